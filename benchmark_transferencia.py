@@ -0,0 +1,211 @@
+import socket as skt
+import os
+import sys
+import time
+import csv
+import hashlib
+import datetime
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+
+import metricas
+from proxy_rede import PROFILES, start_proxy
+
+try:
+    import resource  # Tempo de CPU e pico de memória do processo (não existe no Windows)
+except ImportError:
+    resource = None
+
+
+# Benchmark de transferência de arquivos das entregas 1 e 2 em loopback: para cada combinação da
+# matriz abaixo, um processo novo sobe o servidor numa thread e faz a ida e volta do arquivo com o
+# cliente (entrega1: servidor/cliente; entrega2: RDT.send_file/receive_file), passando pelo proxy_rede
+# com o perfil de rede da combinação (o proxy roda neste processo, fora da CPU medida). Cada linha da
+# tabela também vai para o CSV, com data e hora, para acompanhar os números entre uma mudança e outra
+FILE_SIZES = (64 * 1024, 1024 * 1024, 4 * 1024 * 1024)  # Tamanhos dos arquivos (bytes)
+CHUNK_SIZES = (1024, 8972)  # Tamanho dos datagramas (MAX_BUFFER, sem a negociação aumentar)
+NETWORK_PROFILES = ('limpo', 'perda', 'wifi')  # Perfis do proxy_rede usados com a entrega2
+ENTREGA1_PROFILES = ('limpo', 'lan')  # A entrega1 não recupera perdas: só perfis sem perda
+WINDOW_SIZES = (16, 64)  # Janela do Selective Repeat da entrega2 (a entrega1 não tem janela)
+ENTREGAS = ('entrega1', 'entrega2')
+TRANSFER_TIMEOUT = 60.0  # Segundos até desistir de uma transferência
+RESULTS_FILE = 'benchmark_transferencia.csv'  # Resultados acumulados de todas as rodadas
+
+MODULES = {  # entrega -> (arquivo do servidor, arquivo do cliente)
+    'entrega1': ('UDPservidor.py', 'UDPcliente.py'),
+    'entrega2': ('UDPservidor2.py', 'UDPcliente2.py'),
+}
+RETRANSMIT_METRIC = 'rdt_retransmissions_total'  # Contador da entrega2 (por timeout e rápida, em rótulos)
+COLUMNS = ('entrega', 'tamanho', 'datagrama', 'perfil', 'janela', 'status', 'segundos', 'goodput_mb_s',
+           'retransmissoes', 'cpu_s', 'pico_rss_kb')
+FILE_WRITE_STEP = 1024 * 1024  # O arquivo de entrada é gerado em pedaços desse tamanho
+
+
+def load(entrega, filename):
+    # Carrega o módulo da entrega pelo caminho, sem as mensagens dele na saída do benchmark
+    root = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(filename[:-3], os.path.join(root, entrega, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.print = lambda *args, **kwargs: None
+    metricas.LOG_LEVEL = 'silencio'  # O log das entregas sai pelo metricas.py
+    module.PROBE_SIZES = ()  # Sem negociação: os datagramas ficam no tamanho da configuração
+    return module
+
+
+def make_file(path, size):
+    with open(path, 'wb') as f:
+        for offset in range(0, size, FILE_WRITE_STEP):
+            f.write(os.urandom(min(FILE_WRITE_STEP, size - offset)))
+
+
+def digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FILE_WRITE_STEP), b''):
+            sha.update(block)
+    return sha.digest()
+
+
+def transfer_entrega1(S, C, source, chunk, route):
+    # Como o main do servidor e do cliente da entrega1, com as portas escolhidas pelo SO; o cliente
+    # fala com o proxy que route devolve, na frente do servidor
+    server = S.servidor(skt.AF_INET, skt.SOCK_DGRAM, ('localhost', 0), chunk)
+    server_addr = route(server.sckt.getsockname())
+
+    def serve():
+        if S.STREAMING:
+            server.echo_file()
+            return
+        filename, client_address = server.receive_file()
+        server.send(client_address, filename.encode('utf-8'))
+        server.send_file(client_address, filename)
+    client = C.cliente(skt.AF_INET, skt.SOCK_DGRAM, ('localhost', 0), chunk)
+    client.negotiate(server_addr)
+    listener = threading.Thread(target=client.listen, daemon=True)
+    threading.Thread(target=serve, daemon=True).start()
+    listener.start()
+    client.send_file(server_addr, source)
+    return listener, 'retornado_' + os.path.basename(source), ()
+
+
+def transfer_entrega2(S, C, source, chunk, window, route):
+    os.makedirs('servidor')
+    server = S.Servidor(skt.AF_INET, skt.SOCK_DGRAM, ('localhost', 0), chunk)
+    client = C.Cliente(skt.AF_INET, skt.SOCK_DGRAM, ('localhost', 0), chunk)
+    for rdt, module in ((server.rdt, S), (client.rdt, C)):
+        rdt.window_size = window
+        rdt.cc = module.CongestionControl(window)
+    server_addr = route(server.sckt.getsockname())
+
+    def serve():
+        filename, client_addr = server.receive_file()
+        server.send_file(client_addr, filename)
+
+    def receive():
+        # Como o Cliente.receive_file, mas gravando fora do diretório do servidor (os dois usam o mesmo nome)
+        name, _ = client.rdt.receive()
+        client.rdt.receive_file(os.path.join('..', name.decode('utf-8')))
+    os.chdir('servidor')  # O servidor grava os arquivos dele no diretório atual
+    threading.Thread(target=serve, daemon=True).start()
+    client.send_file(server_addr, os.path.join('..', source))
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    return receiver, os.path.join('..', 'retornado_' + os.path.basename(source)), (server.rdt, client.rdt)
+
+
+def run_config(config, conn):
+    # Roda uma configuração num processo novo (o pico de memória e a CPU são só dela) e manda a linha
+    # pelo pipe; antes, manda o endereço do servidor e recebe o do proxy
+    entrega, size, chunk, profile, window = config
+
+    def route(server_addr):
+        conn.send(server_addr)
+        return conn.recv()
+    os.chdir(tempfile.mkdtemp())
+    S, C = (load(entrega, filename) for filename in MODULES[entrega])
+    source = 'entrada.bin'
+    make_file(source, size)
+    usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    start = time.perf_counter()
+    status = 'ok'
+    rdts = ()
+    try:
+        if entrega == 'entrega1':
+            receiver, output, rdts = transfer_entrega1(S, C, source, chunk, route)
+        else:
+            receiver, output, rdts = transfer_entrega2(S, C, source, chunk, window, route)
+        # O tempo vai até o cliente ter o arquivo de volta: o servidor pode seguir esperando o último
+        # ACK (a entrega2 não tem encerramento), e isso não entra na medida
+        receiver.join(max(start + TRANSFER_TIMEOUT - time.perf_counter(), 0))
+        if receiver.is_alive():
+            status = 'timeout'
+    except Exception as e:
+        status = f"erro: {e!r}"
+    elapsed = time.perf_counter() - start
+    if status == 'ok' and digest(output) != digest(source if entrega == 'entrega1' else os.path.join('..', source)):
+        status = 'corrompido'
+    cpu = peak = None
+    if usage is not None:
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = after.ru_utime - usage.ru_utime + after.ru_stime - usage.ru_stime
+        peak = after.ru_maxrss // 1024 if sys.platform == 'darwin' else after.ru_maxrss  # KiB (no macOS vem em bytes)
+    goodput = 2 * size / elapsed / 1e6 if status == 'ok' else 0.0  # Ida e volta
+    retransmissions = sum(value for rdt in rdts for name, value in rdt.metrics.snapshot()['counters'].items()
+                          if name.partition('{')[0] == RETRANSMIT_METRIC)
+    conn.send((entrega, size, chunk, profile, window, status, round(elapsed, 4), round(goodput, 3), retransmissions,
+               None if cpu is None else round(cpu, 3), peak))
+    conn.close()
+    os._exit(0)  # Threads presas numa transferência que não terminou não seguram o processo
+
+
+def configurations():
+    for entrega in ENTREGAS:
+        for size in FILE_SIZES:
+            for chunk in CHUNK_SIZES:
+                if entrega == 'entrega1':
+                    for profile in ENTREGA1_PROFILES:
+                        yield entrega, size, chunk, profile, None
+                    continue
+                for profile in NETWORK_PROFILES:
+                    for window in WINDOW_SIZES:
+                        yield entrega, size, chunk, profile, window
+
+
+def main_benchmark():
+    context = multiprocessing.get_context('spawn')  # Processo limpo por configuração
+    stamp = datetime.datetime.now().isoformat(timespec='seconds')
+    new_file = not os.path.exists(RESULTS_FILE)
+    with open(RESULTS_FILE, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(('data',) + COLUMNS)
+        print(' '.join(f"{column:>14}" for column in COLUMNS))
+        for config in configurations():
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=run_config, args=(config, child_conn))
+            process.start()
+            child_conn.close()
+            row = config + ('timeout', None, 0.0, None, None, None)  # Se o processo travar fora da transferência
+            stop = None
+            if conn.poll(TRANSFER_TIMEOUT):
+                proxy_addr, stop = start_proxy(conn.recv(), PROFILES[config[3]])
+                conn.send(proxy_addr)
+                if conn.poll(TRANSFER_TIMEOUT + 30):
+                    row = conn.recv()
+            if stop is not None:
+                stop()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+            writer.writerow((stamp,) + row)
+            f.flush()
+            print(' '.join(f"{'-' if value is None else value:>14}" for value in row))
+    print(f"Resultados acrescentados em {RESULTS_FILE}")
+
+
+# Verifica se o script está sendo executado diretamente
+if __name__ == "__main__":
+    main_benchmark()
@@ -1,11 +1,169 @@
 import socket as skt
 import os
 import time
+import mmap
+import threading
+import struct
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #metricas.py fica na raiz do repositorio
+from metricas import Perfil
 
 MAX_BUFFER = 1024 #tam max dos dados
 addr_bind = ('localhost', 8080) #end e porta que o cliente esta vinculado
 addr_target = ('127.0.0.1', 7070) #end e porta do servidor
+PACING_RATE = 16 * 1024 * 1024 #taxa de envio em bytes por segundo (sem ACK nao ha como medir o caminho)
+PACING_BURST = 32 * 1024 #rajada maxima, menor que o buffer de recepcao do outro lado
+PREALLOC_STEP = 16 * 1024 * 1024 #o arquivo recebido e pre-alocado em blocos desse tamanho
+MAX_DATAGRAM = 65507 #maior datagrama UDP sobre IPv4; o buffer de recepcao aceita ate isso
+PROBE_SIZES = (65507, 32768, 16384, 8972, 1472) #tamanhos testados na negociacao, do maior pro menor
+PROBE_TIMEOUT = 0.2 #espera pela resposta de cada sonda (segundos)
+PROBE_TRIES = 2 #sondas perdidas antes de desistir de um tamanho
+PROBE_MAGIC = b'\x00PROBE' #inicio das sondas (nenhum nome de arquivo comeca com byte nulo)
+PROBE_REPLY = b'\x00PROBEOK ' #resposta do servidor, seguida do tamanho que chegou
+SOL_UDP = getattr(skt, 'SOL_UDP', 17) #o modulo socket nao exporta as opcoes de GSO/GRO em todas as versoes
+UDP_SEGMENT = getattr(skt, 'UDP_SEGMENT', 103) #GSO: o kernel corta um buffer grande em varios datagramas
+UDP_GRO = getattr(skt, 'UDP_GRO', 104) #GRO: o kernel entrega varios datagramas do mesmo fluxo numa leitura
+GSO_MAX_SEGMENTS = 64 #maximo de datagramas por envio segmentado (UDP_MAX_SEGMENTS do kernel)
+GSO_SIZE = struct.Struct('=H') #tamanho de cada segmento, no cmsg do sendmsg
+GRO_SIZE = struct.Struct('=i') #tamanho de cada segmento coalescido, no cmsg do recvmsg
+#modo de perfil: com PROFILE ligado, os metodos e funcoes abaixo sao trocados por versoes cronometradas
+#(spans) e, na saida do cliente, o tempo de cada pilha de spans vai para PROFILE_FILE no formato
+#colapsado dos flame graphs. Desligado, nada e trocado: o custo e zero
+PROFILE = False
+PROFILE_FILE = 'perfil.folded' #lido pelo flamegraph.pl, speedscope ou inferno
+CLIENT_SPANS = { #metodo do cliente -> nome do span (syscall e disco separam onde vai o tempo)
+    'negotiate': 'negotiate', 'send_file': 'send_file', 'listen': 'listen',
+    'send_segments': 'send_segments',
+    'send': 'syscall:send', #so o sendto: a espera do pacer fica no span dela, logo abaixo
+}
+PACER_SPANS = {'consume': 'sleep:pacer'} #metodo do TokenBucket -> span (e onde o envio passa mais tempo)
+FUNCTION_SPANS = { #funcoes do modulo -> nome do span
+    'receive_into_file': 'receive_into_file', 'recv_segments': 'syscall:recv', #inclui a espera pelo proximo datagrama
+    'pwrite': 'disco:pwrite', 'preallocate': 'disco:fallocate', 'map_file': 'disco:mmap',
+}
+
+
+def pwrite(fd, data, offset):
+    # escreve na posicao dada sem mexer no cursor do arquivo (no Windows cai no lseek + write)
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def preallocate(fd, size):
+    # reserva o espaço em disco de uma vez em vez de o arquivo crescer a cada datagrama
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size) # sistema de arquivos ou SO sem fallocate
+
+
+def set_dont_fragment(sckt, on):
+    # liga o "não fragmentar" para o SO recusar na hora (EMSGSIZE) o que passa do MTU do caminho;
+    # só existe no Linux, nos outros SOs uma sonda grande demais simplesmente se perde
+    if not hasattr(skt, 'IP_MTU_DISCOVER'):
+        return
+    mode = getattr(skt, 'IP_PMTUDISC_DO', 2) if on else getattr(skt, 'IP_PMTUDISC_DONT', 0)
+    try:
+        sckt.setsockopt(skt.IPPROTO_IP, skt.IP_MTU_DISCOVER, mode)
+    except OSError:
+        pass
+
+
+def map_file(filepath):
+    # mapeia o arquivo na memória; as fatias (memoryview) do mapa vão direto pro sendto, sem cópia
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return memoryview(b'') # mmap não aceita arquivo vazio
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def gso_supported(sckt):
+    # UDP_SEGMENT existe a partir do Linux 4.18; nos outros casos cada datagrama continua sendo um sendto
+    if not hasattr(sckt, 'sendmsg'):
+        return False
+    try:
+        sckt.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def enable_gro(sckt):
+    # UDP_GRO existe a partir do Linux 5.0; sem ele cada leitura devolve um datagrama só
+    if not hasattr(sckt, 'recvmsg_into'):
+        return False
+    try:
+        sckt.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+def recv_segments(sckt, recv_buf, gro):
+    # recebe um datagrama ou, com GRO, vários colados; devolve também o tamanho de cada um deles
+    if not gro:
+        nbytes, addr = sckt.recvfrom_into(recv_buf)
+        return nbytes, nbytes, addr
+    nbytes, ancdata, _, addr = sckt.recvmsg_into([recv_buf], skt.CMSG_SPACE(GRO_SIZE.size))
+    segment = nbytes
+    for level, ctype, data in ancdata:
+        if level == SOL_UDP and ctype == UDP_GRO:
+            segment = GRO_SIZE.unpack_from(data)[0]
+    return nbytes, segment or nbytes, addr
+
+
+def receive_into_file(sckt, recv_buf, path, gro=False):
+    # recebe datagramas num buffer reaproveitado e escreve com pwrite num arquivo pré-alocado, até o EOF
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    view = memoryview(recv_buf)
+    offset = 0 # quanto já foi escrito
+    allocated = 0 # quanto já foi pré-alocado
+    try:
+        while True:
+            try:
+                nbytes, segment, addr = recv_segments(sckt, recv_buf, gro)
+            except skt.timeout:
+                continue  # continua escutando em caso de timeout
+            # com GRO vários datagramas chegam colados e o EOF pode ser o último (e menor) deles
+            last = (nbytes - 1) // segment * segment if nbytes else 0
+            eof = view[last:nbytes] == b'EOF' # recebe dados ate o eof
+            if eof:
+                nbytes = last
+            if offset + nbytes > allocated:
+                allocated += PREALLOC_STEP
+                preallocate(fd, allocated)
+            if nbytes:
+                offset += pwrite(fd, view[:nbytes], offset) # todos os datagramas colados numa escrita só
+            if eof:
+                print("Recepção do arquivo concluída.")
+                return addr
+    finally:
+        os.ftruncate(fd, offset) # devolve o que sobrou da pré-alocação
+        os.close(fd)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate # bytes liberados por segundo
+        self.burst = burst # quanto pode sair de rajada depois de um tempo parado
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def consume(self, amount):
+        # repõe as fichas pelo tempo que passou e só dorme se estiver devendo
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+PROFILER = Perfil() #perfil do processo (so e usado com PROFILE ligado)
 
 
 class cliente():
@@ -17,40 +175,94 @@ class cliente():
         #if self.sckt is None: # entra aqui se o socket nao puder ser criado
         #    raise Exception ("Socket indisponivel")
         
-        self.MAX_BUFFER = MAX_BUFFER # mesmo tam max do buffer original
+        self.MAX_BUFFER = MAX_BUFFER # tam dos datagramas enviados (sobe depois da negociacao)
+        self.pacer = TokenBucket(PACING_RATE, PACING_BURST) # controla o ritmo dos envios
+        self.recv_buf = bytearray(MAX_DATAGRAM) # buffer reaproveitado por todo recvfrom_into
+        self.gso = gso_supported(self.sckt) # varios datagramas saem num unico sendmsg
+        self.gro = enable_gro(self.sckt) # uma leitura pode trazer varios datagramas colados
+        if PROFILE:
+            PROFILER.start(globals(), FUNCTION_SPANS, PROFILE_FILE)
+            PROFILER.instrument(self, CLIENT_SPANS)
+            PROFILER.instrument(self.pacer, PACER_SPANS)
+
+    def negotiate(self, server_addr: tuple[str, int]):
+        # descobre o maior datagrama que chega inteiro no servidor, testando do maior pro menor;
+        # o servidor responde cada sonda com o tamanho recebido e passa a usar o mesmo tamanho na volta
+        size = self.MAX_BUFFER
+        set_dont_fragment(self.sckt, True)
+        try:
+            for probe_size in PROBE_SIZES:
+                if probe_size <= size:
+                    break
+                if self.probe(server_addr, probe_size):
+                    size = probe_size
+                    break
+        finally:
+            set_dont_fragment(self.sckt, False)
+            self.sckt.settimeout(None)
+        print(f"Tamanho de datagrama negociado: {size} bytes")
+        self.MAX_BUFFER = size
+
+    def probe(self, server_addr: tuple[str, int], size: int):
+        packet = PROBE_MAGIC + bytes(size - len(PROBE_MAGIC))
+        reply = PROBE_REPLY + str(size).encode()
+        self.sckt.settimeout(PROBE_TIMEOUT)
+        for _ in range(PROBE_TRIES):
+            try:
+                self.sckt.sendto(packet, server_addr)
+            except OSError:
+                return False # EMSGSIZE: maior que o MTU do caminho, nem adianta esperar
+            try:
+                while True:
+                    data, _ = self.sckt.recvfrom(MAX_DATAGRAM)
+                    if data == reply:
+                        return True # respostas atrasadas de sondas anteriores sao descartadas
+            except skt.timeout:
+                continue
+        return False # sondas perdidas: tenta um tamanho menor
 
     def listen(self):
             # Recebe o nome do arquivo renomeado do servidor
-        data, _ = self.sckt.recvfrom(self.MAX_BUFFER)
+        data, _ = self.sckt.recvfrom(MAX_DATAGRAM)
+        while data.startswith(PROBE_REPLY): # resposta atrasada de uma sonda
+            data, _ = self.sckt.recvfrom(MAX_DATAGRAM)
         new_filename = data.decode('utf-8') # abre um novo arquivo com o nome recebido para que ele possa ser escrito em modo binario
         print(f"Recendo o arquivo: {new_filename}") #avisa que a file foi recebida
 
-        with open(new_filename, 'wb') as f:
-            while True:
-                try:
-                    data, _ = self.sckt.recvfrom(self.MAX_BUFFER)
-                    if data == b'EOF': #quando parar de falar (recebe ate o fim (EOF))
-                        print("Recepção do arquivo concluída.") # avisa que terminou de receber
-                        self.sckt.close()
-                        break # fecha o socket e sai do loop
-                    f.write(data)
-                except:
-                    continue # ta ignorando o erro para continuar escutando
+        receive_into_file(self.sckt, self.recv_buf, new_filename, self.gro) # escreve os datagramas direto do buffer no arquivo
+        self.sckt.close() # fecha o socket depois do EOF
         
     def send(self, server_addr: tuple[str,str], msg:bytes):
             self.sckt.sendto(msg, server_addr) # envia msg (uma mensagem) para o end de servidor
-            time.sleep(0.0001) # pequena pausa para evitar congestionamento de rede
+            self.pacer.consume(len(msg)) # espera so o necessario para nao estourar o buffer do servidor
+
+    def send_segments(self, server_addr: tuple[str, int], data, segment: int):
+        # com GSO o bloco inteiro vai num sendmsg e o kernel corta em datagramas de `segment` bytes
+        if self.gso and len(data) > segment:
+            try:
+                self.sckt.sendmsg([data], [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(segment))], 0, server_addr)
+            except OSError:
+                self.gso = False # interface sem suporte (ex.: EIO sem checksum offload): volta pro sendto
+            else:
+                self.pacer.consume(len(data))
+                return
+        for offset in range(0, len(data), segment):
+            self.send(server_addr, data[offset:offset + segment])
+
+    def gso_block(self):
+        # bytes por envio: quantos datagramas do tamanho atual cabem num envio segmentado
+        if not self.gso:
+            return self.MAX_BUFFER
+        return self.MAX_BUFFER * max(1, min(GSO_MAX_SEGMENTS, MAX_DATAGRAM // self.MAX_BUFFER))
 
     def send_file (self, server_addr: tuple[str, int], filepath: str): # Extrai o nome do arquivo do caminho (filepath) e envia esse nome para o servidor.
         filename = os.path.basename(filepath)
         self.send(server_addr, filename.encode('utf-8'))
 
-        with open(filepath, 'rb') as f: #Abre o arquivo em modo de leitura binária.
-            while True:
-                data = f.read(self.MAX_BUFFER) # le o arquivo de 1024 em 1024 bytes
-                if not data:
-                    break
-                self.send(server_addr, data)
+        view = map_file(filepath) #arquivo mapeado na memoria
+        block = self.gso_block()
+        for offset in range(0, len(view), block): # envia pedaços do tamanho negociado, um bloco GSO por vez
+            self.send_segments(server_addr, view[offset:offset + block], self.MAX_BUFFER)
         
         # Notifica o servidor que o envio do arquivo terminou
         self.send(server_addr, b'EOF')
@@ -63,8 +275,13 @@ def main():
         print(f"File {filename} does not exist.")
         return
     
+    client.negotiate(addr_target) # antes do listener, que passaria a disputar as respostas das sondas
+
+    # escuta em paralelo com o envio: no modo streaming o servidor devolve os dados enquanto o upload ainda esta chegando
+    listener = threading.Thread(target=client.listen)
+    listener.start()
     client.send_file(addr_target, filename) # se existir Envia o arquivo especificado para o servidor.
-    client.listen()  # para colocar ele para escutar
+    listener.join()
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,214 @@
 import socket as skt
 import os
 import time
+import mmap
+import threading
+import collections
+import tempfile
+import struct
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # metricas.py fica na raiz do repositório
+from metricas import Perfil
 
 MAX_BUFFER = 1024
 ADDR_BIND = ('localhost', 7070)
+PACING_RATE = 16 * 1024 * 1024 # taxa de envio em bytes por segundo (sem ACK não há como medir o caminho)
+PACING_BURST = 32 * 1024 # rajada máxima, menor que o buffer de recepção do outro lado
+PREALLOC_STEP = 16 * 1024 * 1024 # o arquivo recebido é pré-alocado em blocos desse tamanho
+STREAMING = True # devolve os pedaços enquanto o upload ainda está chegando, sem passar pelo disco
+SPILL_THRESHOLD = 8 * 1024 * 1024 # bytes na fila de eco antes de começar a usar o disco
+SPILL_HEADER = struct.Struct('!HH') # tamanho de cada pedaço guardado no arquivo da fila e dos datagramas dentro dele
+MAX_DATAGRAM = 65507 # maior datagrama UDP sobre IPv4; o buffer de recepção aceita até isso
+PROBE_MAGIC = b'\x00PROBE' # início das sondas do cliente (nenhum nome de arquivo começa com byte nulo)
+PROBE_REPLY = b'\x00PROBEOK ' # resposta de uma sonda, seguida do tamanho que chegou
+SOL_UDP = getattr(skt, 'SOL_UDP', 17) # o módulo socket não exporta as opções de GSO/GRO em todas as versões
+UDP_SEGMENT = getattr(skt, 'UDP_SEGMENT', 103) # GSO: o kernel corta um buffer grande em vários datagramas
+UDP_GRO = getattr(skt, 'UDP_GRO', 104) # GRO: o kernel entrega vários datagramas do mesmo fluxo numa leitura
+GSO_MAX_SEGMENTS = 64 # máximo de datagramas por envio segmentado (UDP_MAX_SEGMENTS do kernel)
+GSO_SIZE = struct.Struct('=H') # tamanho de cada segmento, no cmsg do sendmsg
+GRO_SIZE = struct.Struct('=i') # tamanho de cada segmento coalescido, no cmsg do recvmsg
+# modo de perfil: com PROFILE ligado, os métodos e funções abaixo são trocados por versões cronometradas
+# (spans) e, na saída do servidor (Ctrl+C), o tempo de cada pilha de spans vai para PROFILE_FILE no
+# formato colapsado dos flame graphs. Desligado, nada é trocado: o custo é zero
+PROFILE = False
+PROFILE_FILE = 'perfil.folded' # lido pelo flamegraph.pl, speedscope ou inferno
+SERVER_SPANS = { # método do servidor -> nome do span (syscall e disco separam onde vai o tempo)
+    'receive_file': 'receive_file', 'echo_file': 'echo_file', 'send_file': 'send_file',
+    'receive_filename': 'nome', 'send_segments': 'send_segments',
+    'send': 'syscall:send', # só o sendto: a espera do pacer fica no span dela, logo abaixo
+}
+PACER_SPANS = {'consume': 'sleep:pacer'} # método do TokenBucket -> span (é onde o envio passa mais tempo)
+FUNCTION_SPANS = { # funções do módulo -> nome do span
+    'receive_into_file': 'receive_into_file', 'recv_segments': 'syscall:recv', # inclui a espera pelo próximo datagrama
+    'pwrite': 'disco:pwrite', 'preallocate': 'disco:fallocate', 'map_file': 'disco:mmap',
+}
+
+
+def pwrite(fd, data, offset):
+    # escreve na posição dada sem mexer no cursor do arquivo (no Windows cai no lseek + write)
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def preallocate(fd, size):
+    # reserva o espaço em disco de uma vez em vez de o arquivo crescer a cada datagrama
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size) # sistema de arquivos ou SO sem fallocate
+
+
+def map_file(filepath):
+    # mapeia o arquivo na memória; as fatias (memoryview) do mapa vão direto pro sendto, sem cópia
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return memoryview(b'') # mmap não aceita arquivo vazio
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def gso_supported(sckt):
+    # UDP_SEGMENT existe a partir do Linux 4.18; nos outros casos cada datagrama continua sendo um sendto
+    if not hasattr(sckt, 'sendmsg'):
+        return False
+    try:
+        sckt.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def enable_gro(sckt):
+    # UDP_GRO existe a partir do Linux 5.0; sem ele cada leitura devolve um datagrama só
+    if not hasattr(sckt, 'recvmsg_into'):
+        return False
+    try:
+        sckt.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+def recv_segments(sckt, recv_buf, gro):
+    # recebe um datagrama ou, com GRO, vários colados; devolve também o tamanho de cada um deles
+    if not gro:
+        nbytes, addr = sckt.recvfrom_into(recv_buf)
+        return nbytes, nbytes, addr
+    nbytes, ancdata, _, addr = sckt.recvmsg_into([recv_buf], skt.CMSG_SPACE(GRO_SIZE.size))
+    segment = nbytes
+    for level, ctype, data in ancdata:
+        if level == SOL_UDP and ctype == UDP_GRO:
+            segment = GRO_SIZE.unpack_from(data)[0]
+    return nbytes, segment or nbytes, addr
+
+
+def receive_into_file(sckt, recv_buf, path, gro=False):
+    # recebe datagramas num buffer reaproveitado e escreve com pwrite num arquivo pré-alocado, até o EOF
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    view = memoryview(recv_buf)
+    offset = 0 # quanto já foi escrito
+    allocated = 0 # quanto já foi pré-alocado
+    try:
+        while True:
+            try:
+                nbytes, segment, addr = recv_segments(sckt, recv_buf, gro)
+            except skt.timeout:
+                continue  # continua escutando em caso de timeout
+            # com GRO vários datagramas chegam colados e o EOF pode ser o último (e menor) deles
+            last = (nbytes - 1) // segment * segment if nbytes else 0
+            eof = view[last:nbytes] == b'EOF' # recebe dados ate o eof
+            if eof:
+                nbytes = last
+            if offset + nbytes > allocated:
+                allocated += PREALLOC_STEP
+                preallocate(fd, allocated)
+            if nbytes:
+                offset += pwrite(fd, view[:nbytes], offset) # todos os datagramas colados numa escrita só
+            if eof:
+                print("Recepção do arquivo concluída.")
+                return addr
+    finally:
+        os.ftruncate(fd, offset) # devolve o que sobrou da pré-alocação
+        os.close(fd)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate # bytes liberados por segundo
+        self.burst = burst # quanto pode sair de rajada depois de um tempo parado
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def consume(self, amount):
+        # repõe as fichas pelo tempo que passou e só dorme se estiver devendo
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+class SpillQueue:
+    def __init__(self, threshold):
+        self.threshold = threshold # bytes que podem ficar na memória antes de ir pro disco
+        self.memory = collections.deque() # pedaços mais antigos, em memória
+        self.memory_bytes = 0
+        self.spill = None # arquivo temporário com os pedaços mais novos quando a memória enche
+        self.read_pos = 0
+        self.write_pos = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, chunk, segment):
+        with self.cond:
+            # depois que algo foi pro disco, tudo que chega vai pra lá também, pra manter a ordem
+            if self.write_pos > self.read_pos or self.memory_bytes + len(chunk) > self.threshold:
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(self.write_pos)
+                self.spill.write(SPILL_HEADER.pack(len(chunk), segment))
+                self.spill.write(chunk)
+                self.write_pos = self.spill.tell()
+            else:
+                self.memory.append((chunk, segment))
+                self.memory_bytes += len(chunk)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True # não chega mais nada, quem estiver esperando pode terminar
+            self.cond.notify()
+
+    def get(self):
+        # devolve o próximo pedaço (e o tamanho dos datagramas dentro dele) na ordem de chegada,
+        # ou None quando a fila fechou e esvaziou
+        with self.cond:
+            while not self.memory and self.write_pos == self.read_pos:
+                if self.closed:
+                    if self.spill is not None:
+                        self.spill.close()
+                    return None
+                self.cond.wait()
+            if self.memory:
+                chunk, segment = self.memory.popleft()
+                self.memory_bytes -= len(chunk)
+                return chunk, segment
+            self.spill.seek(self.read_pos)
+            size, segment = SPILL_HEADER.unpack(self.spill.read(SPILL_HEADER.size))
+            chunk = self.spill.read(size)
+            self.read_pos = self.spill.tell()
+            if self.read_pos == self.write_pos:
+                # o disco esvaziou: volta a usar só a memória
+                self.spill.truncate(0)
+                self.read_pos = self.write_pos = 0
+            return chunk, segment
+
+
+PROFILER = Perfil() # perfil do processo (só é usado com PROFILE ligado)
+
 
 class servidor:
     def __init__(self, sckt_family, sckt_type, sckt_binding, MAX_BUFFER):
@@ -14,24 +219,36 @@ class servidor:
         #if self.sckt is None: # se o socket nao puder ser criado
         #    raise Exception("Socket indisponível")
         
-        self.MAX_BUFFER = MAX_BUFFER
+        self.base_buffer = MAX_BUFFER # tamanho usado com clientes que não negociam
+        self.MAX_BUFFER = MAX_BUFFER # tamanho dos datagramas devolvidos ao cliente atual
+        self.pacer = TokenBucket(PACING_RATE, PACING_BURST) # controla o ritmo dos envios
+        self.recv_buf = bytearray(MAX_DATAGRAM) # buffer reaproveitado por todo recvfrom_into
+        self.gso = gso_supported(self.sckt) # vários datagramas saem num único sendmsg
+        self.gro = enable_gro(self.sckt) # uma leitura pode trazer vários datagramas colados
+        if PROFILE:
+            PROFILER.start(globals(), FUNCTION_SPANS, PROFILE_FILE)
+            PROFILER.instrument(self, SERVER_SPANS)
+            PROFILER.instrument(self.pacer, PACER_SPANS)
+
+    def receive_filename(self):
+        # responde as sondas de tamanho até chegar o nome do arquivo; a maior sonda que chegou
+        # vira o tamanho dos datagramas devolvidos a esse cliente
+        view = memoryview(self.recv_buf)
+        self.MAX_BUFFER = self.base_buffer
+        while True:
+            nbytes, client_address = self.sckt.recvfrom_into(self.recv_buf)
+            # o buffer é reaproveitado: além de nbytes ainda pode estar o início de uma sonda anterior
+            if nbytes < len(PROBE_MAGIC) or view[:len(PROBE_MAGIC)] != PROBE_MAGIC:
+                return bytes(view[:nbytes]).decode('utf-8'), client_address
+            self.sckt.sendto(PROBE_REPLY + str(nbytes).encode(), client_address)
+            self.MAX_BUFFER = max(self.MAX_BUFFER, nbytes)
 
     def receive_file(self): # Recebe o nome do arquivo enviado pelo cliente.
-        data, client_address = self.sckt.recvfrom(self.MAX_BUFFER)
-        filename = data.decode('utf-8')
+        filename, client_address = self.receive_filename()
         print(f"Arquivo recebido: {filename}")
         
-        # Prepara para receber o arquivo
-        with open('recebido_' + filename, 'wb') as f: # Abre um novo arquivo com um nome temporário (recebido_ + filename) para escrita em modo binário.
-            while True:
-                try:
-                    data, addr = self.sckt.recvfrom(self.MAX_BUFFER)
-                    if data == b'EOF': # recebe dados ate o eof
-                        print("Recepção do arquivo concluída.")
-                        break
-                    f.write(data)
-                except skt.timeout:
-                    continue  # continua escutando em caso de timeout
+        # Recebe o arquivo com um nome temporário (recebido_ + filename), sem copiar os datagramas
+        receive_into_file(self.sckt, self.recv_buf, 'recebido_' + filename, self.gro)
         
         # Renomeia o arquivo
         new_filename = 'retornado_' + filename
@@ -39,17 +256,70 @@ class servidor:
         
         return new_filename, client_address #Retorna o novo nome do arquivo e o endereço do cliente.
 
+    def echo_file(self): # Devolve o arquivo pro cliente enquanto ele ainda está sendo enviado
+        filename, client_address = self.receive_filename()
+        print(f"Arquivo recebido: {filename}")
+        self.send(client_address, ('retornado_' + filename).encode('utf-8')) # o nome vai antes dos dados
+
+        # uma thread devolve os pedaços na ordem em que chegaram; a fila só vai pro disco se o
+        # cliente ficar muito atrás de quem está recebendo
+        queue = SpillQueue(SPILL_THRESHOLD)
+        def relay():
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                self.send_segments(client_address, *item) # devolve os datagramas colados do jeito que vieram
+            self.send(client_address, b'EOF') # Notifica o cliente que o envio do arquivo terminou
+        sender = threading.Thread(target=relay)
+        sender.start()
+
+        view = memoryview(self.recv_buf)
+        try:
+            while True:
+                nbytes, segment, _ = recv_segments(self.sckt, self.recv_buf, self.gro)
+                last = (nbytes - 1) // segment * segment if nbytes else 0 # com GRO o EOF pode vir colado no fim
+                eof = view[last:nbytes] == b'EOF' # recebe dados ate o eof
+                if eof:
+                    nbytes = last
+                if nbytes:
+                    queue.put(bytes(view[:nbytes]), segment) # copia, o buffer de recepção vai ser reusado
+                if eof:
+                    print("Recepção do arquivo concluída.")
+                    break
+        finally:
+            queue.close()
+            sender.join()
+        return client_address
+
     def send(self, client_addr: tuple[str, int], msg: bytes):
         self.sckt.sendto(msg, client_addr) # Envia uma mensagem (msg) para o endereço do cliente (client_addr)
-        time.sleep(0.0001)  # pequena pausa para evitar congestionamento de rede
+        self.pacer.consume(len(msg))  # espera só o necessário para não estourar o buffer do cliente
+
+    def send_segments(self, client_addr: tuple[str, int], data, segment: int):
+        # com GSO o bloco inteiro vai num sendmsg e o kernel corta em datagramas de `segment` bytes
+        if self.gso and len(data) > segment:
+            try:
+                self.sckt.sendmsg([data], [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(segment))], 0, client_addr)
+            except OSError:
+                self.gso = False # interface sem suporte (ex.: EIO sem checksum offload): volta pro sendto
+            else:
+                self.pacer.consume(len(data))
+                return
+        for offset in range(0, len(data), segment):
+            self.send(client_addr, data[offset:offset + segment])
+
+    def gso_block(self):
+        # bytes por envio: quantos datagramas do tamanho atual cabem num envio segmentado
+        if not self.gso:
+            return self.MAX_BUFFER
+        return self.MAX_BUFFER * max(1, min(GSO_MAX_SEGMENTS, MAX_DATAGRAM // self.MAX_BUFFER))
 
     def send_file(self, client_addr: tuple[str, int], filepath: str):
-        with open(filepath, 'rb') as f: # Abre o arquivo especificado (filepath) em modo de leitura binária.
-            while True:
-                data = f.read(self.MAX_BUFFER) # le o arquivo de 1024 em 1024 bytes
-                if not data:
-                    break
-                self.send(client_addr, data)
+        view = map_file(filepath) # arquivo mapeado na memória
+        block = self.gso_block()
+        for offset in range(0, len(view), block): # envia pedaços do tamanho negociado, um bloco GSO por vez
+            self.send_segments(client_addr, view[offset:offset + block], self.MAX_BUFFER)
         
         # Notifica o cliente que o envio do arquivo terminou
         self.send(client_addr, b'EOF')
@@ -59,6 +329,10 @@ def main():
     print(f"Server está escutando no {ADDR_BIND}") # onde o servidor esta escutando
     
     while True: # entrando em looping infinito
+        if STREAMING:
+            server.echo_file() # recebe e devolve ao mesmo tempo, sem arquivo intermediário
+            continue
+
         filename, client_address = server.receive_file() # recebendo arquivos de clientes
         
         # Envia o novo nome do arquivo para o cliente
@@ -1,72 +1,578 @@
 import socket as skt
 import os
 import time
-import random
+import itertools
+import struct
+import mmap
+import collections
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # metricas.py fica na raiz do repositório
+from metricas import Metricas, Perfil, log, write_metrics
 
 MAX_BUFFER = 1024  # tamanho máximo dos dados
 ADDR_BIND = ('localhost', 8080)  # endereço e porta do cliente
 ADDR_TARGET = ('127.0.0.1', 7070)  # endereço e porta do servidor
 
-LOSS_PROBABILITY = 0.3  # probabilidade de perda de pacote
+WINDOW_SIZE = 64  # máximo de pacotes em trânsito no Selective Repeat (janela de recepção)
+SEQ_SPACE = 2 ** 16  # espaço de números de sequência (precisa ser >= 2 * WINDOW_SIZE)
+# cabeçalho binário de tamanho fixo: tipo, flags, seq_num, ack e tamanho do payload
+HEADER = struct.Struct('!BBHHH')
+HEADER_SIZE = HEADER.size
+TYPE_DATA = 0  # pacote com dados
+TYPE_ACK = 1  # confirmação de um pacote (o número vai no campo ack)
+TYPE_PROBE = 2  # sonda de tamanho de datagrama, o payload é só enchimento
+TYPE_PROBE_ACK = 3  # resposta da sonda (o campo ack leva o tamanho do datagrama que chegou)
+INITIAL_RTO = 1.0  # timeout de retransmissão antes da primeira medida de RTT (segundos)
+MIN_RTO = 0.05  # limites do timeout de retransmissão (segundos)
+MAX_RTO = 8.0
+MAX_RETRIES = 10  # retransmissões de um mesmo pacote antes de desistir
+DUP_ACK_THRESHOLD = 3  # ACKs de pacotes posteriores que indicam perda (retransmissão rápida)
+PACING_GAIN = 2  # o pacer envia a janela em metade do RTT, deixando folga para crescer
+PREALLOC_STEP = 16 * 1024 * 1024  # o arquivo recebido é pré-alocado em blocos desse tamanho
+MAX_DATAGRAM = 65507  # maior datagrama UDP sobre IPv4; os buffers de recepção aceitam até isso
+PROBE_SIZES = (65507, 32768, 16384, 8972, 1472)  # tamanhos testados na negociação, do maior pro menor
+PROBE_TIMEOUT = 0.2  # espera pela resposta de cada sonda (segundos)
+PROBE_TRIES = 2  # sondas perdidas antes de desistir de um tamanho
+SHRINK_RETRIES = 3  # retransmissões de um datagrama grande que fazem o tamanho negociado cair
+RCVBUF_SIZE = 4 * 1024 * 1024  # buffer de recepção pedido ao SO, para caber a janela com datagramas grandes
+SOL_UDP = getattr(skt, 'SOL_UDP', 17)  # o módulo socket não exporta as opções de GSO/GRO em todas as versões
+UDP_SEGMENT = getattr(skt, 'UDP_SEGMENT', 103)  # GSO: o kernel corta um buffer grande em vários datagramas
+UDP_GRO = getattr(skt, 'UDP_GRO', 104)  # GRO: o kernel entrega vários datagramas do mesmo fluxo numa leitura
+GSO_MAX_SEGMENTS = 64  # máximo de datagramas por envio segmentado (UDP_MAX_SEGMENTS do kernel)
+GSO_SIZE = struct.Struct('=H')  # tamanho de cada segmento, no cmsg do sendmsg
+GRO_SIZE = struct.Struct('=i')  # tamanho de cada segmento coalescido, no cmsg do recvmsg
+
+# métricas do RDT (pacotes, retransmissões, duplicatas, RTT, filas): ficam em rdt.metrics e, com
+# METRICS_FILE, são gravadas num arquivo a cada METRICS_EVERY segundos e no fim de cada transferência
+METRICS_FILE = None  # arquivo das métricas (None = não grava)
+METRICS_EVERY = 10.0  # segundos entre uma gravação e outra
+# modo de perfil: com PROFILE ligado, os métodos abaixo de cada RDT são trocados por versões
+# cronometradas (spans) e, na saída do programa, o tempo de cada pilha de spans vai para PROFILE_FILE
+# no formato colapsado dos flame graphs. Desligado, nada é trocado: o custo é zero
+PROFILE = False
+PROFILE_FILE = 'perfil.folded'  # lido pelo flamegraph.pl, speedscope ou inferno
+RDT_SPANS = {  # método do RDT -> nome do span (syscall, parse e disco separam onde vai o tempo)
+    'send': 'send', 'receive': 'receive', 'send_file': 'send_file', 'receive_file': 'receive_file',
+    'receive_view': 'receive_view', 'send_window': 'send_window', 'negotiate': 'negotiate',
+    'handle_ack': 'ack', 'handle_data': 'dados', 'parse_packet': 'parse',
+    'recv_packet': 'syscall:recv',  # inclui a espera bloqueada pelo próximo pacote (ACK, pacing, timeout)
+    'udt_send': 'syscall:send', 'gso_send': 'syscall:send_gso', 'send_ack': 'syscall:ack',
+}
+FUNCTION_SPANS = {'pwrite': 'disco:pwrite', 'preallocate': 'disco:fallocate'}  # funções do módulo -> span
+
+
+HAS_SENDMSG = hasattr(skt.socket, 'sendmsg')  # scatter-gather (não existe no Windows)
+GRO_CMSG_SPACE = skt.CMSG_SPACE(GRO_SIZE.size) if hasattr(skt, 'CMSG_SPACE') else 0
+
+
+def pwrite(fd, data, offset):
+    # escreve na posição dada sem mexer no cursor do arquivo (no Windows cai no lseek + write)
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+
+def preallocate(fd, size):
+    # reserva o espaço em disco de uma vez em vez de o arquivo crescer a cada datagrama
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size) # sistema de arquivos ou SO sem fallocate
+
+
+def set_dont_fragment(sckt, on):
+    # liga o "não fragmentar" para o SO recusar na hora (EMSGSIZE) o que passa do MTU do caminho;
+    # só existe no Linux, nos outros SOs uma sonda grande demais simplesmente se perde
+    if not hasattr(skt, 'IP_MTU_DISCOVER'):
+        return
+    mode = getattr(skt, 'IP_PMTUDISC_DO', 2) if on else getattr(skt, 'IP_PMTUDISC_DONT', 0)
+    try:
+        sckt.setsockopt(skt.IPPROTO_IP, skt.IP_MTU_DISCOVER, mode)
+    except OSError:
+        pass
+
+
+def gso_supported(sckt):
+    # UDP_SEGMENT existe a partir do Linux 4.18; nos outros casos cada datagrama continua sendo um sendmsg
+    if not HAS_SENDMSG:
+        return False
+    try:
+        sckt.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def enable_gro(sckt):
+    # UDP_GRO existe a partir do Linux 5.0; sem ele cada recvfrom_into devolve um datagrama só
+    if not hasattr(sckt, 'recvmsg_into'):
+        return False
+    try:
+        sckt.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+PROFILER = Perfil() # perfil do processo (só é usado com PROFILE ligado)
+
+
+class BufferPool:
+    def __init__(self, size, count):
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)] # buffers prontos para o próximo recvfrom_into
+
+    def get(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buf):
+        self.free.append(buf)
+
+
+class CongestionControl:
+    def __init__(self, max_window):
+        self.max_window = max_window # nunca passa da janela de recepção do outro lado
+        self.cwnd = 1.0 # janela de congestionamento, em pacotes
+        self.ssthresh = float(max_window) # limite entre slow start e aumento linear
+        self.last_reduction = 0.0 # instante da última redução da janela
+        self.next_send = 0.0 # instante em que o pacer libera o próximo pacote
+
+    def window(self):
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1 # slow start: dobra a janela a cada RTT
+        else:
+            self.cwnd += 1 / self.cwnd # AIMD: +1 pacote por RTT
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, now, srtt, timeout):
+        # várias perdas da mesma janela contam como um único sinal de congestionamento
+        if not timeout and now - self.last_reduction < (srtt or 0):
+            return
+        self.last_reduction = now
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1.0 if timeout else self.ssthresh # timeout recomeça do slow start
+
+    def on_send(self, now, srtt):
+        # pacing: espalha a janela ao longo do RTT em vez de mandar tudo de rajada
+        if srtt:
+            self.next_send = max(self.next_send, now) + srtt / (self.cwnd * PACING_GAIN)
+
+    def pacing_delay(self, now):
+        return max(self.next_send - now, 0)
 
 
 class RDT:
-    def __init__(self, socket, max_buffer):
+    def __init__(self, socket, max_buffer, window_size=WINDOW_SIZE):
         self.socket = socket
-        self.max_buffer = max_buffer
-        self.seq_num = 0 # numero de sequencia inicial
+        self.max_buffer = max_buffer # tamanho dos datagramas enviados (sobe depois da negociação)
+        self.base_buffer = max_buffer # tamanho seguro para onde voltar se os datagramas grandes se perdem
+        self.negotiated = {} # endereço -> tamanho de datagrama negociado com aquele par
+        self.window_size = window_size # tamanho da janela de envio e de recepção
+        self.seq_num = 0 # próximo número de sequência a ser enviado
+        self.expected_seq = 0 # base da janela de recepção
+        self.recv_buffer = {} # pacotes que chegaram fora de ordem, esperando os anteriores
+        self.srtt = None # RTT suavizado (estimador de Jacobson/Karels, RFC 6298)
+        self.rttvar = None # variação do RTT
+        self.rto = INITIAL_RTO # timeout de retransmissão atual
+        self.cc = CongestionControl(window_size) # controle de congestionamento (slow start + AIMD)
+        self.pool = BufferPool(MAX_DATAGRAM, 4) # cresce sob demanda até caber a janela inteira esperando reordenação
+        self.recv_buf = self.pool.get() # buffer onde cai o próximo datagrama
+        self.lent_buf = None # buffer entregue ao consumidor na última chamada do receive_view
+        self.ack_buf = bytearray(HEADER_SIZE) # os ACKs são montados sempre no mesmo buffer
+        self.gso = gso_supported(socket) # vários pacotes do mesmo tamanho saem num único sendmsg
+        self.gro = enable_gro(socket) # uma leitura pode trazer vários pacotes colados
+        self.gro_pending = collections.deque() # pacotes da última leitura GRO que ainda não foram tratados
+        self.in_flight = {} # pacotes sem ACK do send_window em andamento (só para as métricas)
+        self.metrics = Metricas()
+        self.metrics.gauge('rdt_cwnd_packets', lambda: self.cc.cwnd)
+        self.metrics.gauge('rdt_srtt_seconds', lambda: self.srtt or 0.0)
+        self.metrics.gauge('rdt_rto_seconds', lambda: self.rto)
+        self.metrics.gauge('rdt_in_flight_packets', lambda: len(self.in_flight))
+        self.metrics.gauge('rdt_recv_buffer_packets', lambda: len(self.recv_buffer))
+        if PROFILE:
+            PROFILER.start(globals(), FUNCTION_SPANS, PROFILE_FILE)
+            PROFILER.instrument(self, RDT_SPANS)
+        try:
+            self.socket.setsockopt(skt.SOL_SOCKET, skt.SO_RCVBUF, RCVBUF_SIZE)
+        except OSError:
+            pass # o SO pode limitar o valor (net.core.rmem_max no Linux)
+
+    def reset(self):
+        # esquece a conversa atual (sequências, janelas, RTT): a próxima transferência começa do zero,
+        # como com um par novo. Os buffers que estavam com pacotes voltam pro pool
+        for _, _, buf in self.recv_buffer.values():
+            if buf is not None:
+                self.pool.put(buf)
+        if self.lent_buf is not None:
+            self.pool.put(self.lent_buf)
+            self.lent_buf = None
+        self.recv_buffer.clear()
+        self.gro_pending.clear()
+        self.in_flight = {}
+        self.seq_num = 0
+        self.expected_seq = 0
+        self.srtt = self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.cc = CongestionControl(self.window_size)
+
+    def make_packet(self, seq_num, msg):
+        # Cria um pacote com o cabeçalho binário e a mensagem (o ack leva a base da janela de recepção);
+        # os dois pedaços vão separados pro sendmsg, sem concatenar (a mensagem pode ser uma fatia do mmap)
+        return [HEADER.pack(TYPE_DATA, 0, seq_num, self.expected_seq, len(msg)), msg]
+
+    def send_ack(self, addr, ack_num):
+        HEADER.pack_into(self.ack_buf, 0, TYPE_ACK, 0, 0, ack_num, 0)
+        self.socket.sendto(self.ack_buf, addr)
+        self.metrics.add('rdt_acks_sent_total')
+
+    def handle_packet(self, ptype, seq_num, payload, addr):
+        # pacotes que não são ACK e podem chegar a qualquer momento, inclusive durante um envio
+        if ptype == TYPE_DATA:
+            self.handle_data(seq_num, payload, addr)
+        elif ptype == TYPE_PROBE:
+            #responde a sonda com o tamanho que chegou inteiro (o buffer aceita até MAX_DATAGRAM)
+            HEADER.pack_into(self.ack_buf, 0, TYPE_PROBE_ACK, 0, 0, HEADER_SIZE + len(payload), 0)
+            self.socket.sendto(self.ack_buf, addr)
+
+    def negotiate(self, addr):
+        # descobre o maior datagrama que chega inteiro no outro lado, testando do maior pro menor;
+        # o resultado fica guardado por endereço e vale para as próximas transferências
+        if addr not in self.negotiated:
+            size = self.base_buffer
+            set_dont_fragment(self.socket, True)
+            try:
+                for probe_size in PROBE_SIZES:
+                    if probe_size <= size:
+                        break
+                    if self.probe(addr, probe_size):
+                        size = probe_size
+                        break
+            finally:
+                set_dont_fragment(self.socket, False)
+                self.socket.settimeout(None)
+            log('info', "Tamanho de datagrama negociado com %s: %d bytes", addr, size)
+            self.negotiated[addr] = size
+        self.max_buffer = self.negotiated[addr]
+        return self.max_buffer
+
+    def probe(self, addr, size):
+        packet = HEADER.pack(TYPE_PROBE, 0, 0, 0, size - HEADER_SIZE) + bytes(size - HEADER_SIZE)
+        for _ in range(PROBE_TRIES):
+            try:
+                self.socket.sendto(packet, addr)
+            except OSError:
+                return False # EMSGSIZE: maior que o MTU do caminho, nem adianta esperar
+            deadline = time.monotonic() + PROBE_TIMEOUT
+            while time.monotonic() < deadline:
+                self.socket.settimeout(max(deadline - time.monotonic(), 0.0001))
+                try:
+                    ptype, seq_num, ack_num, payload, recv_addr = self.recv_packet()
+                except skt.timeout:
+                    break
+                if ptype == TYPE_PROBE_ACK and ack_num == size:
+                    return True
+                self.handle_packet(ptype, seq_num, payload, recv_addr)
+        return False # sondas perdidas: tenta um tamanho menor
+
+    def shrink(self, addr):
+        # datagramas grandes continuam se perdendo: os próximos pedaços usam o tamanho menor seguinte
+        smaller = [size for size in PROBE_SIZES if self.base_buffer <= size < self.max_buffer]
+        self.max_buffer = smaller[0] if smaller else self.base_buffer
+        self.negotiated[addr] = self.max_buffer
+        log('aviso', "Perdas seguidas, datagramas para %s caem para %d bytes", addr, self.max_buffer)
+
+    def recv_packet(self):
+        # recebe direto no buffer preallocado e lê o cabeçalho sem copiar o payload
+        if self.gro_pending:
+            return self.parse_packet(*self.gro_pending.popleft())
+        if not self.gro:
+            nbytes, addr = self.socket.recvfrom_into(self.recv_buf)
+            return self.parse_packet(memoryview(self.recv_buf)[:nbytes], addr)
+        nbytes, ancdata, _, addr = self.socket.recvmsg_into([self.recv_buf], GRO_CMSG_SPACE)
+        segment = nbytes
+        for level, ctype, data in ancdata:
+            if level == SOL_UDP and ctype == UDP_GRO:
+                segment = GRO_SIZE.unpack_from(data)[0]
+        view = memoryview(self.recv_buf)
+        if 0 < segment < nbytes:
+            #vários pacotes colados: todos ficam no mesmo buffer, que sai do pool (o GC libera
+            #quando o último deles for entregue) e o próximo datagrama cai num buffer novo
+            self.recv_buf = self.pool.get()
+            for offset in range(segment, nbytes, segment):
+                self.gro_pending.append((view[offset:min(offset + segment, nbytes)], addr))
+            nbytes = segment
+        return self.parse_packet(view[:nbytes], addr)
+
+    def parse_packet(self, view, addr):
+        self.metrics.add('rdt_packets_received_total')
+        if len(view) < HEADER_SIZE:
+            return None, 0, 0, None, addr #pacote mal formado
+        ptype, _, seq_num, ack_num, length = HEADER.unpack_from(view)
+        if HEADER_SIZE + length > len(view):
+            return None, 0, 0, None, addr #pacote truncado
+        return ptype, seq_num, ack_num, view[HEADER_SIZE:HEADER_SIZE + length], addr
+
+    def udt_send(self, addr, seq_num, packet):
+        if HAS_SENDMSG:
+            self.socket.sendmsg(packet, [], 0, addr) #envia cabeçalho + payload num único datagrama
+        else:
+            self.socket.sendto(b''.join(packet), addr)
+        self.metrics.add('rdt_packets_sent_total')
+        log('debug', "Enviado pacote seq_num: %d", seq_num)
+
+    def udt_send_batch(self, addr, batch):
+        # agrupa pacotes seguidos do mesmo tamanho (o último pode ser menor) num único sendmsg
+        # com UDP_SEGMENT; o kernel (ou a placa de rede) corta nos datagramas de cada pacote
+        if not self.gso or len(batch) == 1:
+            for seq_num, packet in batch:
+                self.udt_send(addr, seq_num, packet)
+            return
+        run = []
+        segment = 0
+        for seq_num, packet in batch:
+            size = HEADER_SIZE + len(packet[1])
+            if run and size > segment:
+                self.gso_send(addr, run, segment)
+                run = []
+            if not run:
+                segment = size
+            run.append((seq_num, packet))
+            if size < segment:
+                self.gso_send(addr, run, segment) # pacote menor fecha o grupo
+                run = []
+        if run:
+            self.gso_send(addr, run, segment)
+
+    def gso_send(self, addr, run, segment):
+        buffers = [part for _, packet in run for part in packet]
+        try:
+            if len(run) == 1:
+                self.socket.sendmsg(buffers, [], 0, addr)
+            else:
+                self.socket.sendmsg(buffers, [(SOL_UDP, UDP_SEGMENT, GSO_SIZE.pack(segment))], 0, addr)
+        except OSError:
+            #interface sem suporte (ex.: EIO sem checksum offload): volta pro envio de um em um
+            self.gso = False
+            for seq_num, packet in run:
+                self.socket.sendmsg(packet, [], 0, addr)
+        self.metrics.add('rdt_packets_sent_total', len(run))
+        log('debug', "Enviados pacotes seq_num: %d a %d", run[0][0], run[-1][0])
+
+    def gso_batch(self):
+        # quantos pacotes do tamanho atual cabem num envio segmentado (o total não passa de um datagrama)
+        if not self.gso:
+            return 1
+        return max(1, min(GSO_MAX_SEGMENTS, MAX_DATAGRAM // self.max_buffer))
 
     def send(self, addr, msg):
-         #simula a perda de pacotes com a probabilidade definida na parte de cima do codigo
-        if random.random() < LOSS_PROBABILITY:
-            print(f"Simulando perda de pacote seq_num: {self.seq_num}")
-            return  # Simula a perda do pacote
+        self.send_window(addr, [msg]) # stop-and-wait: espera o ACK e retransmite se precisar
 
-        # Cria um pacote com o numero de sequencia e mensagem
-        packet = f"{self.seq_num}|".encode('utf-8') + msg
-        self.socket.sendto(packet, addr)
-        print(f"Enviado pacote seq_num: {self.seq_num}")
-        self.seq_num = 1 - self.seq_num  # alterna entre 0 e 1
+    def update_rtt(self, sample):
+        # atualiza SRTT/RTTVAR com uma nova medida e recalcula o RTO
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
 
-    def receive(self):
+    def backoff(self, retries):
+        # backoff exponencial por pacote: cada retransmissão dobra o timeout daquele pacote
+        return min(self.rto * 2 ** retries, MAX_RTO)
+
+    def send_window(self, addr, messages):
+        # Selective Repeat: cada pacote em trânsito tem o seu temporizador, e a janela
+        # efetiva é o menor valor entre window_size e a janela de congestionamento
+        messages = iter(messages)
+        in_flight = self.in_flight = {} # seq_num -> [pacote, último envio, retransmissões, ACKs de pacotes posteriores, prazo], em ordem de envio
+        exhausted = False
+        try:
+            while True:
+                # preenche a janela enquanto houver espaço, mensagens e o pacer liberar; com GSO
+                # o pacer libera um lote de pacotes de uma vez e cobra o tempo de todos eles
+                now = time.monotonic()
+                base = next(iter(in_flight), self.seq_num) # pacote mais antigo sem ACK
+                batch = []
+                batch_size = self.gso_batch()
+                while (not exhausted and (self.seq_num - base) % SEQ_SPACE < self.cc.window()
+                       and (batch or self.cc.pacing_delay(now) == 0) and len(batch) < batch_size):
+                    msg = next(messages, None)
+                    if msg is None:
+                        exhausted = True
+                        break
+                    packet = self.make_packet(self.seq_num, msg)
+                    batch.append((self.seq_num, packet))
+                    in_flight[self.seq_num] = [packet, now, 0, 0, now + self.rto]
+                    self.cc.on_send(now, self.srtt)
+                    self.seq_num = (self.seq_num + 1) % SEQ_SPACE
+                if batch:
+                    self.udt_send_batch(addr, batch)
+                if exhausted and not in_flight:
+                    break # tudo enviado e confirmado
+
+                # espera um ACK até o temporizador mais antigo estourar ou o pacer liberar outro envio
+                # (o prazo de cada pacote fica guardado nele: com a janela cheia de lotes GSO,
+                # recalcular o backoff de todos a cada ACK custava mais que o próprio envio)
+                deadline = min(entry[4] for entry in in_flight.values()) if in_flight else now + MAX_RTO
+                wait = deadline - now
+                if not exhausted and (self.seq_num - base) % SEQ_SPACE < self.cc.window():
+                    wait = min(wait, self.cc.pacing_delay(now))
+                self.socket.settimeout(max(wait, 0.0001))
+                try:
+                    ptype, seq_num, ack_num, payload, recv_addr = self.recv_packet()
+                    if ptype == TYPE_ACK:
+                        self.handle_ack(addr, in_flight, ack_num)
+                    else:
+                        self.handle_packet(ptype, seq_num, payload, recv_addr) # dados do outro lado (ex.: retransmissão)
+                except skt.timeout:
+                    self.metrics.add('rdt_timeouts_total')
+
+                # retransmite apenas os pacotes cujo temporizador estourou
+                now = time.monotonic()
+                expired = []
+                if now >= deadline:
+                    expired = [(seq_num, entry) for seq_num, entry in in_flight.items() if now >= entry[4]]
+                if expired:
+                    self.cc.on_loss(now, self.srtt, timeout=True)
+                for seq_num, entry in expired:
+                    if entry[2] >= MAX_RETRIES:
+                        raise TimeoutError(f"Sem ACK de {addr} para o pacote seq_num: {seq_num}")
+                    if entry[2] + 1 == SHRINK_RETRIES and HEADER_SIZE + len(entry[0][1]) > self.base_buffer:
+                        self.shrink(addr)
+                    log('debug', "Timeout, retransmitindo pacote seq_num: %d (RTO %.3fs)", seq_num, self.backoff(entry[2] + 1))
+                    self.metrics.add('rdt_retransmissions_total{reason="timeout"}')
+                    self.udt_send(addr, seq_num, entry[0])
+                    entry[1] = now
+                    entry[2] += 1
+                    entry[4] = now + self.backoff(entry[2])
+        finally:
+            self.socket.settimeout(None) # volta a bloquear no receive
+
+    def handle_ack(self, addr, in_flight, ack_num):
+        self.metrics.add('rdt_acks_received_total')
+        if ack_num not in in_flight:
+            self.metrics.add('rdt_duplicate_acks_total')
+            return # ACK duplicado ou atrasado
+        now = time.monotonic()
+        # cada ACK de um pacote posterior conta contra os mais antigos que ainda esperam ACK;
+        # com DUP_ACK_THRESHOLD deles (menos, se a janela for pequena demais para isso, como no
+        # early retransmit da RFC 5827) o pacote é dado como perdido sem esperar o RTO
+        threshold = max(min(DUP_ACK_THRESHOLD, len(in_flight) - 1), 1)
+        for seq_num, entry in in_flight.items():
+            if seq_num == ack_num:
+                break
+            entry[3] += 1
+            if entry[3] >= threshold and entry[2] == 0: # retransmissão rápida só uma vez por pacote
+                log('debug', "Retransmissão rápida do pacote seq_num: %d", seq_num)
+                self.metrics.add('rdt_retransmissions_total{reason="fast"}')
+                self.udt_send(addr, seq_num, entry[0])
+                entry[1] = now
+                entry[2] += 1
+                entry[4] = now + self.backoff(entry[2])
+                self.cc.on_loss(now, self.srtt, timeout=False)
+        entry = in_flight.pop(ack_num) # ACK individual, só libera esse pacote
+        if entry[2] == 0:
+            # regra de Karn: só mede RTT de pacotes que não foram retransmitidos
+            self.update_rtt(now - entry[1])
+            self.metrics.observe('rdt_rtt_seconds', now - entry[1])
+        self.cc.on_ack()
+
+    def handle_data(self, seq_num, payload, addr):
+        offset = (seq_num - self.expected_seq) % SEQ_SPACE
+        if offset < self.window_size:
+            #dentro da janela de recepção: confirma e guarda no buffer (ignora duplicatas)
+            self.send_ack(addr, seq_num)
+            log('debug', "Recebido e confirmado pacote seq_num: %d", seq_num)
+            if seq_num in self.recv_buffer:
+                self.metrics.add('rdt_duplicates_total')
+            elif payload.obj is not self.recv_buf:
+                self.recv_buffer[seq_num] = (payload, addr, None) #veio de uma leitura GRO, o buffer já saiu do pool
+            else:
+                #o buffer fica com o pacote até ele ser entregue; o próximo datagrama cai em outro do pool
+                self.recv_buffer[seq_num] = (payload, addr, self.recv_buf)
+                self.recv_buf = self.pool.get()
+        elif offset >= SEQ_SPACE - self.window_size:
+            #pacote já entregue cujo ACK se perdeu: confirma de novo
+            self.send_ack(addr, seq_num)
+            self.metrics.add('rdt_duplicates_total')
+
+    def receive_view(self):
+        # como o receive, mas a mensagem é entregue como uma visão do buffer onde o datagrama
+        # caiu, sem cópia (válida só até a próxima chamada)
+        if self.lent_buf is not None:
+            self.pool.put(self.lent_buf) #o consumidor já terminou com o buffer da chamada anterior
+            self.lent_buf = None
         while True:
-            data, addr = self.socket.recvfrom(self.max_buffer) #recebe os dados
-            if b'|' not in data:
-                continue #ignora os pacotes que foram mal formados
-            header, msg = data.split(b'|', 1) #separa o cabeçalho da mensagem em si
-            recv_seq_num = int(header.decode('utf-8')) #decodifica a sequencia
-            if recv_seq_num == self.seq_num:
-                #envia o ACK confirmando o recebimento
-                self.socket.sendto(f"ACK{recv_seq_num}".encode('utf-8'), addr)
-                print(f"Recebido e confirmado pacote seq_num: {recv_seq_num}")
-                self.seq_num = 1 - self.seq_num #alterna o num de seq
-                return msg, addr # retorna a mensagem e o endereço pro servidor
+            #entrega o próximo pacote em ordem assim que ele estiver no buffer
+            if self.expected_seq in self.recv_buffer:
+                msg, addr, self.lent_buf = self.recv_buffer.pop(self.expected_seq)
+                self.expected_seq = (self.expected_seq + 1) % SEQ_SPACE
+                return msg, addr
+            ptype, seq_num, _, payload, addr = self.recv_packet() #recebe os dados
+            if ptype != TYPE_DATA:
+                self.handle_packet(ptype, seq_num, payload, addr) #sondas; ACKs atrasados e pacotes mal formados são ignorados
+                continue
+            if seq_num == self.expected_seq:
+                self.send_ack(addr, seq_num)
+                log('debug', "Recebido e confirmado pacote seq_num: %d", seq_num)
+                self.expected_seq = (self.expected_seq + 1) % SEQ_SPACE
+                return payload, addr
+            self.handle_data(seq_num, payload, addr)
 
-    # Envia um arquivo 
-    def send_file(self, addr, filepath):
-        filename = os.path.basename(filepath) #recebe o nome do arquivo
-        self.send(addr, filename.encode('utf-8')) #envia o nme do arquivo
+    def receive(self):
+        msg, addr = self.receive_view()
+        return bytes(msg), addr # retorna a mensagem e o endereço pro servidor
 
-        #Abre o arquivo em leitura binária
+    def read_chunks(self, filepath):
+        #mapeia o arquivo na memória: cada pedaço é uma fatia (memoryview) do mapa, sem cópia.
+        #o mapa é desfeito sozinho quando a última fatia deixa de existir (inclusive as retransmissões)
         with open(filepath, 'rb') as f:
-            while True:
-                data = f.read(self.max_buffer - 2) #le o arquivo de 1024 em 1024 bytes
-                if not data:
-                    break #termina se n ouver dados
-                self.send(addr, data) #envia oq foi lido
-                time.sleep(0.1)  # tempo para evitar congestionamento
+            size = os.fstat(f.fileno()).st_size
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if size else memoryview(b'')
+        offset = 0
+        while offset < size:
+            chunk = self.max_buffer - HEADER_SIZE #pedaços que cabem no datagrama negociado (pode cair no meio)
+            yield view[offset:offset + chunk]
+            offset += chunk
+        yield b'EOF' #avisa que chegou ao fim do arquivo
 
-        self.send(addr, b'EOF') #avisa que chegou ao fim do arquivo
+    # Envia um arquivo 
+    def send_file(self, addr, filepath):
+        filename = os.path.basename(filepath) #recebe o nome do arquivo
+        self.negotiate(addr) #descobre o maior datagrama que o caminho aguenta antes de começar
+        #o nome e os pedaços do arquivo vão pela mesma janela, sem esperar ACK a cada pacote
+        self.send_window(addr, itertools.chain([filename.encode('utf-8')], self.read_chunks(filepath)))
+        self.metrics.add('rdt_files_sent_total')
+        if METRICS_FILE:
+            write_metrics(METRICS_FILE, self.metrics.snapshot())
 
 #recebe um arquivo e muda o nome especificado
     def receive_file(self, save_as):
-        with open(save_as, 'wb') as f: #abre um arquivo
+        fd = os.open(save_as, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644) #abre um arquivo
+        offset = 0 #quanto já foi escrito
+        allocated = 0 #quanto já foi pré-alocado
+        try:
             while True:
-                data, _ = self.receive() #recebe os dados
+                data, _ = self.receive_view() #recebe os dados sem copiar do buffer de recepção
                 if data == b'EOF':
-                    print("Recepção do arquivo concluída.")
+                    log('info', "Recepção do arquivo concluída.")
                     break #termina ao chegar no fim do arquivo
-                f.write(data) # escreve os dados no arquivo
+                if offset + len(data) > allocated:
+                    allocated += PREALLOC_STEP
+                    preallocate(fd, allocated)
+                offset += pwrite(fd, data, offset) # escreve os dados direto do buffer no arquivo
+        finally:
+            os.ftruncate(fd, offset) #devolve o que sobrou da pré-alocação
+            os.close(fd)
+        self.metrics.add('rdt_files_received_total')
+        if METRICS_FILE:
+            write_metrics(METRICS_FILE, self.metrics.snapshot())
 
 
 class Cliente:
@@ -79,7 +585,7 @@ class Cliente:
         self.rdt.send_file(server_addr, filepath) #envia o arquivo pro servidor
 
     def receive_file(self):
-        data, _ = self.sckt.recvfrom(MAX_BUFFER) #recebe o nome do arquivo
+        data, _ = self.rdt.receive() #recebe o nome do arquivo (primeiro pacote da janela)
         new_filename = data.decode('utf-8') #traduz o nome do arquivo
         print(f"Recebendo o arquivo: {new_filename}")
         self.rdt.receive_file(new_filename) # recebe o arquivo renomeado
@@ -87,12 +593,17 @@ class Cliente:
 
 def main_cliente():
     client = Cliente(skt.AF_INET, skt.SOCK_DGRAM, ADDR_BIND, MAX_BUFFER) #cria uma instancia do cliente
+    if METRICS_FILE:
+        client.rdt.metrics.dump_every(METRICS_FILE, METRICS_EVERY)
     filename = input("Digite o nome do arquivo a ser enviado: ")
     if not os.path.isfile(filename):
         print(f"File {filename} does not exist.") #verifica se o arquivo existe 
         return
-    client.send_file(ADDR_TARGET, filename) #envia o arquivo pro servidor
-    client.receive_file() #recebe o arquivo de volta do servidor
+    try:
+        client.send_file(ADDR_TARGET, filename) #envia o arquivo pro servidor
+        client.receive_file() #recebe o arquivo de volta do servidor
+    except TimeoutError as e:
+        print(f"Falha na transferência: {e}") #o servidor parou de confirmar os pacotes
 
 
 if __name__ == "__main__":
@@ -2,44 +2,312 @@ import socket as skt
 import time  
 import threading  
 import random  
+import struct
+import collections
+import itertools
+import concurrent.futures
+import codecs
+import datetime
 
 
 MAX_BUFFER = 1024  # Define o tamanho máximo dos dados que podem ser recebidos pelo socket
 ADDR_BIND = ('localhost', 0)  # Define o endereço e a porta onde o cliente se vinculará
 ADDR_TARGET = ('127.0.0.1', 7070)  # Define o endereço e a porta do servidor de destino
 
-LOSS_PROBABILITY = 0  # Define a probabilidade de perda de pacotes (0 = sem perda)
+# Cabeçalho binário de tamanho fixo: tipo, flags, número de sequência, ack e tamanho do payload
+HEADER = struct.Struct('!BBHHH')
+TYPE_DATA = 0  # Pacote com dados (o campo ack leva o ID da sessão do cliente)
+TYPE_ACK = 1  # Confirmação de um pacote (o número vai no campo ack e o ID da sessão no seq)
+TYPE_PROBE = 2  # Sonda de tamanho de datagrama, o payload é só enchimento (o seq leva o ID da sessão)
+TYPE_PROBE_ACK = 3  # Resposta da sonda (o campo ack leva o tamanho do datagrama que chegou)
+FLAG_MORE = 0x01  # Nas flags de um DATA: a mensagem continua no próximo pacote (fragmentação)
+REQUEST_TAG = b'#'  # Prefixo do ID de cada pedido ("#<id> <comando>"), repetido pelo servidor na resposta
+
+# Comandos em binário: BINARY_MARK, opcode, ID do pedido e os campos do esquema do opcode (mesmo
+# formato do servidor). s = palavra, t = texto até o fim, d = dia no calendário, n = número opcional,
+# v = versão do catálogo
+BINARY_MARK = 0x00  # Primeiro byte de um comando binário
+COMMAND_HEADER = struct.Struct('!BBI')
+FIELDS = {'s': struct.Struct('!B'), 't': struct.Struct('!H'), 'd': struct.Struct('!h'), 'n': struct.Struct('!H'), 'v': struct.Struct('!I')}
+OP_LOGIN, OP_LOGOUT, OP_CREATE, OP_LIST_MYACMD, OP_LIST_ACMD, OP_LIST_MYRSV, OP_BOOK, OP_CANCEL, OP_SEARCH, OP_LIST_SINCE, OP_STATS = range(1, 12)
+COMMANDS = {  # opcode -> (nome em texto, esquema dos campos)
+    OP_LOGIN: ('login', 's'),
+    OP_LOGOUT: ('logout', ''),
+    OP_CREATE: ('create', 'sst'),
+    OP_LIST_MYACMD: ('list:myacmd', 'nn'),
+    OP_LIST_ACMD: ('list:acmd', 'nn'),
+    OP_LIST_MYRSV: ('list:myrsv', 'nn'),
+    OP_BOOK: ('book', 'sssd'),
+    OP_CANCEL: ('cancel', 'sssd'),
+    OP_SEARCH: ('search', 'sdd'),
+    OP_LIST_SINCE: ('list:since', 'v'),
+    OP_STATS: ('stats', ''),
+}
+DATE_FORMAT = '%d/%m/%Y'  # Formato dos dias nos comandos
+CALENDAR_START = datetime.date(2024, 7, 17)  # Dia 0 do calendário do servidor
+
+MAX_DATAGRAM = 65507  # Maior datagrama UDP sobre IPv4; o buffer de recepção aceita até isso
+PROBE_SIZES = (65507, 32768, 16384, 8972, 1472)  # Tamanhos testados na negociação, do maior pro menor
+PROBE_TIMEOUT = 0.2  # Espera pela resposta de cada sonda (segundos)
+PROBE_TRIES = 2  # Sondas perdidas antes de desistir de um tamanho
+
+SEQ_SPACE = 2 ** 16  # Espaço dos números de sequência, separado em cada sentido
+WINDOW_SIZE = 128  # Pacotes sem ACK em trânsito (e fora de ordem guardados) em cada sentido
+RTO = 0.5  # Tempo de espera pelo ACK antes da primeira medida de RTT (dobra a cada tentativa)
+MIN_RTO = 0.05  # Limites do tempo de espera calculado com SRTT/RTTVAR (segundos)
+MAX_RTO = 2.0  # Também é o teto da espera dobrada
+BACKOFF_LIMIT = 8  # A espera dobra a cada retransmissão até BACKOFF_LIMIT vezes o RTO (com perda aleatória, esperar mais só atrasa)
+DEAD_AFTER = 15.0  # Segundos sem ACK de um pacote até dar a sessão como morta (o mesmo limite do servidor)
+DUP_ACK_THRESHOLD = 3  # ACKs de pacotes posteriores que indicam perda (retransmissão rápida)
+SHRINK_RETRIES = 3  # Retransmissões por prazo de um datagrama maior que MAX_BUFFER que fazem o tamanho negociado cair pela metade
+
+
+def encode_command(opcode, request_id, *args):
+    # Monta um comando binário; os dias vão como "DD/MM/AAAA" e viram a posição no calendário
+    parts = [COMMAND_HEADER.pack(BINARY_MARK, opcode, request_id)]
+    for kind, value in zip(COMMANDS[opcode][1], args):
+        if kind == 'd':
+            value = datetime.datetime.strptime(value, DATE_FORMAT).date().toordinal() - CALENDAR_START.toordinal()
+        elif kind in 'st':
+            data = value.encode('utf-8')
+            parts.append(FIELDS[kind].pack(len(data)))
+            parts.append(data)
+            continue
+        parts.append(FIELDS[kind].pack(int(value)))
+    return b''.join(parts)
+
+
+def set_dont_fragment(sckt, on):
+    # Liga o "não fragmentar" para o SO recusar na hora (EMSGSIZE) o que passa do MTU do caminho;
+    # só existe no Linux, nos outros SOs uma sonda grande demais simplesmente se perde
+    if not hasattr(skt, 'IP_MTU_DISCOVER'):
+        return
+    mode = getattr(skt, 'IP_PMTUDISC_DO', 2) if on else getattr(skt, 'IP_PMTUDISC_DONT', 0)
+    try:
+        sckt.setsockopt(skt.IPPROTO_IP, skt.IP_MTU_DISCOVER, mode)
+    except OSError:
+        pass
 
 # Classe RDT 3.0 (Feita nas etapas anteriores) para gerenciar a transferência confiável de dados
 class RDT:
     def __init__(self, socket, max_buffer):
         self.socket = socket  # Armazena o socket para comunicação
         self.max_buffer = max_buffer  # Armazena o tamanho máximo do buffer
-        self.seq_num = 0  # Inicializa o número de sequência
+        # Cada sentido tem a sua sequência: o que o cliente envia não mexe no que ele espera receber
+        self.session_id = random.randrange(1, SEQ_SPACE)  # Identifica esta execução do cliente para o servidor
+        self.send_seq = 0  # Próximo número de sequência a ser enviado
+        self.recv_seq = 0  # Próximo número de sequência esperado do servidor
+        self.in_flight = {}  # seq_num -> [pacote, endereço, prazo, retransmissões, ACKs de pacotes posteriores, envio] esperando ACK
+        self.srtt = None  # RTT suavizado (None até a primeira medida)
+        self.rttvar = 0.0  # Variação do RTT
+        self.rto = RTO  # Tempo de espera pelo ACK, recalculado a cada medida
+        self.backlog = collections.deque()  # (endereço, flags, fragmento) esperando espaço na janela
+        self.recv_buffer = {}  # seq_num -> (fragmento, endereço, último) que chegou fora de ordem
+        self.negotiated = {}  # Endereço -> maior datagrama que chega inteiro naquele par
+        self.recv_buf = bytearray(MAX_DATAGRAM)  # Buffer pré-alocado reaproveitado a cada recvfrom_into
+        self.recv_view = memoryview(self.recv_buf)
+        self.ack_buf = bytearray(HEADER.size)  # Buffer onde os ACKs são montados
+        self.recv_lock = threading.Lock()  # Só uma thread por vez usa o buffer de recepção
+        self.send_lock = threading.Lock()  # A thread principal envia e a que recebe trata os ACKs
+        self.on_reset = None  # Chamado quando a sessão morre e começa outra (o que estava pendente se perdeu)
 
     def send(self, addr, msg):
-        # Simula a perda de pacotes com a probabilidade definida
-        if random.random() < LOSS_PROBABILITY:
-            
-            return  # Simula a perda do pacote
+        # Não bloqueia: quem estiver no receive trata o ACK e retransmite se ele não chegar.
+        # Mensagens maiores que o datagrama negociado vão em fragmentos seguidos, todos menos o
+        # último com FLAG_MORE (o lock garante que os fragmentos de duas mensagens não se misturam)
+        size = self.negotiated.get(addr, self.max_buffer) - HEADER.size
+        view = memoryview(msg)
+        with self.send_lock:
+            for offset in range(0, max(len(msg), 1), size):
+                flags = FLAG_MORE if offset + size < len(msg) else 0
+                if self.window_full():
+                    self.backlog.append((addr, flags, view[offset:offset + size]))  # Janela cheia: sai quando chegar um ACK
+                else:
+                    self.transmit(addr, flags, view[offset:offset + size])
 
-        # Cria um pacote com o número de sequência e a mensagem
-        packet = f"{self.seq_num}|".encode('utf-8') + msg
+    def transmit(self, addr, flags, fragment):
+        # Cria um pacote com o cabeçalho binário e o fragmento
+        packet = HEADER.pack(TYPE_DATA, flags, self.send_seq, self.session_id, len(fragment)) + fragment
+        now = time.monotonic()
+        self.in_flight[self.send_seq] = [packet, addr, now + self.rto, 0, 0, now]
+        self.send_seq = (self.send_seq + 1) % SEQ_SPACE
+        self.udt_send(addr, packet)
+
+    def udt_send(self, addr, packet):
         self.socket.sendto(packet, addr)  # Envia o pacote para o endereço especificado
-        self.seq_num = 1 - self.seq_num  # Alterna o número de sequência entre 0 e 1
+
+    def window_full(self):
+        # A janela vai do pacote mais antigo sem ACK (o primeiro do dict, que segue a ordem de envio)
+        # até WINDOW_SIZE depois dele; contar só os pendentes deixaria passar do que o outro lado aceita
+        return bool(self.in_flight) and (self.send_seq - next(iter(self.in_flight))) % SEQ_SPACE >= WINDOW_SIZE
+
+    def handle_ack(self, ack_num):
+        with self.send_lock:
+            if ack_num not in self.in_flight:
+                return  # ACK duplicado
+            # Cada ACK de um pacote posterior conta contra os mais antigos que ainda esperam ACK; com
+            # DUP_ACK_THRESHOLD deles o pacote é dado como perdido sem esperar o prazo (uma vez por pacote)
+            now = time.monotonic()
+            for seq_num, entry in self.in_flight.items():
+                if seq_num == ack_num:
+                    break
+                entry[4] += 1
+                if entry[4] == DUP_ACK_THRESHOLD and not entry[3]:
+                    entry[3] = 1
+                    entry[2] = now + min(self.rto * 2, MAX_RTO)
+                    self.udt_send(entry[1], entry[0])
+            entry = self.in_flight.pop(ack_num)
+            if not entry[3]:
+                self.update_rtt(now - entry[5])  # Regra de Karn: só mede pacotes que não foram retransmitidos
+            while self.backlog and not self.window_full():
+                self.transmit(*self.backlog.popleft())
+
+    def update_rtt(self, sample):
+        # Atualiza SRTT/RTTVAR com uma nova medida e recalcula o tempo de espera
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def retransmit_expired(self):
+        # Retransmite o que passou do prazo e devolve quanto esperar até o próximo prazo. Depois de
+        # DEAD_AFTER sem ACK o servidor também já desistiu desta sessão: começa outra
+        now = time.monotonic()
+        wait = RTO  # Mesmo sem nada em trânsito acorda de vez em quando: um envio pode chegar a qualquer hora
+        dead = False
+        with self.send_lock:
+            for seq_num, entry in self.in_flight.items():
+                if now >= entry[2]:
+                    if now - entry[5] >= DEAD_AFTER:
+                        dead = True
+                        break
+                    entry[3] += 1
+                    entry[2] = now + min(self.rto * min(2 ** entry[3], BACKOFF_LIMIT), MAX_RTO)
+                    if entry[3] == SHRINK_RETRIES and self.max_buffer < len(entry[0]) <= self.negotiated.get(entry[1], self.max_buffer):
+                        self.shrink(entry[1])
+                    self.udt_send(entry[1], entry[0])
+                wait = min(wait, entry[2] - now)
+            if dead:
+                self.reset_session()
+        if dead:
+            print(f"Servidor não responde: pedidos pendentes descartados, nova sessão {self.session_id}")
+            if self.on_reset is not None:
+                self.on_reset()  # Fora do send_lock: quem é avisado pode enviar de novo
+            return RTO
+        return max(wait, 0.001)
+
+    def shrink(self, addr):
+        # Um datagrama do tamanho negociado continua sem ACK (o caminho mudou ou perde os grandes): o
+        # tamanho cai pela metade, até max_buffer, para os próximos fragmentos e para os do backlog, que
+        # são recortados (chamado com o send_lock); o que já saiu numerado continua do tamanho que tinha
+        size = max(self.negotiated[addr] // 2, self.max_buffer)
+        self.negotiated[addr] = size
+        step = size - HEADER.size
+        backlog = collections.deque()
+        for backlog_addr, flags, fragment in self.backlog:
+            if backlog_addr != addr:
+                backlog.append((backlog_addr, flags, fragment))
+                continue
+            for offset in range(0, max(len(fragment), 1), step):
+                backlog.append((addr, FLAG_MORE if offset + step < len(fragment) else flags, fragment[offset:offset + step]))
+        self.backlog = backlog
+
+    def reset_session(self):
+        # Sessão nova, com outro ID: o servidor vê o ID diferente e também recomeça as duas sequências
+        old = self.session_id
+        while self.session_id == old:
+            self.session_id = random.randrange(1, SEQ_SPACE)
+        self.send_seq = 0
+        self.recv_seq = 0
+        self.in_flight.clear()
+        self.backlog.clear()
+        self.recv_buffer.clear()
+
+    def negotiate(self, addr):
+        # Descobre o maior datagrama que chega inteiro no outro lado, testando do maior pro menor;
+        # chamado antes de existir outra thread lendo o socket (as respostas chegam por aqui)
+        size = self.max_buffer
+        set_dont_fragment(self.socket, True)
+        try:
+            with self.recv_lock:
+                for probe_size in PROBE_SIZES:
+                    if probe_size <= size:
+                        break
+                    if self.probe(addr, probe_size):
+                        size = probe_size
+                        break
+        finally:
+            set_dont_fragment(self.socket, False)
+            self.socket.settimeout(None)
+        self.negotiated[addr] = size
+        return size
+
+    def probe(self, addr, size):
+        packet = HEADER.pack(TYPE_PROBE, 0, self.session_id, 0, size - HEADER.size) + bytes(size - HEADER.size)
+        self.socket.settimeout(PROBE_TIMEOUT)
+        for _ in range(PROBE_TRIES):
+            try:
+                self.socket.sendto(packet, addr)
+            except OSError:
+                return False  # EMSGSIZE: maior que o MTU do caminho, nem adianta esperar
+            try:
+                while True:
+                    nbytes, _ = self.socket.recvfrom_into(self.recv_buf)
+                    if nbytes >= HEADER.size:
+                        ptype, _, _, ack_num, _ = HEADER.unpack_from(self.recv_buf)
+                        if ptype == TYPE_PROBE_ACK and ack_num == size:
+                            return True
+            except skt.timeout:
+                continue
+        return False  # Sondas perdidas: tenta um tamanho menor
 
     def receive(self):
+        # Junta os fragmentos de uma mensagem e devolve ela inteira
+        fragments = []
+        while True:
+            fragment, addr, last = self.receive_fragment()
+            fragments.append(fragment)
+            if last:
+                return b''.join(fragments), addr  # Retorna a mensagem e o endereço
+
+    def receive_fragment(self):
+        # Devolve o próximo fragmento em ordem assim que ele chega (entrega em streaming),
+        # com o endereço e se ele é o último da mensagem
         while True:
-            data, addr = self.socket.recvfrom(self.max_buffer)  # Recebe dados do socket
-            if b'|' not in data:
-                continue  # Ignora pacotes malformados
-            header, msg = data.split(b'|', 1)  # Separa o cabeçalho da mensagem
-            recv_seq_num = int(header.decode('utf-8'))  # Decodifica o número de sequência
-            if recv_seq_num == self.seq_num:
-                # Envia um ACK confirmando o recebimento
-                self.socket.sendto(f"ACK{recv_seq_num}".encode('utf-8'), addr)
-                self.seq_num = 1 - self.seq_num  # Alterna o número de sequência
-                return msg, addr  # Retorna a mensagem e o endereço
+            with self.recv_lock:
+                if self.recv_seq in self.recv_buffer:
+                    # Entrega em ordem o que já tinha chegado fora de ordem
+                    fragment = self.recv_buffer.pop(self.recv_seq)
+                    self.recv_seq = (self.recv_seq + 1) % SEQ_SPACE
+                    return fragment
+                self.socket.settimeout(self.retransmit_expired())
+                try:
+                    nbytes, addr = self.socket.recvfrom_into(self.recv_buf)  # Recebe direto no buffer pré-alocado
+                except skt.timeout:
+                    continue
+                if nbytes < HEADER.size:
+                    continue  # Ignora pacotes malformados
+                ptype, flags, recv_seq_num, ack_num, length = HEADER.unpack_from(self.recv_buf)  # Lê o cabeçalho sem copiar
+                if ptype == TYPE_ACK and recv_seq_num == self.session_id:
+                    self.handle_ack(ack_num)
+                    continue
+                if ptype != TYPE_DATA or HEADER.size + length > nbytes or ack_num != self.session_id:
+                    continue  # Ignora pacotes truncados e de uma execução anterior deste cliente
+                offset = (recv_seq_num - self.recv_seq) % SEQ_SPACE
+                if offset >= WINDOW_SIZE and offset < SEQ_SPACE - WINDOW_SIZE:
+                    continue  # Fora da janela: nem confirma
+                # Envia um ACK confirmando o recebimento (de novo, se for uma retransmissão já entregue)
+                HEADER.pack_into(self.ack_buf, 0, TYPE_ACK, 0, self.session_id, recv_seq_num, 0)
+                self.socket.sendto(self.ack_buf, addr)
+                fragment = (bytes(self.recv_view[HEADER.size:HEADER.size + length]), addr, not flags & FLAG_MORE)
+                if offset == 0:
+                    self.recv_seq = (self.recv_seq + 1) % SEQ_SPACE
+                    return fragment
+                if offset < WINDOW_SIZE and recv_seq_num not in self.recv_buffer:
+                    self.recv_buffer[recv_seq_num] = fragment
 
 # Classe Cliente para gerenciar as operações do cliente
 class Cliente:
@@ -47,38 +315,145 @@ class Cliente:
         self.sckt = skt.socket(sckt_family, sckt_type)  # Cria o socket
         self.sckt.bind(sckt_binding)  # Vincula o socket ao endereço fornecido
         self.rdt = RDT(self.sckt, max_buffer)  # Instancia a classe RDT
+        self.rdt.on_reset = self.fail_pending  # Sessão perdida: as respostas pendentes não chegam mais
         self.server_addr = ADDR_TARGET  # Define o endereço do servidor
         self.running = True  # Flag para controle de execução
+        self.echo = True  # Imprime as mensagens do servidor (um script pode desligar e usar só os futuros)
+        self.pending = {}  # ID do pedido -> Future esperando a resposta
+        self.request_ids = itertools.count(1)  # IDs dos pedidos, escolhidos pelo cliente
+        self.pending_lock = threading.Lock()  # Protege os IDs e os pendentes entre threads
+        # Cópia local do catálogo ("nome em local" -> linha), atualizada pelas diferenças do list:since
+        self.catalogue = {}
+        self.catalogue_version = 0  # Versão do catálogo que a cópia local reflete
+        self.catalogue_lock = threading.Lock()
+
+    def new_request(self):
+        # Reserva um ID novo e o Future que vai receber o texto da resposta
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+        return request_id, future
+
+    def fail_pending(self):
+        # Acorda quem espera uma resposta que não vai chegar (a sessão com o servidor morreu)
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Servidor não respondeu; a sessão foi reiniciada"))
+
+    def request(self, command):
+        # Envia um comando em texto com um ID novo e devolve na hora um Future com a resposta;
+        # vários pedidos podem estar pendentes ao mesmo tempo, o listener casa cada resposta pelo ID
+        request_id, future = self.new_request()
+        self.rdt.send(self.server_addr, REQUEST_TAG + f"{request_id} {command}".encode('utf-8'))
+        return future
+
+    def call(self, opcode, *args):
+        # Igual ao request, mas com o comando em binário (menor e sem parsing de texto no servidor)
+        request_id, future = self.new_request()
+        self.rdt.send(self.server_addr, encode_command(opcode, request_id, *args))
+        return future
 
     def login(self, username):
-        self.rdt.send(self.server_addr, f"login {username}".encode('utf-8'))  # Envia comando de login
+        return self.call(OP_LOGIN, username)  # Envia comando de login
 
     def logout(self):
-        self.rdt.send(self.server_addr, b"logout")  # Envia comando de logout
+        return self.call(OP_LOGOUT)  # Envia comando de logout
 
     def create_accommodation(self, name, location, description):
-        self.rdt.send(self.server_addr, f"create {name} {location} {description}".encode('utf-8'))  # Envia comando para criar acomodação
+        return self.call(OP_CREATE, name, location, description)  # Envia comando para criar acomodação
+
+    def list_my_accommodations(self, offset=0, limit=0):
+        return self.call(OP_LIST_MYACMD, offset, limit)  # Envia comando para listar acomodações do usuário (limite 0 = tudo)
+
+    def list_accommodations(self, offset=0, limit=0):
+        if not limit:
+            return self.list_cached()  # O catálogo inteiro sai da cópia local, pedindo só o que mudou
+        return self.call(OP_LIST_ACMD, offset, limit)  # Envia comando para listar todas as acomodações (limite 0 = tudo)
+
+    def list_cached(self):
+        # Pede as acomodações que mudaram desde a versão da cópia local, aplica na cópia e resolve o
+        # Future devolvido com o catálogo inteiro; sem mudanças a resposta do servidor é uma linha
+        result = concurrent.futures.Future()
 
-    def list_my_accommodations(self):
-        self.rdt.send(self.server_addr, b"list:myacmd")  # Envia comando para listar acomodações do usuário
+        def apply(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+            reply = future.result()
+            header, *lines = reply.split('\n')
+            if not header.startswith('versao '):
+                # Resposta sem a versão (erro de um shard, ou a vazia de um pedido que falhou no servidor):
+                # a cópia local fica como está e quem chamou recebe a resposta do jeito que veio
+                result.set_result(reply)
+                return
+            try:
+                _, version, *complete = header.split()
+                version = int(version)
+            except ValueError:
+                result.set_exception(ValueError(f"Cabeçalho inválido na resposta do list:since: {header!r}"))
+                return
+            with self.catalogue_lock:
+                if complete:
+                    self.catalogue.clear()  # O servidor reiniciou: a cópia local não vale mais
+                if complete or version > self.catalogue_version:
+                    for line in lines:
+                        self.catalogue[line.split(': ', 1)[0]] = line  # Mudou: troca a linha no mesmo lugar
+                    self.catalogue_version = version
+                result.set_result('\n'.join(self.catalogue.values()))
 
-    def list_accommodations(self):
-        self.rdt.send(self.server_addr, b"list:acmd")  # Envia comando para listar todas as acomodações
+        self.call(OP_LIST_SINCE, self.catalogue_version).add_done_callback(apply)
+        return result
 
-    def list_my_reservations(self):
-        self.rdt.send(self.server_addr, b"list:myrsv")  # Envia comando para listar as reservas do usuário
+    def list_my_reservations(self, offset=0, limit=0):
+        return self.call(OP_LIST_MYRSV, offset, limit)  # Envia comando para listar as reservas do usuário (limite 0 = tudo)
 
     def book_accommodation(self, owner, name, location, day):
-        self.rdt.send(self.server_addr, f"book {owner} {name} {location} {day}".encode('utf-8'))  # Envia comando para reservar uma acomodação
+        return self.call(OP_BOOK, owner, name, location, day)  # Envia comando para reservar uma acomodação
 
     def cancel_reservation(self, owner, name, location, day):
-        self.rdt.send(self.server_addr, f"cancel {owner} {name} {location} {day}".encode('utf-8'))  # Envia comando para cancelar uma reserva
-        msg, _ = self.rdt.receive()  # Recebe a resposta do servidor
+        return self.call(OP_CANCEL, owner, name, location, day)  # Envia comando para cancelar uma reserva (a resposta chega pelo Future)
+
+    def search_accommodations(self, location, start, end):
+        return self.call(OP_SEARCH, location, start, end)  # Envia comando para buscar acomodações livres
+
+    def stats(self):
+        return self.call(OP_STATS)  # Pede as métricas do servidor (texto do Prometheus)
+
+    def match(self, fragment):
+        # Separa o ID do início de uma resposta e pega o Future do pedido (None para avisos)
+        if fragment.startswith(REQUEST_TAG):
+            request_id, _, rest = fragment[len(REQUEST_TAG):].partition(b' ')
+            if request_id.isdigit():
+                with self.pending_lock:
+                    future = self.pending.pop(int(request_id), None)
+                return future, rest
+        return None, fragment
 
     def listen_for_messages(self):
+        # Mostra cada fragmento assim que ele chega, sem esperar a mensagem inteira
+        decoder = codecs.getincrementaldecoder('utf-8')()  # Um caractere pode ficar dividido entre fragmentos
+        start = True
+        session_id = self.rdt.session_id
         while self.running:
-            msg, addr = self.rdt.receive()  # Recebe mensagens do servidor
-            print(f"Mensagem do servidor: {msg.decode('utf-8')}")  # Imprime a mensagem recebida
+            fragment, addr, last = self.rdt.receive_fragment()  # Recebe mensagens do servidor
+            if session_id != self.rdt.session_id:
+                # Sessão nova: a mensagem que estava pela metade na anterior não continua mais
+                session_id = self.rdt.session_id
+                decoder.reset()
+                start = True
+            if start:
+                future, fragment = self.match(fragment)
+                texts = []
+            text = decoder.decode(fragment, final=last)
+            if future is not None:
+                texts.append(text)
+                if last and not future.done():  # O fail_pending pode ter desistido dele antes
+                    future.set_result(''.join(texts))  # Resposta completa: acorda quem espera o pedido
+            if self.echo and (text or not (start and last)):  # Resposta vazia não é impressa
+                print(("Mensagem do servidor: " if start else "") + text, end="\n" if last else "", flush=True)  # Imprime a mensagem recebida
+            start = last
 
     def start_listener(self):
         # Inicia uma thread para escutar mensagens do servidor
@@ -92,31 +467,14 @@ class Cliente:
 # Função principal para iniciar o cliente
 def main_cliente():
     client = Cliente(skt.AF_INET, skt.SOCK_DGRAM, ADDR_BIND, MAX_BUFFER)  # Cria o cliente
+    client.rdt.negotiate(client.server_addr)  # Negocia o tamanho dos datagramas antes do listener
     client.start_listener()  # Inicia o listener de mensagens
 
     try:
         while True:
-            command = input("> ")  # Lê comandos do usuário
-            if command.startswith("login"):
-                _, username = command.split()
-                client.login(username)  # Realiza login
-            elif command == "logout":
-                client.logout()  # Realiza logout
-            elif command.startswith("create"):
-                _, name, location, *description = command.split()
-                client.create_accommodation(name, location, ' '.join(description))  # Cria uma acomodação
-            elif command == "list:myacmd":
-                client.list_my_accommodations()  # Lista acomodações do usuário
-            elif command == "list:acmd":
-                client.list_accommodations()  # Lista todas as acomodações
-            elif command == "list:myrsv":
-                client.list_my_reservations()  # Lista reservas do usuário
-            elif command.startswith("book"):
-                _, owner, name, location, day = command.split()
-                client.book_accommodation(owner, name, location, day)  # Reserva uma acomodação
-            elif command.startswith("cancel"):
-                _, owner, name, location, day = command.split()
-                client.cancel_reservation(owner, name, location, day)  # Cancela uma reserva
+            command = input("> ").strip()  # Lê comandos do usuário
+            if command:
+                client.request(command)  # Vai em texto, como foi digitado; o servidor valida e responde
     except KeyboardInterrupt:
         print("Encerrando o cliente...")  # Mensagem ao encerrar
         client.stop_listener()  # Para o listener
@@ -1,232 +1,1666 @@
 import socket as skt  
-import random  
-import threading
-import time  
+import struct
+import asyncio
+import bisect
+import collections
+import datetime
+import gc
+import itertools
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import time
+import zlib
+import concurrent.futures
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # metricas.py fica na raiz do repositório
+from metricas import Metricas, Perfil, log, merge_snapshots, prometheus_text, write_metrics
 
 MAX_BUFFER = 1024  # Define o tamanho máximo dos dados a serem recebidos pelo socket
 ADDR_BIND = ('localhost', 7070)  # Define o endereço e a porta onde o servidor se vinculará
-LOSS_PROBABILITY = 0.0  # Define a probabilidade de perda de pacotes (0.0 = sem perda)
 
-# Classe RDT 3.0 (Feita nas etapas anteriores) para gerenciar a transferência confiável de dados
-class RDT:
-    def __init__(self, socket, max_buffer):
-        self.socket = socket  # Armazena o socket para comunicação
+# Cabeçalho binário de tamanho fixo: tipo, flags, número de sequência, ack e tamanho do payload
+HEADER = struct.Struct('!BBHHH')
+TYPE_DATA = 0  # Pacote com dados (o campo ack leva o ID da sessão do cliente)
+TYPE_ACK = 1  # Confirmação de um pacote (o número vai no campo ack e o ID da sessão no seq)
+TYPE_PROBE = 2  # Sonda de tamanho de datagrama, o payload é só enchimento (o seq leva o ID da sessão)
+TYPE_PROBE_ACK = 3  # Resposta da sonda (o campo ack leva o tamanho do datagrama que chegou)
+FLAG_MORE = 0x01  # Nas flags de um DATA: a mensagem continua no próximo pacote (fragmentação)
+
+SEQ_SPACE = 2 ** 16  # Espaço dos números de sequência, separado em cada sentido de cada sessão
+WINDOW_SIZE = 128  # Pacotes sem ACK em trânsito (e fora de ordem guardados) em cada sentido
+RTO = 0.5  # Tempo de espera pelo ACK antes da primeira medida de RTT da sessão (dobra a cada tentativa)
+MIN_RTO = 0.05  # Limites do tempo de espera calculado com SRTT/RTTVAR (segundos)
+MAX_RTO = 2.0  # Também é o teto da espera dobrada
+BACKOFF_LIMIT = 8  # A espera dobra a cada retransmissão até BACKOFF_LIMIT vezes o RTO (com perda aleatória, esperar mais só atrasa)
+DEAD_AFTER = 15.0  # Segundos sem ACK de um pacote até dar a sessão como morta
+DUP_ACK_THRESHOLD = 3  # ACKs de pacotes posteriores que indicam perda (retransmissão rápida)
+SHRINK_RETRIES = 3  # Retransmissões por prazo de um datagrama maior que MAX_BUFFER que fazem o tamanho daquele cliente cair pela metade
+EXPIRED_MAX = 256  # Sessões mortas guardadas (com o que ficou sem ACK), para o cliente que volta depois de uma queda
+IDLE_TIMEOUT = 60.0  # Segundos sem nenhum pacote até a sessão de quem não está logado sair da tabela
+RCVBUF_SIZE = 4 * 1024 * 1024  # Buffer de recepção pedido ao SO, para rajadas de muitos clientes
+
+REQUEST_TAG = '#'  # Prefixo do ID escolhido pelo cliente ("#<id> <comando>"), repetido na resposta
+
+# Comandos em binário: BINARY_MARK, opcode, ID do pedido (0 = sem ID) e os campos do esquema do opcode.
+# Campos: s = palavra (tamanho em 1 byte + UTF-8), t = texto até o fim (tamanho em 2 bytes + UTF-8),
+# d = dia como posição no calendário (2 bytes com sinal), n = número opcional (2 bytes, 0 = ausente),
+# v = versão do catálogo (4 bytes, 0 = nenhuma).
+# Em texto os mesmos comandos continuam valendo ("book ana casa recife 18/07/2024")
+BINARY_MARK = 0x00  # Primeiro byte de um comando binário (um comando em texto nunca começa com ele)
+COMMAND_HEADER = struct.Struct('!BBI')
+FIELDS = {'s': struct.Struct('!B'), 't': struct.Struct('!H'), 'd': struct.Struct('!h'), 'n': struct.Struct('!H'), 'v': struct.Struct('!I')}
+OP_LOGIN, OP_LOGOUT, OP_CREATE, OP_LIST_MYACMD, OP_LIST_ACMD, OP_LIST_MYRSV, OP_BOOK, OP_CANCEL, OP_SEARCH, OP_LIST_SINCE, OP_STATS = range(1, 12)
+COMMANDS = {  # opcode -> (nome em texto, esquema dos campos)
+    OP_LOGIN: ('login', 's'),
+    OP_LOGOUT: ('logout', ''),
+    OP_CREATE: ('create', 'sst'),
+    OP_LIST_MYACMD: ('list:myacmd', 'nn'),
+    OP_LIST_ACMD: ('list:acmd', 'nn'),
+    OP_LIST_MYRSV: ('list:myrsv', 'nn'),
+    OP_BOOK: ('book', 'sssd'),
+    OP_CANCEL: ('cancel', 'sssd'),
+    OP_SEARCH: ('search', 'sdd'),
+    OP_LIST_SINCE: ('list:since', 'v'),
+    OP_STATS: ('stats', ''),
+}
+TEXT_COMMANDS = {name: opcode for opcode, (name, _) in COMMANDS.items()}
+
+# Diário (write-ahead log) das mudanças de estado e snapshot compacto, para sobreviver a reinícios.
+# Cada registro: tamanho e CRC32 do resto, opcode do comando e os campos do esquema abaixo
+STATE_DIR = 'estado'  # Diretório do diário e do snapshot (None = estado só em memória)
+JOURNAL_RECORD = struct.Struct('!II')
+JOURNAL_SCHEMAS = {  # opcode -> campos gravados (t para os textos: nomes não têm limite de 255 bytes)
+    OP_CREATE: 'tttt',  # dono, nome, local, descrição
+    OP_BOOK: 'ttttd',  # usuário, dono, nome, local, dia
+    OP_CANCEL: 'tttd',  # usuário, nome, local, dia
+}
+SNAPSHOT_EVERY = 100000  # Registros no diário antes de gravar um snapshot novo e começar outro diário
+SNAPSHOT_CHUNK = 2000  # Itens por pickle no snapshot: entre um e outro a thread de escrita solta o GIL
+JOURNAL_RETRIES = 3  # Tentativas de gravar um lote (cortando o arquivo de volta entre uma e outra)
+JOURNAL_RETRY_DELAY = 0.1  # Segundos entre uma tentativa e outra
+JOURNAL_ERROR = b"Erro gravando no disco, tente de novo."  # Resposta das mudanças que não chegaram ao disco
+JOURNAL_STOP_DELAY = 2.0  # Segundos entre um erro sem volta no diário e a parada do servidor (para as respostas de erro saírem)
+
+# Leituras grandes (o catálogo inteiro) são montadas em threads de leitura a partir de uma cópia do
+# catálogo; as acomodações nunca são alteradas no lugar (cada mudança troca o dict), então a cópia
+# rasa é imutável e o laço de eventos continua aplicando escritas enquanto ela é formatada
+READ_OFFLOAD_MIN = 5000  # Acomodações a partir das quais a listagem inteira sai do laço de eventos
+READ_THREADS = 2  # Threads de leitura
+
+# Vários processos (um por núcleo) na mesma porta com SO_REUSEPORT: o kernel espalha os clientes entre
+# eles pelo endereço de origem. As acomodações ficam repartidas por hash consistente de (nome, local),
+# cada processo com o seu diário; os processos conversam por pares de sockets locais (pedidos que caem
+# no shard errado, listagens de todos os shards, avisos para usuários que estão em outro processo)
+WORKERS = 1  # Processos do servidor (1 = um processo só, sem shards)
+SHARD_POINTS = 64  # Pontos de cada shard no anel do hash consistente
+PEER_FRAME = struct.Struct('!I')  # Tamanho de cada mensagem (pickle) entre os processos
+PEER_TIMEOUT = 5.0  # Segundos esperando o resultado de outro shard antes de responder com erro
+PEER_ERROR = b"Shard indisponivel, tente de novo."  # Resposta quando o shard de que o pedido depende caiu ou não responde
+STOP_TIMEOUT = 5.0  # Segundos que cada processo tem para fechar o diário ao encerrar, antes de ser morto
+
+NOTIFY_QUEUE_MAX = 64  # Avisos pendentes por destinatário (e broadcasts por espalhar); acima disso cai o mais antigo
+NOTIFY_BATCH = 256  # Destinatários atendidos por rodada do notificador, antes de devolver o laço aos pedidos
+NOTIFY_RETRY = 0.05  # Espera antes de tentar de novo quando todos os destinatários pendentes estão com a janela cheia
+
+# Métricas (contadores, histogramas e medidores, do metricas.py): saem pelo comando stats e, com
+# METRICS_FILE, num arquivo regravado a cada METRICS_EVERY segundos (com shards, um arquivo por
+# processo: <arquivo>.<shard>). O nível do log e o formato do arquivo ficam no metricas.py
+METRICS_FILE = None  # Arquivo das métricas (None = só pelo comando stats)
+METRICS_EVERY = 10.0  # Segundos entre uma gravação e outra
+
+# Modo de perfil: com PROFILE ligado, os métodos listados abaixo são trocados por versões cronometradas
+# (spans) e, quando o servidor para, o tempo de cada pilha de spans vai para PROFILE_FILE no formato
+# colapsado dos flame graphs (com shards, um arquivo por processo: <arquivo>.<shard>). Desligado, nada
+# é trocado e o custo é zero
+PROFILE = False
+PROFILE_FILE = 'perfil.folded'  # Lido pelo flamegraph.pl, speedscope ou inferno
+SERVER_SPANS = {  # Método do Servidor -> nome do span (cada tratador de comando tem o seu)
+    'handle_message': 'pedido', 'login': 'login', 'logout': 'logout', 'create_accommodation': 'create',
+    'list_my_accommodations': 'list:myacmd', 'list_accommodations': 'list:acmd', 'list_my_reservations': 'list:myrsv',
+    'book_accommodation': 'book', 'cancel_reservation': 'cancel', 'search_accommodations': 'search',
+    'list_since': 'list:since', 'stats': 'stats', 'peer_message': 'shard', 'deliver': 'resposta',
+}
+RDT_SPANS = {'datagram_received': 'rdt:recebe', 'send': 'rdt:send', 'on_timer': 'rdt:timer', 'udt_send': 'syscall:sendto'}
+NOTIFIER_SPANS = {'drain': 'avisos'}
+JOURNAL_SPANS = {'write': 'disco:diario', 'write_snapshot': 'disco:snapshot'}  # Na thread de escrita
+FUNCTION_SPANS = {'decode_binary': 'parse:binario', 'decode_text': 'parse:texto', 'encode_record': 'parse:diario'}
+SELECTOR_SPANS = {'select': 'espera'}  # Laço de eventos parado esperando datagramas ou temporizadores
+
+DATE_FORMAT = '%d/%m/%Y'  # Formato dos dias nos comandos e nas respostas
+CALENDAR_START = datetime.date(2024, 7, 17)  # Primeiro dia do calendário (bit 0 do mapa de disponibilidade)
+CALENDAR_DAYS = 6  # Dias oferecidos a cada acomodação nova, a partir do primeiro
+
+
+def day_ordinal(day):
+    # "DD/MM/AAAA" -> posição do dia no calendário (o bit no mapa de disponibilidade, negativa antes
+    # do início do calendário), ou None se a data for inválida
+    try:
+        return datetime.datetime.strptime(day, DATE_FORMAT).date().toordinal() - CALENDAR_START.toordinal()
+    except ValueError:
+        return None
+
+
+def decode_binary(msg):
+    # Comando binário -> (opcode, ID do pedido, campos); struct.error/ValueError se estiver malformado
+    _, opcode, request_id = COMMAND_HEADER.unpack_from(msg)
+    return opcode, request_id, decode_fields(COMMANDS[opcode][1], msg, COMMAND_HEADER.size)
+
+
+def decode_fields(schema, msg, pos):
+    args = []
+    for kind in schema:
+        field = FIELDS[kind]
+        value, = field.unpack_from(msg, pos)
+        pos += field.size
+        if kind in 'st':
+            if pos + value > len(msg):
+                raise ValueError("campo maior que a mensagem")
+            value, pos = str(msg[pos:pos + value], 'utf-8'), pos + value
+        args.append(value)
+    return args
+
+
+def encode_record(opcode, *args):
+    # Registro do diário: cabeçalho com tamanho e CRC, opcode e os campos do esquema do opcode
+    parts = [bytes((opcode,))]
+    for kind, value in zip(JOURNAL_SCHEMAS[opcode], args):
+        if kind in 'st':
+            value = value.encode('utf-8')
+            parts.append(FIELDS[kind].pack(len(value)))
+            parts.append(value)
+        else:
+            parts.append(FIELDS[kind].pack(value))
+    body = b''.join(parts)
+    return JOURNAL_RECORD.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_text(parts):
+    # Palavras de um comando em texto (sem o ID) -> (opcode, campos), no mesmo esquema do binário;
+    # None nos campos se faltar argumento obrigatório
+    opcode = TEXT_COMMANDS[parts[0]]
+    fields = parts[1:]
+    args = []
+    for i, kind in enumerate(COMMANDS[opcode][1]):
+        if kind in 'nv':
+            args.append(int(fields[i]) if i < len(fields) and fields[i].isdigit() else 0)
+        elif i >= len(fields):
+            return opcode, None
+        elif kind == 't':
+            args.append(' '.join(fields[i:]))
+        elif kind == 'd':
+            args.append(day_ordinal(fields[i]))  # None se a data for inválida
+        else:
+            args.append(fields[i])
+    return opcode, args
+
+
+def describe_data(data):
+    # Acomodação como era mostrada antes do mapa de bits: com a lista de dias livres
+    return {**data, 'availability': calendar_days(data['availability'])}
+
+
+def format_accommodations(accommodations, keys=None, header=None):
+    # Linhas "nome em local: {...}" das chaves pedidas (todas se keys for None); roda também nas
+    # threads de leitura, sobre uma cópia imutável do catálogo
+    lines = [header] if header is not None else []
+    lines.extend(accommodation_lines(accommodations, keys))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def accommodation_lines(accommodations, keys=None):
+    if keys is None:
+        return [f"{name} em {loc}: {describe_data(data)}" for (name, loc), data in accommodations.items()]
+    return [f"{name} em {loc}: {describe_data(accommodations[(name, loc)])}" if loc else name for name, loc in keys]
+
+
+def more_results(opcode, offset, limit):
+    # Última linha de uma página que não é a última: como pedir a próxima
+    return f"-- mais resultados: {COMMANDS[opcode][0]} {offset + limit} {limit}"
+
+
+def day_mask(first, last):
+    # Bits dos dias do intervalo [first, last] no mapa de disponibilidade
+    return ((1 << (last - first + 1)) - 1) << first if last >= first else 0
+
+
+def shard_ring(shards):
+    # Anel do hash consistente: (ponto, shard) ordenado, com SHARD_POINTS pontos por shard. CRC32 e
+    # não hash(): o hash de str muda a cada processo
+    return sorted((zlib.crc32(f"shard {shard} {point}".encode('utf-8')), shard) for shard in range(shards) for point in range(SHARD_POINTS))
+
+
+def reservation_lines(keys):
+    return [f"Reservado {name} em {loc} no dia {day}" if loc else name for name, loc, day in keys]
+
+
+def day_string(ordinal):
+    return (CALENDAR_START + datetime.timedelta(days=ordinal)).strftime(DATE_FORMAT)
+
+
+def recut(fragments, size):
+    # Recorta (flags, fragmento) em pedaços de até size bytes; só o último pedaço de cada um fica
+    # com as flags dele, os outros levam FLAG_MORE (a mensagem remontada do outro lado é a mesma)
+    for flags, fragment in fragments:
+        for offset in range(0, max(len(fragment), 1), size):
+            yield (FLAG_MORE if offset + size < len(fragment) else flags), fragment[offset:offset + size]
+
+
+def calendar_days(bitmap):
+    # Dias livres de um mapa de disponibilidade, em ordem
+    days = []
+    ordinal = 0
+    while bitmap:
+        if bitmap & 1:
+            days.append(day_string(ordinal))
+        bitmap >>= 1
+        ordinal += 1
+    return days
+
+
+PROFILER = Perfil()  # Perfil do processo (só é usado com PROFILE ligado)
+
+
+# Estado de um cliente: sequências de envio e recepção, janela e temporizador próprios.
+# Com __slots__ cada sessão ocupa só os campos abaixo (sem __dict__), e as estruturas
+# que quase sempre ficam vazias só são criadas quando precisam
+class Sessao:
+    __slots__ = ('addr', 'session_id', 'send_seq', 'recv_seq', 'in_flight', 'backlog', 'recv_buffer',
+                 'partial', 'timer', 'max_datagram', 'srtt', 'rttvar', 'rto', 'active', 'closing')
+
+    def __init__(self, addr, session_id, max_datagram):
+        self.addr = addr
+        self.session_id = session_id  # Escolhido pelo cliente; muda quando ele reinicia no mesmo endereço
+        self.send_seq = 0  # Próximo número de sequência a ser enviado para esse cliente
+        self.recv_seq = 0  # Próximo número de sequência esperado desse cliente
+        self.in_flight = {}  # seq_num -> [pacote, prazo, retransmissões, ACKs de pacotes posteriores, envio] esperando ACK
+        self.backlog = None  # (flags, fragmento) esperando espaço na janela (deque criado sob demanda)
+        self.recv_buffer = None  # seq_num -> (flags, fragmento) que chegou fora de ordem (dict criado sob demanda)
+        self.partial = None  # Fragmentos já recebidos da mensagem que está sendo remontada
+        self.timer = None  # Temporizador do prazo mais próximo entre os pacotes em trânsito
+        self.max_datagram = max_datagram  # Maior datagrama que chega inteiro nesse cliente
+        self.srtt = None  # RTT suavizado (None até a primeira medida)
+        self.rttvar = 0.0  # Variação do RTT
+        self.rto = RTO  # Tempo de espera pelo ACK, recalculado a cada medida
+        self.active = True  # Chegou algum pacote do cliente desde a última varredura de sessões paradas
+        self.closing = False  # O cliente deslogou: a sessão sai quando a última resposta for confirmada
+
+
+# Motor RDT do servidor sobre asyncio: um único laço de eventos recebe todos os datagramas,
+# despacha cada um na hora e cuida das retransmissões com temporizadores, sem uma thread por cliente
+class AsyncRDT(asyncio.DatagramProtocol):
+    def __init__(self, max_buffer, handler, metrics, on_expire, keep):
         self.max_buffer = max_buffer  # Armazena o tamanho máximo do buffer
-        self.seq_num = 0  # Inicializa o número de sequência
+        self.handler = handler  # Chamado com (mensagem, endereço) para cada mensagem nova
+        self.on_expire = on_expire  # Chamado com o endereço quando a sessão morre (o cliente parou de responder)
+        self.keep = keep  # Diz se o servidor ainda precisa da sessão do endereço (usuário logado), mesmo parada
+        self.sessions = {}  # Endereço do cliente -> Sessao
+        self.expired = {}  # Endereço -> Sessao que morreu, da mais antiga para a mais nova
+        self.transport = None
+        self.metrics = metrics
+        metrics.gauge('rdt_sessions', lambda: len(self.sessions))
+        metrics.gauge('rdt_in_flight_packets', lambda: sum(len(sess.in_flight) for sess in self.sessions.values()))
+        metrics.gauge('rdt_backlog_packets', lambda: sum(len(sess.backlog or ()) for sess in self.sessions.values()))
+
+    def connection_made(self, transport):
+        self.transport = transport  # Transporte do laço de eventos, usado em todos os envios
+        asyncio.get_running_loop().call_later(IDLE_TIMEOUT, self.sweep)
+
+    def session(self, addr, session_id, seq_num=None):
+        # Sessão do endereço; um ID diferente quer dizer que o cliente reiniciou e começa do zero
+        sess = self.sessions.get(addr)
+        if sess is None or session_id != sess.session_id:
+            if sess is not None and sess.timer is not None:
+                sess.timer.cancel()
+            expired = self.expired.pop(addr, None)
+            if expired is not None and expired.session_id == session_id and seq_num is not None:
+                return self.revive(expired, seq_num)
+            sess = self.sessions[addr] = Sessao(addr, session_id, self.max_buffer)
+        sess.active = True
+        return sess
+
+    def revive(self, sess, seq_num):
+        # Um DATA com o ID de uma sessão que morreu é o cliente voltando depois de uma queda: a sessão
+        # volta com as sequências que tinha, e o que ficou sem ACK sai de novo na hora (o que já tinha
+        # chegado o cliente só confirma). Se o cliente mandou algo que nunca chegou aqui, a recepção
+        # pula para o seq dele; o que vier antes disso já foi tratado
+        if (seq_num - sess.recv_seq) % SEQ_SPACE < SEQ_SPACE // 2:
+            sess.recv_seq = seq_num
+            sess.recv_buffer = None
+            sess.partial = None
+        now = asyncio.get_running_loop().time()
+        for entry in sess.in_flight.values():
+            entry[1] = now  # Prazo vencido: retransmite no próximo on_timer
+            entry[4] = now  # E o prazo até dar a sessão como morta recomeça
+        self.sessions[sess.addr] = sess
+        sess.closing = False
+        if sess.in_flight:
+            sess.timer = asyncio.get_running_loop().call_soon(self.on_timer, sess)
+        self.metrics.add('rdt_sessions_revived_total')
+        return sess
+
+    def bury(self, sess):
+        # Guarda a sessão que saiu da tabela entre as mortas, a mais nova no fim
+        self.expired.pop(sess.addr, None)
+        self.expired[sess.addr] = sess
+        if len(self.expired) > EXPIRED_MAX:
+            del self.expired[next(iter(self.expired))]
+
+    def close(self, addr):
+        # O servidor terminou com o cliente (logout): a sessão sai da tabela assim que o que falta
+        # enviar (a resposta do logout) for confirmado
+        sess = self.sessions.get(addr)
+        if sess is not None:
+            sess.closing = True
+            self.retire(sess, 'logout')
+
+    def retire(self, sess, reason):
+        # Tira da tabela a sessão sem nada em trânsito de que o servidor não precisa mais. Ela fica entre
+        # as mortas, então o cliente que voltar a falar continua com as sequências que tinha (revive)
+        if sess.in_flight or sess.backlog or self.keep(sess.addr) or self.sessions.get(sess.addr) is not sess:
+            return
+        del self.sessions[sess.addr]
+        self.bury(sess)
+        self.metrics.add(f'rdt_sessions_closed_total{{reason="{reason}"}}')
+
+    def sweep(self):
+        # A cada IDLE_TIMEOUT: quem não mandou nenhum pacote desde a última passada e não está logado
+        # (deslogou sem a última confirmação chegar, ou nunca logou) sai da tabela; quem está logado
+        # fica, porque os avisos para ele precisam da sessão
+        for sess in list(self.sessions.values()):
+            if not sess.active:
+                self.retire(sess, 'idle')
+            sess.active = False
+        asyncio.get_running_loop().call_later(IDLE_TIMEOUT, self.sweep)
+
+    def datagram_received(self, data, addr):
+        self.metrics.add('rdt_packets_received_total')
+        if len(data) < HEADER.size:
+            return  # Ignora pacotes malformados
+        ptype, flags, recv_seq_num, ack_num, length = HEADER.unpack_from(data)  # Lê o cabeçalho sem copiar
+        if ptype == TYPE_PROBE:
+            # Responde a sonda com o tamanho que chegou inteiro e guarda como limite daquele cliente
+            self.udt_send(addr, HEADER.pack(TYPE_PROBE_ACK, 0, 0, len(data), 0))
+            sess = self.session(addr, recv_seq_num)
+            sess.max_datagram = max(sess.max_datagram, len(data))
+        elif ptype == TYPE_ACK:
+            sess = self.sessions.get(addr)
+            if sess is not None and recv_seq_num == sess.session_id:
+                sess.active = True
+                self.handle_ack(sess, ack_num)
+        elif ptype == TYPE_DATA and HEADER.size + length <= len(data):
+            self.handle_data(self.session(addr, ack_num, recv_seq_num), recv_seq_num, flags, data[HEADER.size:HEADER.size + length])
+
+    def handle_data(self, sess, seq_num, flags, fragment):
+        offset = (seq_num - sess.recv_seq) % SEQ_SPACE
+        if offset >= WINDOW_SIZE and offset < SEQ_SPACE - WINDOW_SIZE:
+            return  # Fora da janela: nem confirma
+        # Envia um ACK confirmando o recebimento (de novo, se for uma retransmissão já entregue)
+        self.udt_send(sess.addr, HEADER.pack(TYPE_ACK, 0, sess.session_id, seq_num, 0))
+        self.metrics.add('rdt_acks_sent_total')
+        if offset >= WINDOW_SIZE:
+            self.metrics.add('rdt_duplicates_total')
+            return
+        if offset > 0:
+            if sess.recv_buffer is None:
+                sess.recv_buffer = {}
+            if seq_num in sess.recv_buffer:
+                self.metrics.add('rdt_duplicates_total')
+            sess.recv_buffer.setdefault(seq_num, (flags, fragment))  # Chegou antes de um anterior: espera ele
+            return
+        # Junta esse fragmento e os seguintes que já estavam esperando, na ordem, e entrega cada
+        # mensagem assim que chega o fragmento sem FLAG_MORE
+        while fragment is not None:
+            sess.recv_seq = (sess.recv_seq + 1) % SEQ_SPACE
+            if flags & FLAG_MORE:
+                if sess.partial is None:
+                    sess.partial = []
+                sess.partial.append(fragment)
+            else:
+                if sess.partial is not None:
+                    sess.partial.append(fragment)
+                    fragment = b''.join(sess.partial)
+                    sess.partial = None
+                try:
+                    self.handler(fragment, sess.addr)
+                except Exception as exc:  # Um comando inválido não pode travar a entrega dos seguintes
+                    self.metrics.add('handler_errors_total')
+                    log('aviso', "Erro tratando mensagem de %s: %r", sess.addr, exc)
+            flags, fragment = sess.recv_buffer.pop(sess.recv_seq, (0, None)) if sess.recv_buffer else (0, None)
+
+    def handle_ack(self, sess, ack_num):
+        if ack_num not in sess.in_flight:
+            self.metrics.add('rdt_duplicate_acks_total')
+            return  # ACK duplicado
+        now = asyncio.get_running_loop().time()
+        # Cada ACK de um pacote posterior conta contra os mais antigos que ainda esperam ACK; com
+        # DUP_ACK_THRESHOLD deles o pacote é dado como perdido sem esperar o prazo (uma vez por pacote)
+        for seq_num, entry in sess.in_flight.items():
+            if seq_num == ack_num:
+                break
+            entry[3] += 1
+            if entry[3] == DUP_ACK_THRESHOLD and not entry[2]:
+                entry[2] = 1
+                entry[1] = now + min(sess.rto * 2, MAX_RTO)
+                self.udt_send(sess.addr, entry[0])
+                self.metrics.add('rdt_retransmissions_total{reason="fast"}')
+                self.metrics.add('rdt_packets_sent_total')
+        entry = sess.in_flight.pop(ack_num)
+        if not entry[2]:
+            # RTT só de pacotes que não foram retransmitidos (regra de Karn)
+            self.update_rtt(sess, now - entry[4])
+        while sess.backlog and not self.window_full(sess):
+            self.transmit(sess, *sess.backlog.popleft())
+        if not sess.in_flight and sess.timer is not None:
+            sess.timer.cancel()
+            sess.timer = None
+        if sess.closing and not sess.in_flight:
+            self.retire(sess, 'logout')
+
+    def update_rtt(self, sess, sample):
+        # Atualiza SRTT/RTTVAR com uma nova medida e recalcula o tempo de espera da sessão
+        self.metrics.observe('rdt_rtt_seconds', sample)
+        if sess.srtt is None:
+            sess.srtt = sample
+            sess.rttvar = sample / 2
+        else:
+            sess.rttvar = 0.75 * sess.rttvar + 0.25 * abs(sess.srtt - sample)
+            sess.srtt = 0.875 * sess.srtt + 0.125 * sample
+        sess.rto = min(max(sess.srtt + 4 * sess.rttvar, MIN_RTO), MAX_RTO)
+
+    def error_received(self, exc):
+        self.metrics.add('rdt_socket_errors_total')
+        log('debug', "Erro no socket: %s", exc)  # Ex.: ICMP de porta inalcançável de um cliente que saiu
+
+    def window_full(self, sess):
+        # A janela vai do pacote mais antigo sem ACK (o primeiro do dict, que segue a ordem de envio)
+        # até WINDOW_SIZE depois dele; contar só os pendentes deixaria passar do que o outro lado aceita
+        return bool(sess.in_flight) and (sess.send_seq - next(iter(sess.in_flight))) % SEQ_SPACE >= WINDOW_SIZE
+
+    def busy(self, addr):
+        # Janela do destinatário cheia: o que for enviado agora só ficaria parado no backlog
+        sess = self.sessions.get(addr)
+        return sess is not None and (bool(sess.backlog) or self.window_full(sess))
+
+    def payload_size(self, addr):
+        # Quanto cabe em um único datagrama para esse endereço
+        sess = self.sessions.get(addr)
+        return (sess.max_datagram if sess is not None else self.max_buffer) - HEADER.size
 
     def send(self, addr, msg):
-        # Simula a perda de pacotes com a probabilidade definida
-        if random.random() < LOSS_PROBABILITY:
-            return  # Simula a perda do pacote, não enviando nada
-
-        # Cria um pacote com o número de sequência e a mensagem
-        time.sleep(0.1)  # Adiciona um atraso para simulação
-        packet = f"{self.seq_num}|".encode('utf-8') + msg
-        self.socket.sendto(packet, addr)  # Envia o pacote para o endereço especificado
-        self.seq_num = 1 - self.seq_num  # Alterna o número de sequência entre 0 e 1
-
-    def receive(self):
-        while True:
-            data, addr = self.socket.recvfrom(self.max_buffer)  # Recebe dados do socket
-            if b'|' not in data:
-                continue  # Ignora pacotes malformados
-            header, msg = data.split(b'|', 1)  # Separa o cabeçalho da mensagem
-            recv_seq_num = int(header.decode('utf-8'))  # Decodifica o número de sequência
-            if recv_seq_num == self.seq_num:
-                # Envia um ACK confirmando o recebimento
-                time.sleep(0.1)  # Adiciona um atraso para simulação
-                self.socket.sendto(f"ACK{recv_seq_num}".encode('utf-8'), addr)
-                self.seq_num = 1 - self.seq_num  # Alterna o número de sequência
-                return msg, addr  # Retorna a mensagem e o endereço
+        # Não bloqueia: o ACK é esperado pelo temporizador da sessão, que retransmite se ele não chegar.
+        # Mensagens maiores que o datagrama negociado vão em fragmentos seguidos, todos menos o
+        # último com FLAG_MORE; como a entrega é em ordem, o número de sequência numera os fragmentos.
+        # Sem sessão (o cliente nunca falou ou a sessão morreu) não há para onde mandar: descarta
+        sess = self.sessions.get(addr)
+        if sess is None:
+            self.metrics.add('rdt_dropped_messages_total')
+            return
+        size = sess.max_datagram - HEADER.size
+        view = memoryview(msg)
+        for offset in range(0, max(len(msg), 1), size):
+            flags = FLAG_MORE if offset + size < len(msg) else 0
+            if self.window_full(sess):
+                if sess.backlog is None:
+                    sess.backlog = collections.deque()
+                sess.backlog.append((flags, view[offset:offset + size]))  # Janela cheia: sai quando chegar um ACK
+            else:
+                self.transmit(sess, flags, view[offset:offset + size])
+
+    def transmit(self, sess, flags, fragment):
+        # Cria um pacote com o cabeçalho binário e o fragmento
+        loop = asyncio.get_running_loop()
+        packet = HEADER.pack(TYPE_DATA, flags, sess.send_seq, sess.session_id, len(fragment)) + fragment
+        now = loop.time()
+        sess.in_flight[sess.send_seq] = [packet, now + sess.rto, 0, 0, now]
+        sess.send_seq = (sess.send_seq + 1) % SEQ_SPACE
+        self.udt_send(sess.addr, packet)
+        self.metrics.add('rdt_packets_sent_total')
+        if sess.timer is None:
+            sess.timer = loop.call_later(sess.rto, self.on_timer, sess)
+
+    def on_timer(self, sess):
+        # Retransmite o que passou do prazo e rearma o temporizador para o próximo prazo
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        sess.timer = None
+        for entry in sess.in_flight.values():
+            if now < entry[1]:
+                continue
+            if now - entry[4] >= DEAD_AFTER:
+                # O cliente saiu sem avisar: descarta a sessão e avisa o servidor, que desloga o usuário
+                if self.sessions.get(sess.addr) is sess:
+                    del self.sessions[sess.addr]
+                    self.bury(sess)
+                    self.metrics.add('rdt_sessions_expired_total')
+                    self.on_expire(sess.addr)
+                return
+            entry[2] += 1
+            entry[1] = now + min(sess.rto * min(2 ** entry[2], BACKOFF_LIMIT), MAX_RTO)
+            if entry[2] == SHRINK_RETRIES and self.max_buffer < len(entry[0]) <= sess.max_datagram:
+                self.shrink(sess)
+            self.udt_send(sess.addr, entry[0])
+            self.metrics.add('rdt_retransmissions_total{reason="timeout"}')
+            self.metrics.add('rdt_packets_sent_total')
+        if sess.in_flight:
+            sess.timer = loop.call_at(min(entry[1] for entry in sess.in_flight.values()), self.on_timer, sess)
+
+    def shrink(self, sess):
+        # Um datagrama do tamanho atual continua sem ACK (a sonda passou, mas o caminho mudou ou perde
+        # os grandes): o tamanho do cliente cai pela metade, até MAX_BUFFER. Vale para os próximos
+        # fragmentos e para o backlog, que é recortado; o que já saiu numerado continua do tamanho que tinha
+        sess.max_datagram = max(sess.max_datagram // 2, self.max_buffer)
+        if sess.backlog:
+            sess.backlog = collections.deque(recut(sess.backlog, sess.max_datagram - HEADER.size))
+        self.metrics.add('rdt_datagram_shrinks_total')
+        log('aviso', "Perdas seguidas, datagramas para %s caem para %d bytes", sess.addr, sess.max_datagram)
+
+    def udt_send(self, addr, packet):
+        self.transport.sendto(packet, addr)  # Envia o pacote para o endereço especificado
+
+
+# Notificações fora do caminho dos pedidos: cada destinatário tem sua fila de avisos, esvaziada aos
+# poucos pelo laço de eventos; os avisos pendentes de um mesmo destinatário saem juntos em um datagrama
+class Notificador:
+    def __init__(self, rdt, online, metrics):
+        self.rdt = rdt
+        self.online = online  # Endereço -> usuário de quem está online (o self.users do servidor)
+        self.queues = {}  # Endereço -> deque de avisos pendentes; a ordem do dict é a vez de cada um
+        self.broadcasts = collections.deque(maxlen=NOTIFY_QUEUE_MAX)  # (aviso, endereço excluído) por espalhar
+        self.fanout = None  # (aviso, endereço excluído, iterador dos destinatários) do broadcast em andamento
+        self.scheduled = False  # Já existe uma rodada marcada no laço de eventos
+        self.metrics = metrics  # Avisos descartados por fila cheia vão no notify_dropped_total
+        metrics.gauge('notify_queued', lambda: sum(len(queue) for queue in self.queues.values()))
+        metrics.gauge('notify_broadcasts_queued', lambda: len(self.broadcasts))
+
+    def notify(self, addr, message):
+        # Coloca o aviso na fila do destinatário e volta na hora
+        self.enqueue(addr, message.encode('utf-8'))
+        self.schedule()
+
+    def broadcast(self, message, exclude_addr=None):
+        # Só guarda o aviso: a cópia para cada usuário online é feita nas rodadas, em lotes
+        if len(self.broadcasts) == self.broadcasts.maxlen:
+            self.metrics.add('notify_dropped_total')
+        self.broadcasts.append((message.encode('utf-8'), exclude_addr))
+        self.schedule()
+
+    def forget(self, addr):
+        self.queues.pop(addr, None)  # Quem saiu não recebe mais os avisos pendentes
+
+    def enqueue(self, addr, data):
+        queue = self.queues.get(addr)
+        if queue is None:
+            queue = self.queues[addr] = collections.deque(maxlen=NOTIFY_QUEUE_MAX)
+        elif len(queue) == queue.maxlen:
+            self.metrics.add('notify_dropped_total')  # A deque descarta o mais antigo sozinha
+        queue.append(data)
+
+    def schedule(self, delay=0):
+        if self.scheduled:
+            return
+        self.scheduled = True
+        loop = asyncio.get_running_loop()
+        if delay:
+            loop.call_later(delay, self.drain)
+        else:
+            loop.call_soon(self.drain)
+
+    def drain(self):
+        # Uma rodada: espalha até NOTIFY_BATCH cópias de broadcasts e atende até NOTIFY_BATCH
+        # destinatários, depois devolve o laço para os pedidos e marca a próxima rodada se sobrou algo
+        self.scheduled = False
+        budget = NOTIFY_BATCH
+        while budget > 0 and (self.fanout is not None or self.broadcasts):
+            if self.fanout is None:
+                data, exclude_addr = self.broadcasts.popleft()
+                self.fanout = (data, exclude_addr, iter(list(self.online)))
+            data, exclude_addr, recipients = self.fanout
+            taken = 0
+            for addr in itertools.islice(recipients, budget):
+                taken += 1
+                if addr != exclude_addr:  # Não envia nada para o usuário que ativou o aviso
+                    self.enqueue(addr, data)
+            budget -= taken
+            if budget > 0:
+                self.fanout = None  # O iterador acabou antes do lote: broadcast espalhado
+
+        sent = 0
+        for _ in range(min(NOTIFY_BATCH, len(self.queues))):
+            addr = next(iter(self.queues))
+            queue = self.queues.pop(addr)
+            if addr not in self.online:
+                continue  # Saiu antes de receber
+            if self.rdt.busy(addr):
+                self.queues[addr] = queue  # Janela cheia: vai para o fim da fila e junta mais avisos
+                continue
+            # Junta os avisos pendentes que couberem em um datagrama (pelo menos um)
+            size = self.rdt.payload_size(addr)
+            notices = [queue.popleft()]
+            total = len(notices[0])
+            while queue and total + 1 + len(queue[0]) <= size:
+                notices.append(queue.popleft())
+                total += 1 + len(notices[-1])
+            self.rdt.send(addr, b'\n'.join(notices))
+            self.metrics.add('notify_sent_total', len(notices))
+            sent += 1
+            if queue:
+                self.queues[addr] = queue
+
+        if self.fanout is not None or self.broadcasts or (self.queues and sent):
+            self.schedule()
+        elif self.queues:
+            self.schedule(NOTIFY_RETRY)  # Todos com a janela cheia: espera os ACKs
+
+
+# Diário com group commit: os registros de uma rodada do laço de eventos vão juntos em um write + fsync,
+# feitos numa thread só para isso; o que depende do registro estar no disco (as respostas) espera o fsync.
+# Se um lote não chega ao disco nem depois de JOURNAL_RETRIES tentativas, quem esperava recebe o erro no
+# lugar da confirmação e o diário para de gravar: o estado em memória já tem mudanças que o disco não
+# tem, e quem decide o que fazer (o Servidor para e, ao voltar, fica com o que está no disco) é o broken
+class Diario:
+    def __init__(self, directory, dump, metrics, broken):
+        self.directory = directory
+        self.dump = dump  # Função que devolve o estado inteiro, para o snapshot
+        self.broken = broken  # Chamada (uma vez) quando um lote não pôde ser gravado
+        self.metrics = metrics  # Usado também pela thread de escrita, no acumulador dela
+        self.generation = 0  # Número do arquivo de diário atual (diario.<n>); o snapshot diz a partir de qual repetir
+        self.buffer = []  # Registros ainda não entregues para a thread de escrita
+        self.waiting = []  # (função, args, falha) a chamar quando os registros do buffer estiverem no disco
+        self.records = 0  # Registros desde o último snapshot
+        self.scheduled = False
+        self.flushing = False
+        self.file = None  # Arquivo aberto pela thread de escrita, a geração dele e até onde ele está no disco
+        self.file_generation = None
+        self.file_offset = 0
+        self.failed = False  # Um lote não foi gravado: nada mais vai para o disco
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # Uma thread: escritas em ordem
+        os.makedirs(directory, exist_ok=True)
+        metrics.gauge('journal_pending_records', lambda: len(self.buffer))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        # Devolve o estado do último snapshot (None se não há) e um gerador com os registros do diário
+        # gravados depois dele, já decodificados como (opcode, campos)
+        state = None
+        try:
+            with open(self.path('snapshot'), 'rb') as f:
+                state = {}
+                while True:
+                    try:
+                        name, chunked, value = pickle.load(f)
+                    except EOFError:
+                        break
+                    if chunked:
+                        state.setdefault(name, {}).update(value)
+                    else:
+                        state[name] = value
+            self.generation = state['generation']
+        except FileNotFoundError:
+            pass
+        generations = sorted(int(name.split('.')[1]) for name in os.listdir(self.directory)
+                             if name.startswith('diario.') and name.split('.')[1].isdigit())
+        generations = [g for g in generations if g >= self.generation]
+        if generations:
+            self.generation = generations[-1]
+        return state, self.replay(generations)
+
+    def replay(self, generations):
+        for generation in generations:
+            path = self.path(f'diario.{generation}')
+            with open(path, 'rb') as f:
+                data = f.read()
+            pos = 0
+            while pos + JOURNAL_RECORD.size <= len(data):
+                length, crc = JOURNAL_RECORD.unpack_from(data, pos)
+                body = data[pos + JOURNAL_RECORD.size:pos + JOURNAL_RECORD.size + length]
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break  # Registro cortado por uma queda no meio da escrita: o resto não vale
+                pos += JOURNAL_RECORD.size + length
+                self.records += 1
+                yield body[0], decode_fields(JOURNAL_SCHEMAS[body[0]], body, 1)
+            if pos < len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(pos)  # Tira o registro cortado para os próximos não ficarem depois dele
+
+    def append(self, record):
+        self.buffer.append(record)
+        self.records += 1
+        self.metrics.add('journal_records_total')
+        if not self.scheduled:
+            # Espera o fim da rodada atual do laço: os registros dos outros pedidos já lidos vão juntos
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def defer(self, failure, function, *args):
+        # failure (ou None) é chamada no lugar de function se os registros não chegarem ao disco
+        self.waiting.append((function, args, failure))
+
+    def flush(self):
+        self.scheduled = False
+        if self.failed:
+            self.buffer, waiting, self.waiting = [], self.waiting, []
+            self.fail(waiting)
+            return
+        if self.flushing or not self.buffer:
+            return  # Um fsync em andamento: o buffer vai no próximo, junto com o que chegar até lá
+        self.submit()
+
+    def submit(self):
+        self.flushing = True
+        batch, waiting = b''.join(self.buffer), self.waiting
+        self.buffer, self.waiting = [], []
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.write, self.generation, batch)
+        future.add_done_callback(lambda future: self.committed(future, waiting))
+
+    def write(self, generation, batch):
+        # Roda na thread de escrita. Depois de um erro, o que está além do último fsync bem-sucedido é
+        # incerto (pode ter ficado um registro pela metade, e no Linux um fsync que falhou pode ter
+        # largado as páginas sujas): o arquivo é cortado de volta até lá e o lote inteiro vai de novo
+        for attempt in range(JOURNAL_RETRIES):
+            try:
+                if self.file_generation != generation:
+                    if self.file is not None:
+                        self.file.close()
+                    self.file = open(self.path(f'diario.{generation}'), 'ab')
+                    self.file_generation = generation
+                    self.file_offset = self.file.seek(0, os.SEEK_END)
+                start = time.perf_counter()
+                self.file.write(batch)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                self.metrics.add('journal_write_errors_total')
+                log('aviso', "Erro gravando o diário (tentativa %d de %d): %r", attempt + 1, JOURNAL_RETRIES, e)
+                self.discard(generation)
+                if attempt + 1 == JOURNAL_RETRIES:
+                    raise
+                time.sleep(JOURNAL_RETRY_DELAY)
+            else:
+                self.file_offset += len(batch)
+                self.metrics.observe('journal_commit_seconds', time.perf_counter() - start)
+                self.metrics.add('journal_bytes_written_total', len(batch))
+                return
+
+    def discard(self, generation):
+        # Fecha o arquivo (o close ainda pode tentar gravar o que ficou no buffer dele) e corta o diário
+        # no fim do último lote gravado; a próxima escrita abre de novo
+        try:
+            self.file.close()
+        except (OSError, AttributeError):
+            pass
+        self.file = self.file_generation = None
+        try:
+            with open(self.path(f'diario.{generation}'), 'r+b') as f:
+                f.truncate(self.file_offset)
+        except FileNotFoundError:
+            pass  # O erro foi ao criar o arquivo: não há o que cortar
+
+    def committed(self, future, waiting):
+        self.flushing = False
+        if future.exception() is not None:
+            # Ninguém recebe confirmação de uma mudança que não está no disco
+            self.failed = True
+            log('aviso', "Diário sem gravar: as mudanças ainda não gravadas recebem erro: %r", future.exception())
+            self.buffer, pending, self.waiting = [], self.waiting, []
+            self.fail(waiting + pending)
+            self.broken()
+            return
+        for function, args, _ in waiting:
+            function(*args)
+        if self.records >= SNAPSHOT_EVERY:
+            self.snapshot()
+        else:
+            self.flush()
+
+    def fail(self, waiting):
+        for _, _, failure in waiting:
+            if failure is not None:
+                failure()
+
+    def snapshot(self):
+        # Aqui, entre dois pedidos, só se tira a cópia do estado (dump); serializar, gravar e trocar de
+        # diário fica com a thread de escrita, depois das escritas que já estavam na fila. O buffer ainda
+        # é do diário antigo (o snapshot já inclui essas mudanças), então vai para a fila antes da troca
+        if self.buffer:
+            self.submit()
+        self.generation += 1
+        self.records = 0
+        state = self.dump()
+        state['generation'] = self.generation
+        self.executor.submit(self.write_snapshot, self.generation, state)
+
+    def write_snapshot(self, generation, state):
+        # Roda na thread de escrita: grava num temporário e troca de nome, assim uma queda no meio
+        # deixa o snapshot anterior (e os diários que ele precisa) intactos. Os dicts vão em pedaços
+        # de SNAPSHOT_CHUNK itens, cada um um pickle (nome, True, itens); o resto como (nome, False, valor)
+        start = time.perf_counter()
+        tmp = self.path('snapshot.tmp')
+        with open(tmp, 'wb') as f:
+            for name, value in state.items():
+                if not isinstance(value, dict):
+                    pickle.dump((name, False, value), f, pickle.HIGHEST_PROTOCOL)
+                    continue
+                items = iter(value.items())
+                while True:
+                    chunk = list(itertools.islice(items, SNAPSHOT_CHUNK))
+                    pickle.dump((name, True, chunk), f, pickle.HIGHEST_PROTOCOL)
+                    if len(chunk) < SNAPSHOT_CHUNK:
+                        break
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path('snapshot'))
+        for name in os.listdir(self.directory):
+            if name.startswith('diario.') and name.split('.')[1].isdigit() and int(name.split('.')[1]) < generation:
+                os.remove(self.path(name))
+        self.metrics.observe('journal_snapshot_seconds', time.perf_counter() - start)
+
+    def close(self):
+        # Grava o que sobrou no buffer e espera a thread de escrita terminar
+        batch, self.buffer = b''.join(self.buffer), []
+        if batch and not self.failed:
+            self.executor.submit(self.write, self.generation, batch)
+        self.executor.shutdown(wait=True)
+        if self.file is not None:
+            self.file.close()
+
+
+# Endereço de um cliente atendido por outro shard: os tratadores usam como um endereço normal, e o
+# reply cai no respond, que devolve a resposta ao shard onde o cliente está
+class Proxy:
+    __slots__ = ('client_addr', 'respond')
+
+    def __init__(self, client_addr, respond):
+        self.client_addr = client_addr
+        self.respond = respond
+
 
 # Classe Servidor para gerenciar as operações do servidor
 class Servidor:
-    def __init__(self, sckt_family, sckt_type, sckt_binding, max_buffer):
+    def __init__(self, sckt_family, sckt_type, sckt_binding, max_buffer, shard=0, shards=1):
+        if PROFILE:
+            # Antes de tudo: o AsyncRDT e a tabela de despacho já pegam os métodos cronometrados
+            PROFILER.start(globals(), FUNCTION_SPANS)
+            PROFILER.instrument(self, SERVER_SPANS)
         self.sckt = skt.socket(sckt_family, sckt_type)  # Cria o socket
+        if shards > 1:
+            self.sckt.setsockopt(skt.SOL_SOCKET, skt.SO_REUSEPORT, 1)  # Todos os processos na mesma porta
         self.sckt.bind(sckt_binding)  # Vincula o socket ao endereço fornecido
-        self.rdt = RDT(self.sckt, max_buffer)  # Instancia a classe RDT
+        self.sckt.setblocking(False)  # Quem lê o socket é o laço de eventos
+        try:
+            self.sckt.setsockopt(skt.SOL_SOCKET, skt.SO_RCVBUF, RCVBUF_SIZE)
+        except OSError:
+            pass  # O SO pode limitar o valor (net.core.rmem_max no Linux)
+        self.metrics = Metricas()
+        # Cada mensagem nova cai no handle_message; a sessão de quem está logado não sai da tabela por estar parada
+        self.rdt = AsyncRDT(max_buffer, self.handle_message, self.metrics, self.session_expired, lambda addr: addr in self.users)
         self.users = {}  # Dicionário para armazenar usuários
         self.accommodations = {}  # Dicionário para armazenar acomodações
         self.reservations = {}  # Dicionário para armazenar reservas
-        self.send_count = 0  # Contador de envios
-
-    def handle_client(self):
-        # Lida com as mensagens do cliente
-        msg, client_addr = self.rdt.receive()  # Recebe mensagem do cliente
-        # print("Entrou na função do switch")
-        msg = msg.decode('utf-8')  # Decodifica a mensagem recebida
-        parts = msg.split()  # Divide a mensagem em partes
-        print(f"Mensagem recebida de {client_addr}: {msg}")
-        print(f"parts é {parts[0]}")
-
-        # Switch case para entrada nos comandos certos
-        if parts[0] == "login":
-            # print("Entrou no login do switch")
-            self.login(msg, client_addr)  # Chama o método login
-        elif parts[0] == "logout":
-            self.logout(client_addr)  # Chama o método logout
-        elif parts[0] == "create":
-            self.create_accommodation(msg, client_addr)  # Chama o método create_accommodation
-        elif parts[0] == "list:myacmd":
-            self.list_my_accommodations(client_addr)  # Chama o método list_my_accommodations
-        elif parts[0] == "list:acmd":
-            self.list_accommodations(client_addr)  # Chama o método list_accommodations
-        elif parts[0] == "list:myrsv":
-            self.list_my_reservations(client_addr)  # Chama o método list_my_reservations
-        elif parts[0] == "book":
-            self.book_accommodation(msg, client_addr)  # Chama o método book_accommodation
-        elif parts[0] == "cancel":
-            self.cancel_reservation(msg, client_addr)  # Chama o método cancel_reservation
+        # Índices mantidos junto com os dicionários acima, para os comandos custarem o tamanho da
+        # resposta e não o total de dados (dict como conjunto ordenado: chave -> None)
+        self.user_addrs = {}  # Nome de usuário -> endereço, só de quem está online
+        self.owner_accommodations = {}  # Dono -> {(nome, local): None}
+        self.user_reservations = {}  # Usuário -> {(nome, local, dia): None}
+        self.location_accommodations = {}  # Local -> {(nome, local): None}, para a busca
+        # Versão do catálogo, que só cresce, e a última versão em que cada acomodação mudou (criada,
+        # reservada ou cancelada), na ordem das mudanças: o list:since devolve só o que mudou
+        self.catalogue_version = 0
+        self.catalogue_changes = {}  # (nome, local) -> versão da última mudança
+        self.journaled = False  # O pedido atual gravou no diário: respostas e avisos esperam o fsync
+        self.view = None  # (versão do catálogo, cópia rasa das acomodações) para as leituras em thread
+        self.readers = concurrent.futures.ThreadPoolExecutor(max_workers=READ_THREADS)
+        self.shard = shard  # Este processo e o total deles
+        self.shards = shards
+        self.ring = shard_ring(shards)
+        self.ring_points = [point for point, _ in self.ring]
+        self.peer_socks = {}  # Shard -> socket local para ele (entregues pelo run_workers antes do serve)
+        self.peers = {}  # Shard -> StreamWriter
+        self.peer_tasks = []
+        self.calls = {}  # ID da chamada a outro shard -> (shard, callback, failed, temporizador do prazo)
+        self.call_ids = itertools.count(1)
+        self.registry = {}  # Nomes em uso em todos os processos cujo shard é este (nome -> None)
+        self.seen = {}  # Endereço -> (versão, versão de cada shard) do último list:since, com shards
+        state_dir = os.path.join(STATE_DIR, f"shard{shard}") if STATE_DIR and shards > 1 else STATE_DIR
+        self.journal = Diario(state_dir, self.dump_state, self.metrics, self.journal_broken) if state_dir else None
+        if self.journal is not None:
+            self.restore()
+        self.notifier = Notificador(self.rdt, self.users, self.metrics)  # Avisos saem em segundo plano, sem segurar o pedido
+        self.profile_file = f"{PROFILE_FILE}.{shard}" if shards > 1 else PROFILE_FILE
+        if PROFILE:
+            PROFILER.instrument(self.rdt, RDT_SPANS)
+            PROFILER.instrument(self.notifier, NOTIFIER_SPANS)
+            if self.journal is not None:
+                PROFILER.instrument(self.journal, JOURNAL_SPANS)
+        self.request = None  # (endereço, prefixo do ID) do pedido sendo tratado, para o reply
+        self.answered = False  # O pedido atual já recebeu resposta
+        # Histograma do tempo de cada comando, da chegada até a resposta sair (depois do fsync, se
+        # gravou no diário, ou da volta dos outros shards), e o (histograma, início) do pedido atual
+        self.command_metrics = {opcode: f'command_seconds{{command="{name}"}}' for opcode, (name, _) in COMMANDS.items()}
+        self.command_metrics[None] = 'command_seconds{command="desconhecido"}'
+        self.started = None
+        self.metrics_file = f"{METRICS_FILE}.{shard}" if METRICS_FILE and shards > 1 else METRICS_FILE
+        self.metrics_timer = None
+        self.stopped = None  # Future que o serve espera; o stop termina ele
+        self.metrics.gauge('users_online', lambda: len(self.user_addrs))
+        self.metrics.gauge('accommodations', lambda: len(self.accommodations))
+        self.metrics.gauge('reservations', lambda: len(self.reservations))
+        self.metrics.gauge('catalogue_version', lambda: self.catalogue_version)
+        # Tabela de despacho: opcode -> (tratador, resposta quando faltam argumentos em texto)
+        self.handlers = {
+            OP_LOGIN: (self.login, b"Argumentos insuficientes para login."),
+            OP_LOGOUT: (self.logout, None),
+            OP_CREATE: (self.create_accommodation, b"Argumentos insuficientes para criar acomodacao."),
+            OP_LIST_MYACMD: (self.list_my_accommodations, None),
+            OP_LIST_ACMD: (self.list_accommodations, None),
+            OP_LIST_MYRSV: (self.list_my_reservations, None),
+            OP_BOOK: (self.book_accommodation, b"Argumentos insuficientes para reservar acomodacao."),
+            OP_CANCEL: (self.cancel_reservation, b"Argumentos insuficientes para cancelar reserva."),
+            OP_SEARCH: (self.search_accommodations, b"Argumentos insuficientes para buscar acomodacao."),
+            OP_LIST_SINCE: (self.list_since, None),
+            OP_STATS: (self.stats, None),
+        }
+
+    async def serve(self):
+        # Entrega o socket ao laço de eventos e roda até ser cancelado (Ctrl+C)
+        loop = asyncio.get_running_loop()
+        if PROFILE and hasattr(loop, '_selector'):
+            # Tempo parado no select/epoll do laço. O _selector é um detalhe interno do laço do CPython
+            # (asyncio puro); com outro laço (uvloop, ou o proactor do Windows) esse span só não aparece
+            PROFILER.instrument(loop._selector, SELECTOR_SPANS)
+        for peer, sock in self.peer_socks.items():  # Os outros shards antes dos clientes
+            reader, self.peers[peer] = await asyncio.open_connection(sock=sock)
+            self.peer_tasks.append(asyncio.create_task(self.read_peer(peer, reader)))
+        transport, _ = await loop.create_datagram_endpoint(lambda: self.rdt, sock=self.sckt)
+        if self.metrics_file:
+            self.dump_metrics()
+        self.stopped = loop.create_future()
+        try:
+            await self.stopped  # Só termina cancelado (Ctrl+C) ou pelo journal_broken
+        finally:
+            transport.close()
+            if self.metrics_timer is not None:
+                self.metrics_timer.cancel()
+                write_metrics(self.metrics_file, self.metrics.snapshot())  # Os números finais
+            for writer in self.peers.values():
+                writer.close()
+            self.readers.shutdown(wait=False)
+            if self.journal is not None:
+                self.journal.close()
+            if PROFILE:
+                PROFILER.dump(self.profile_file)
+
+    def journal_broken(self):
+        # O diário não grava mais e a memória tem mudanças que o disco não tem: depois de dar tempo das
+        # respostas de erro saírem, o servidor para; ao ser iniciado de novo, o estado é o do disco
+        log('aviso', "Servidor parando em %.0fs por erro no diário", JOURNAL_STOP_DELAY)
+        asyncio.get_running_loop().call_later(JOURNAL_STOP_DELAY, self.stop)
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def dump_state(self):
+        # Tudo o que sobrevive a um reinício (os usuários online não: eles logam de novo), como cópias
+        # que a thread de escrita pode serializar enquanto o laço segue mudando o estado: os valores
+        # das acomodações e reservas não mudam no lugar, os índices (dict de dicts) são copiados
+        return {
+            'accommodations': dict(self.accommodations),
+            'reservations': dict(self.reservations),
+            'owner_accommodations': {user: dict(keys) for user, keys in self.owner_accommodations.items()},
+            'user_reservations': {user: dict(keys) for user, keys in self.user_reservations.items()},
+            'location_accommodations': {loc: dict(keys) for loc, keys in self.location_accommodations.items()},
+            'catalogue_version': self.catalogue_version,
+            'catalogue_changes': dict(self.catalogue_changes),
+        }
+
+    def dump_metrics(self):
+        # Regrava o arquivo de métricas e marca a próxima gravação
+        write_metrics(self.metrics_file, self.metrics.snapshot())
+        self.metrics_timer = asyncio.get_running_loop().call_later(METRICS_EVERY, self.dump_metrics)
+
+    def read_view(self):
+        # Cópia rasa do catálogo para as threads de leitura, refeita só quando o catálogo muda
+        if self.view is None or self.view[0] != self.catalogue_version:
+            self.view = (self.catalogue_version, dict(self.accommodations))
+        return self.view[1]
+
+    def reply_later(self, addr):
+        # Função que responde ao pedido atual depois, fora do handle_message: o ID do pedido é
+        # guardado agora e o pedido já conta como respondido
+        prefix = self.request[1] if self.request is not None and self.request[0] == addr else b""
+        self.answered = True
+        started = self.started
+        return lambda data: self.deliver(addr, prefix + data, started)
+
+    def reply_async(self, addr, function, *args):
+        # Resposta montada numa thread de leitura (function devolve os bytes); o envio volta para o
+        # laço de eventos quando ela fica pronta. Se a thread falhar, é como um tratador que falhou no
+        # laço: conta o erro e o pedido com ID recebe a resposta vazia
+        tagged = self.request is not None and self.request[0] == addr
+        send = self.reply_later(addr)
+        if PROFILE:
+            function = PROFILER.wrap('leitura', function)
+
+        def done(future):
+            if future.cancelled():
+                return  # Servidor parando
+            if future.exception() is None:
+                send(future.result())
+                return
+            self.metrics.add('handler_errors_total')
+            log('aviso', "Erro montando a resposta para %s: %r", addr, future.exception())
+            if tagged:
+                send(b"")
+        future = asyncio.get_running_loop().run_in_executor(self.readers, function, *args)
+        future.add_done_callback(done)
+
+    def deliver(self, addr, data, started=None):
+        if isinstance(addr, Proxy):
+            addr.respond(data)  # Cliente de outro shard: a resposta volta por ele
+        else:
+            self.rdt.send(addr, data)
+        if started is not None:
+            self.metrics.observe(started[0], time.perf_counter() - started[1])
+
+    def shard_of(self, *key):
+        # Shard dono de uma chave ((nome, local) de uma acomodação, ou um nome de usuário) no anel
+        if self.shards == 1:
+            return 0
+        point = zlib.crc32('\x00'.join(key).encode('utf-8'))
+        return self.ring[bisect.bisect(self.ring_points, point) % len(self.ring)][1]
+
+    async def read_peer(self, peer, reader):
+        # Mensagens de outro shard: tamanho e pickle de uma tupla cujo primeiro item diz o tipo
+        try:
+            while True:
+                size, = PEER_FRAME.unpack(await reader.readexactly(PEER_FRAME.size))
+                message = pickle.loads(await reader.readexactly(size))
+                try:
+                    self.peer_message(peer, message)
+                except Exception as e:
+                    log('aviso', "Erro na mensagem do shard %s: %r", peer, e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log('aviso', "Shard %s desconectou", peer)
+        # Sem o outro lado: as chamadas pendentes para ele falham agora e as próximas falham na hora
+        self.peers.pop(peer).close()
+        for call_id in [call_id for call_id, call in self.calls.items() if call[0] == peer]:
+            self.fail_call(call_id)
+
+    def send_peer(self, peer, message):
+        writer = self.peers.get(peer)
+        if writer is None:
+            return  # Shard fora do ar (quem chamou fica sabendo pelo fail_call)
+        body = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        writer.write(PEER_FRAME.pack(len(body)) + body)
+
+    def peer_message(self, peer, message):
+        kind = message[0]
+        if kind == 'call':  # ('call', ID, método, argumentos): roda o remote_<método> e devolve o resultado
+            _, call_id, method, args = message
+            getattr(self, 'remote_' + method)(lambda result: self.send_peer(peer, ('result', call_id, result)), *args)
+        elif kind == 'result':  # ('result', ID, resultado) de uma chamada nossa
+            call = self.calls.pop(message[1], None)
+            if call is not None:  # Depois do prazo quem chamou já respondeu com erro
+                call[3].cancel()
+                call[1](message[2])
+        elif kind == 'notify':  # ('notify', usuário, aviso): entrega se o usuário estiver online aqui
+            addr = self.user_addrs.get(message[1])
+            if addr is not None:
+                self.notifier.notify(addr, message[2])
+        elif kind == 'broadcast':  # ('broadcast', aviso, endereço que não recebe)
+            self.notifier.broadcast(message[1], message[2])
+
+    def call_shard(self, shard, method, args, callback, failed):
+        # Chama remote_<método> no shard (direto, se for este) e passa o resultado ao callback; se o
+        # shard caiu ou não devolve nada em PEER_TIMEOUT, chama o failed no lugar
+        if shard == self.shard:
+            getattr(self, 'remote_' + method)(callback, *args)
+            return
+        if shard not in self.peers:
+            self.metrics.add('peer_call_failures_total')
+            failed()
+            return
+        call_id = next(self.call_ids)
+        timer = asyncio.get_running_loop().call_later(PEER_TIMEOUT, self.fail_call, call_id)
+        self.calls[call_id] = (shard, callback, failed, timer)
+        self.send_peer(shard, ('call', call_id, method, args))
+
+    def fail_call(self, call_id):
+        call = self.calls.pop(call_id, None)
+        if call is not None:
+            call[3].cancel()
+            self.metrics.add('peer_call_failures_total')
+            log('aviso', "Shard %s não respondeu a tempo", call[0])
+            call[2]()
+
+    def gather(self, method, args, finish, failed):
+        # Chama o método em todos os shards (args de cada um, em ordem) e passa ao finish a lista
+        # dos resultados, na ordem dos shards, quando o último chegar; se algum falhar, só o failed
+        results = [None] * self.shards
+        pending = [self.shards]
+
+        def done(shard, result):
+            results[shard] = result
+            pending[0] -= 1
+            if not pending[0]:
+                finish(results)
+
+        def fail():
+            if pending[0] > 0:
+                pending[0] = -1  # Os resultados que ainda chegarem são ignorados
+                failed()
+        for shard in range(self.shards):
+            self.call_shard(shard, method, args[shard], lambda result, shard=shard: done(shard, result), fail)
+
+    def forward(self, addr, opcode, key, args):
+        # Comando que muda uma acomodação de outro shard: roda lá, e a resposta (que só vem depois do
+        # fsync de lá) volta para cá. Devolve False se a acomodação é deste shard
+        shard = self.shard_of(*key)
+        if shard == self.shard:
+            return False
+        user = self.users[addr]
+        send = self.reply_later(addr)
+        self.call_shard(shard, 'command', (opcode, args, user, addr), send, lambda: send(PEER_ERROR))
+        return True
+
+    def remote_command(self, respond, opcode, args, user, client_addr):
+        # Comando de um cliente de outro shard, com o Proxy no lugar do endereço
+        proxy = Proxy(client_addr, respond)
+        self.users[proxy] = user
+        self.request = (proxy, b"")
+        self.answered = False
+        self.journaled = False
+        try:
+            self.handlers[opcode][0](proxy, *args)
+        finally:
+            if not self.answered:
+                self.reply(proxy, b"")
+            del self.users[proxy]
+            self.request = None
+            self.journaled = False
+
+    def remote_stats(self, respond):
+        respond(self.metrics.snapshot())
+
+    def remote_lines(self, respond, method, *args):
+        respond(getattr(self, 'lines_' + method)(*args))
+
+    def remote_claim(self, respond, username):
+        # Reserva o nome de usuário para quem está logando em algum processo (True se estava livre)
+        free = username not in self.registry
+        self.registry[username] = None
+        respond(free)
+
+    def remote_release(self, respond, username):
+        self.registry.pop(username, None)
+        respond(None)
+
+    def gather_page(self, addr, opcode, method, offset, limit, *args):
+        # Listagem paginada com shards: cada shard devolve suas primeiras linhas (até o fim da página
+        # pedida) e a página sai da concatenação, na ordem dos shards
+        send = self.reply_later(addr)
+        count = offset + limit + 1 if limit else 0
+
+        def finish(results):
+            lines = [line for result in results for line in result]
+            if limit:
+                lines = lines[offset:offset + limit + 1]
+                if len(lines) > limit:
+                    lines[limit:] = [more_results(opcode, offset, limit)]
+            send('\n'.join(lines).encode('utf-8'))
+        self.gather('lines', [(method, count) + args] * self.shards, finish, lambda: send(PEER_ERROR))
+
+    def restore(self):
+        # Carrega o último snapshot e repete só os registros do diário gravados depois dele. Sem o
+        # coletor de ciclos durante a carga: com milhões de objetos novos ele rodaria várias vezes à toa
+        gc.disable()
+        try:
+            state, records = self.journal.load()
+            if state is not None:
+                for name, value in state.items():
+                    if name != 'generation':
+                        setattr(self, name, value)
+            replay = {OP_CREATE: self.apply_create, OP_BOOK: self.apply_book, OP_CANCEL: self.apply_cancel}
+            for opcode, args in records:
+                replay[opcode](*args)
+        finally:
+            gc.enable()
+        log('info', "Estado restaurado: %d acomodações, %d reservas", len(self.accommodations), len(self.reservations))
+
+    def append_journal(self, opcode, *args):
+        if self.journal is not None:
+            self.journal.append(encode_record(opcode, *args))
+            self.journaled = True
+
+    def after_commit(self, function, *args, failure=None):
+        # Depois de uma mudança, o cliente só fica sabendo quando ela já está no disco; se ela não
+        # chegar lá, roda o failure (ou nada, para os avisos) no lugar
+        if self.journaled:
+            self.journal.defer(failure, function, *args)
         else:
-            print("Comando desconhecido:", parts[0])  # Mensagem para comando desconhecido
-        if(self.send_count % 2 == 0):
-            self.rdt.send(client_addr, b"")  # Envia pacote vazio para sincronização de ACK
-        self.send_count = 0  # Reseta contador de envios
-
-    def login(self, msg, addr):
-        _, username = msg.split()  # Divide a mensagem recebida
-        if username in self.users.values():  # Verifica se o nome de usuário já existe
-            self.rdt.send(addr, b"Nome de usuario ja esta em uso.")
-            self.send_count += 1
+            function(*args)
+
+    def handle_message(self, msg, client_addr):
+        # Lida com as mensagens do cliente (chamado pelo AsyncRDT para cada mensagem nova): decodifica
+        # uma vez, valida pelo esquema do comando e chama o tratador pela tabela de despacho
+        self.request = None
+        if msg and msg[0] == BINARY_MARK:
+            try:
+                opcode, request_id, args = decode_binary(msg)
+            except (KeyError, ValueError, struct.error):
+                self.metrics.add('invalid_commands_total')
+                log('aviso', "Comando binário inválido de %s", client_addr)
+                return
+            if request_id:
+                # Pedido com ID: a resposta leva o mesmo prefixo, e o cliente pode ter vários pendentes
+                self.request = (client_addr, f"{REQUEST_TAG}{request_id} ".encode('utf-8'))
+        else:
+            msg = msg.decode('utf-8')  # Decodifica a mensagem recebida
+            parts = msg.split()  # Divide a mensagem em partes
+            if parts and parts[0].startswith(REQUEST_TAG):
+                self.request = (client_addr, f"{parts.pop(0)} ".encode('utf-8'))
+            opcode, args = decode_text(parts) if parts and parts[0] in TEXT_COMMANDS else (None, ())
+        name = COMMANDS[opcode][0] if opcode else (parts[0] if parts else "")
+        log('debug', "Mensagem recebida de %s: %s %s", client_addr, name, args)
+
+        self.answered = False
+        self.journaled = False
+        self.started = (self.command_metrics[opcode], time.perf_counter())
+        try:
+            if opcode is None:
+                self.metrics.add('invalid_commands_total')
+                log('aviso', "Comando desconhecido: %s", name)  # Mensagem para comando desconhecido
+                self.reply(client_addr, b"Comando desconhecido.")
+            elif args is None:
+                self.reply(client_addr, self.handlers[opcode][1])  # Faltam argumentos
+            else:
+                self.handlers[opcode][0](client_addr, *args)
+        finally:
+            if self.request is not None and not self.answered:
+                self.reply(client_addr, b"")  # Todo pedido com ID recebe resposta, mesmo vazia
+            self.request = None
+            self.journaled = False
+            self.started = None
+
+    def reply(self, addr, data):
+        # Resposta ao cliente que fez o pedido atual, com o ID dele se o pedido tinha um
+        prefix = b""
+        if self.request is not None and self.request[0] == addr:
+            prefix = self.request[1]
+            self.answered = True
+        started = self.started
+        self.after_commit(self.deliver, addr, prefix + data, started,
+                          failure=lambda: self.deliver(addr, prefix + JOURNAL_ERROR, started))
+
+    def login(self, addr, username):
+        if username.startswith(REQUEST_TAG):  # Um aviso começando com o nome seria lido como resposta
+            self.reply(addr, b"Nome de usuario invalido.")
+        elif username in self.user_addrs:  # Verifica se o nome de usuário já existe
+            self.reply(addr, b"Nome de usuario ja esta em uso.")
+        elif self.shards > 1:
+            # O nome pode estar em uso em outro processo: quem sabe é o shard do nome
+            send = self.reply_later(addr)
+
+            def claimed(free):
+                if free:
+                    self.sign_in(addr, username)
+                    send(b"Voce esta online!")
+                else:
+                    send(b"Nome de usuario ja esta em uso.")
+            self.call_shard(self.shard_of(username), 'claim', (username,), claimed, lambda: send(PEER_ERROR))
         else:  # Se não, adiciona o endereço e nome do cliente na lista de usuários
-            self.users[addr] = username
-            self.rdt.send(addr, b"Voce esta online!")  # Mensagem de confirmação de login
-            self.send_count += 1
-            print(f"{username} logou com sucesso em {addr}")
-            print(f"lista de usuarios: {self.users}")
+            self.sign_in(addr, username)
+            self.reply(addr, b"Voce esta online!")  # Mensagem de confirmação de login
+
+    def sign_in(self, addr, username):
+        if addr in self.users:
+            self.release(self.users[addr])  # Mesmo endereço trocando de nome
+        self.users[addr] = username
+        self.user_addrs[username] = addr
+        log('debug', "%s logou com sucesso em %s", username, addr)
+
+    def release(self, username):
+        del self.user_addrs[username]
+        if self.shards > 1:
+            self.call_shard(self.shard_of(username), 'release', (username,), lambda result: None, lambda: None)
 
     def logout(self, addr):
         if addr in self.users:  # Verifica se o endereço está na lista de usuários
-            username = self.users.pop(addr)  # Remove o usuário da lista
-            self.rdt.send(addr, b"Logout bem-sucedido.")  # Mensagem de confirmação de logout
-            self.send_count += 1
-            print(f"{username} deslogou de {addr}")
+            username = self.sign_out(addr)
+            self.reply(addr, b"Logout bem-sucedido.")  # Mensagem de confirmação de logout
+            self.rdt.close(addr)  # A sessão sai da tabela quando o cliente confirmar a resposta
+            log('debug', "%s deslogou de %s", username, addr)
 
-    def create_accommodation(self, msg, addr):
-        parts = msg.split()  # Divide a mensagem recebida
-        if len(parts) < 4:  # Verifica se há argumentos suficientes
-            self.rdt.send(addr, b"Argumentos insuficientes para criar acomodacao.")
-            self.send_count += 1
-            return
+    def sign_out(self, addr):
+        # Tira o usuário do endereço de tudo (nome, índices, avisos pendentes) e devolve o nome
+        username = self.users.pop(addr)  # Remove o usuário da lista
+        self.release(username)
+        self.seen.pop(addr, None)
+        self.notifier.forget(addr)
+        return username
+
+    def session_expired(self, addr):
+        # O RDT desistiu do cliente: sai como num logout, sem resposta, e o nome fica livre de novo
+        if addr in self.users:
+            log('info', "%s parou de responder em %s e foi deslogado", self.sign_out(addr), addr)
 
-        # Atribui as partes da mensagem às variáveis da acomodação
-        _, name, location, description = parts[0], parts[1], parts[2], ' '.join(parts[3:])
+    def create_accommodation(self, addr, name, location, description):
+        if self.forward(addr, OP_CREATE, (name, location), (name, location, description)):
+            return  # A acomodação é de outro shard
         user = self.users[addr]  # Pega o nome do usuário que está criando a acomodação
         key = (name, location)  # Cria uma chave única para a acomodação
         if key in self.accommodations:  # Verifica se a acomodação já existe
-            self.rdt.send(addr, b"Acomodacao ja existe.")  # Mensagem de erro
-            self.send_count += 1
+            self.reply(addr, b"Acomodacao ja existe.")  # Mensagem de erro
         else:
-            self.accommodations[key] = {  # Adiciona a nova acomodação
-                'owner': user,
-                'location': location,
-                'description': description,
-                'availability': [f"{i:02d}/07/2024" for i in range(17, 23)]  # Dias disponíveis
-            }
-            print(f"acomodacao criada {self.accommodations[key]}")
-            self.rdt.send(addr, f"Acomodação {name} criada com sucesso!".encode('utf-8'))  # Mensagem de sucesso
-            self.send_count += 1
+            self.apply_create(user, name, location, description)
+            self.append_journal(OP_CREATE, user, name, location, description)
+            log('debug', "acomodacao criada %s em %s por %s", name, location, user)
+            self.reply(addr, f"Acomodação {name} criada com sucesso!".encode('utf-8'))  # Mensagem de sucesso
             self.notify_all_users(f"{user} criou a acomodação {name} em {location}.", exclude_addr=addr)  # Notifica todos os usuários
 
-    def list_my_accommodations(self, addr):
+    def apply_create(self, user, name, location, description):
+        # A mudança de estado do create, sem validação nem mensagens (também usada ao repetir o diário)
+        key = (name, location)
+        self.accommodations[key] = {  # Adiciona a nova acomodação
+            'owner': user,
+            'location': location,
+            'description': description,
+            'availability': (1 << CALENDAR_DAYS) - 1  # Dias disponíveis: bit i = i dias depois de CALENDAR_START
+        }
+        self.owner_accommodations.setdefault(user, {})[key] = None
+        self.location_accommodations.setdefault(location, {})[key] = None
+        self.touch(key)
+
+    def list_my_accommodations(self, addr, offset, limit):
         user = self.users[addr]  # Pega o nome do usuário
+        if self.shards > 1:
+            self.gather_page(addr, OP_LIST_MYACMD, 'myacmd', offset, limit, user)
+            return
 
-        # Cria uma lista das acomodações do usuário
-        user_accommodations = [f"{name} em {loc}: {data}" for (name, loc), data in self.accommodations.items() if data['owner'] == user]
+        # Cria uma lista das acomodações do usuário (pelo índice de donos, sem varrer todas)
+        keys = self.paginate(self.owner_accommodations.get(user, ()), OP_LIST_MYACMD, offset, limit)
         # Converte a lista em uma string e envia para o cliente
-        self.rdt.send(addr, '\n'.join(user_accommodations).encode('utf-8'))
-        self.send_count += 1
+        self.reply(addr, format_accommodations(self.accommodations, keys))
 
-    def list_accommodations(self, addr):
+    def list_accommodations(self, addr, offset, limit):
         # Cria uma lista com todas as acomodações disponíveis
-        all_accommodations = [f"{name} em {loc}: {data}" for (name, loc), data in self.accommodations.items()]
+        if self.shards > 1:
+            self.gather_page(addr, OP_LIST_ACMD, 'acmd', offset, limit)
+            return
+        if not limit and len(self.accommodations) >= READ_OFFLOAD_MIN:
+            self.reply_async(addr, format_accommodations, self.read_view())  # Catálogo grande: fora do laço
+            return
+        keys = self.paginate(self.accommodations, OP_LIST_ACMD, offset, limit)
         # Converte a lista em uma string e envia para o cliente
-        self.rdt.send(addr, '\n'.join(all_accommodations).encode('utf-8'))
-        self.send_count += 1
+        self.reply(addr, format_accommodations(self.accommodations, keys))
+
+    def list_since(self, addr, version):
+        # list:since <versão>: primeira linha "versao <atual>" e depois só as acomodações que mudaram
+        # desde a versão que o cliente já tem (todas se ele não tem nenhuma). Sem mudanças a resposta
+        # é só a primeira linha. Uma versão que o servidor ainda não teve (ele reiniciou) recebe o
+        # catálogo inteiro, com "completa" na primeira linha para o cliente descartar a cópia
+        if self.shards > 1:
+            self.gather_since(addr, version)
+            return
+        header = f"versao {self.catalogue_version}"
+        if version > self.catalogue_version:
+            version = 0
+            header += " completa"
+        if version == 0:
+            # Tudo, na ordem de criação (a mesma do list:acmd); grande, sai do laço como o list:acmd
+            if len(self.accommodations) >= READ_OFFLOAD_MIN:
+                self.reply_async(addr, format_accommodations, self.read_view(), None, header)
+            else:
+                self.reply(addr, format_accommodations(self.accommodations, None, header))
+            return
+        self.reply(addr, format_accommodations(self.accommodations, self.changed_since(version), header))
+
+    def changed_since(self, version):
+        # Acomodações que mudaram depois da versão, na ordem das mudanças
+        changed = []
+        if version < self.catalogue_version:
+            for key, changed_at in reversed(self.catalogue_changes.items()):
+                if changed_at <= version:
+                    break  # Daqui para trás o cliente já tem
+                changed.append(key)
+            changed.reverse()
+        return changed
+
+    def gather_since(self, addr, version):
+        # list:since com shards: cada shard tem a sua versão, e a do cliente é a soma delas. O shard que
+        # atende guarda as versões de cada shard da última resposta ao cliente; se a versão que ele
+        # manda não é essa soma, a resposta é o catálogo inteiro ("completa" se ele tinha alguma)
+        seen = self.seen.get(addr)
+        complete = version != 0 and (seen is None or seen[0] != version)
+        versions = seen[1] if version and not complete else [0] * self.shards
+        send = self.reply_later(addr)
 
-    def list_my_reservations(self, addr):
+        def finish(results):
+            total = sum(current for current, _ in results)
+            self.seen[addr] = (total, [current for current, _ in results])
+            lines = [f"versao {total}" + (" completa" if complete else "")]
+            lines.extend(line for _, result in results for line in result)
+            send('\n'.join(lines).encode('utf-8'))
+        self.gather('lines', [('since', shard_version) for shard_version in versions], finish, lambda: send(PEER_ERROR))
+
+    def lines_acmd(self, count):
+        # Linhas deste shard para as leituras espalhadas (count = quantas no máximo, 0 = todas)
+        keys = itertools.islice(self.accommodations, count) if count else None
+        return accommodation_lines(self.accommodations, keys)
+
+    def lines_myacmd(self, count, user):
+        keys = self.owner_accommodations.get(user, ())
+        return accommodation_lines(self.accommodations, itertools.islice(keys, count) if count else keys)
+
+    def lines_myrsv(self, count, user):
+        keys = self.user_reservations.get(user, ())
+        return reservation_lines(itertools.islice(keys, count) if count else keys)
+
+    def lines_search(self, location, mask):
+        results = []
+        for name, loc in self.location_accommodations.get(location, ()):
+            free = self.accommodations[(name, loc)]['availability'] & mask
+            if free:
+                results.append(f"{name} em {loc}: livre em {', '.join(calendar_days(free))}")
+        return results
+
+    def lines_since(self, version):
+        # (versão deste shard, linhas do que mudou desde a versão dele que o cliente tem)
+        if version > self.catalogue_version:
+            version = 0
+        keys = self.changed_since(version) if version else None
+        return self.catalogue_version, accommodation_lines(self.accommodations, keys)
+
+    def touch(self, key):
+        # Marca a acomodação como mudada na versão nova (vai para o fim da ordem de mudanças)
+        self.catalogue_version += 1
+        self.catalogue_changes.pop(key, None)
+        self.catalogue_changes[key] = self.catalogue_version
+
+    def list_my_reservations(self, addr, offset, limit):
         # Pega o nome do usuário
         user = self.users[addr]
-        # Cria uma lista de reservas feitas pelo usuário
-        user_reservations = [f"Reservado {name} em {loc} no dia {day}" for (name, loc, day), res in self.reservations.items() if res['user'] == user]
+        if self.shards > 1:
+            self.gather_page(addr, OP_LIST_MYRSV, 'myrsv', offset, limit, user)
+            return
+        # Cria uma lista de reservas feitas pelo usuário (pelo índice de reservas por usuário)
+        keys = self.paginate(self.user_reservations.get(user, ()), OP_LIST_MYRSV, offset, limit, width=3)
         # Converte a lista em uma string e envia para o cliente
-        self.rdt.send(addr, '\n'.join(user_reservations).encode('utf-8'))
-        self.send_count += 1
-
-    def book_accommodation(self, msg, addr):
-        parts = msg.split()  # Divide a mensagem em partes
-        if len(parts) < 5:
-            self.rdt.send(addr, b"Argumentos insuficientes para reservar acomodacao.")  # Mensagem de erro
-            self.send_count += 1
-            return  # Não continua na reserva
-        _, owner, name, location, day = parts  # Atribui as partes da mensagem às variáveis
+        self.reply(addr, '\n'.join(reservation_lines(keys)).encode('utf-8'))
+
+    def paginate(self, keys, opcode, offset, limit, width=2):
+        # list:... <offset> <limite>: só as chaves da página pedida (as outras nem são formatadas) e,
+        # se houver mais, uma chave final que vira a linha dizendo como pedir a próxima página
+        if not limit:
+            return list(keys)  # Sem paginação: a lista inteira, fragmentada pelo RDT se precisar
+        page = list(itertools.islice(keys, offset, offset + limit + 1))
+        if len(page) > limit:
+            page[limit:] = [(more_results(opcode, offset, limit),) + (None,) * (width - 1)]
+        return page
+
+    def book_accommodation(self, addr, owner, name, location, ordinal):
+        if self.forward(addr, OP_BOOK, (name, location), (owner, name, location, ordinal)):
+            return
         key = (name, location)  # Cria chave única para a acomodação
         if key not in self.accommodations:  # Verifica se a acomodação existe
-            self.rdt.send(addr, b"Acomodacao nao encontrada.")  # Mensagem de erro
-            self.send_count += 1
+            self.reply(addr, b"Acomodacao nao encontrada.")  # Mensagem de erro
             return  # Não continua na reserva
-        if day not in self.accommodations[key]['availability']:  # Verifica se o dia está disponível
-            self.rdt.send(addr, b"Dia indisponivel.")  # Mensagem de erro
-            self.send_count += 1
+        if ordinal is None or ordinal < 0 or not self.accommodations[key]['availability'] >> ordinal & 1:  # Verifica se o dia está disponível
+            self.reply(addr, b"Dia indisponivel.")  # Mensagem de erro
             return
         user = self.users[addr]
         if self.accommodations[key]['owner'] == user:  # Verifica se o proprietário está tentando reservar para si mesmo
-            self.rdt.send(addr, b"Voce nao pode reservar sua propria acomodacao.")
-            self.send_count += 1
+            self.reply(addr, b"Voce nao pode reservar sua propria acomodacao.")
             return
-        self.accommodations[key]['availability'].remove(day)  # Remove o dia da disponibilidade
-        self.reservations[(name, location, day)] = {'user': user, 'owner': owner}  # Adiciona a reserva
-        self.rdt.send(addr, f"Reserva confirmada: {name} em {location} no dia {day}".encode('utf-8'))  # Mensagem de confirmação
-        self.send_count += 1
+        day = self.apply_book(user, owner, name, location, ordinal)
+        self.append_journal(OP_BOOK, user, owner, name, location, ordinal)
+        self.reply(addr, f"Reserva confirmada: {name} em {location} no dia {day}".encode('utf-8'))  # Mensagem de confirmação
         self.notify_user(owner, f"{user} reservou sua acomodação {name} em {location} no dia {day}")
-        self.send_count += 1
-
-    def cancel_reservation(self, msg, addr):
-        parts = msg.split()
-        if len(parts) < 4: # Verifica se há a quantidade necessária de argumentos
-            self.rdt.send(addr, b"Argumentos insuficientes para cancelar reserva.")
-            self.send_count += 1
-            return # Se não houver retorna um erro
-        _, owner, name, location, day = parts
+
+    def apply_book(self, user, owner, name, location, ordinal):
+        key = (name, location)
+        day = day_string(ordinal)  # Texto do dia nas chaves e nas mensagens, igual para texto e binário
+        data = self.accommodations[key]  # Troca o dict em vez de mudar: quem tem uma cópia do catálogo não vê a mudança
+        self.accommodations[key] = {**data, 'availability': data['availability'] & ~(1 << ordinal)}  # Remove o dia da disponibilidade
+        self.touch(key)
+        self.reservations[(name, location, day)] = {'user': user, 'owner': owner}  # Adiciona a reserva
+        self.user_reservations.setdefault(user, {})[(name, location, day)] = None
+        return day
+
+    def cancel_reservation(self, addr, owner, name, location, ordinal):
+        if self.forward(addr, OP_CANCEL, (name, location), (owner, name, location, ordinal)):
+            return
+        day = day_string(ordinal) if ordinal is not None else None
         key = (name, location, day)
         if key not in self.reservations: # Verifica se a reserva existe
-            self.rdt.send(addr, b"Reserva nao encontrada.") # Se ela não existir, envia um erro 
-            self.send_count += 1
+            self.reply(addr, b"Reserva nao encontrada.") # Se ela não existir, envia um erro 
             return
         user = self.users[addr]
         if self.reservations[key]['user'] != user: # Verifica se o usuário que quer cancelar a reserva é o mesmo que fez a reserva
-            self.rdt.send(addr, b"Voce nao pode cancelar uma reserva que nao fez.") # Se não for, retorna um erro
-            self.send_count += 1
+            self.reply(addr, b"Voce nao pode cancelar uma reserva que nao fez.") # Se não for, retorna um erro
             return
-        self.accommodations[(name, location)]['availability'].append(day)  # Adiciona o dia de volta à disponibilidade
-        self.reservations.pop(key)  # Remove a reserva
-        self.rdt.send(addr, f"Reserva cancelada: {name} em {location} no dia {day}".encode('utf-8'))
-        self.send_count += 1
+        self.apply_cancel(user, name, location, ordinal)
+        self.append_journal(OP_CANCEL, user, name, location, ordinal)
+        self.reply(addr, f"Reserva cancelada: {name} em {location} no dia {day}".encode('utf-8'))
         self.notify_user(owner, f"{user} cancelou a reserva da sua acomodação {name} em {location} no dia {day}")
-        self.send_count += 1
         self.notify_all_users(f"Acomodação {name} em {location} agora está disponível no dia {day}", exclude_addr=addr)
 
+    def apply_cancel(self, user, name, location, ordinal):
+        key = (name, location, day_string(ordinal))
+        data = self.accommodations[(name, location)]  # Troca o dict em vez de mudar (cópias do catálogo)
+        self.accommodations[(name, location)] = {**data, 'availability': data['availability'] | 1 << ordinal}  # Adiciona o dia de volta à disponibilidade
+        self.touch((name, location))
+        self.reservations.pop(key)  # Remove a reserva
+        del self.user_reservations[user][key]
+
+    def search_accommodations(self, addr, location, first, last):
+        # search <local> <de> <até>: acomodações do local com algum dia livre no intervalo, e quais dias.
+        # Usa o índice por local e testa o intervalo inteiro de uma vez com uma máscara de bits
+        if first is None or last is None or last < first:
+            self.reply(addr, b"Intervalo de dias invalido.")
+            return
+        # Fora do calendário não há nada livre: o intervalo é cortado nas pontas antes de virar máscara
+        # (um intervalo todo fora dele vira a máscara vazia)
+        mask = day_mask(max(first, 0), min(last, CALENDAR_DAYS - 1))
+        if self.shards > 1:
+            send = self.reply_later(addr)
+            self.gather('lines', [('search', location, mask)] * self.shards, lambda results: send(
+                ('\n'.join(line for result in results for line in result) or "Nenhuma acomodacao disponivel.").encode('utf-8')),
+                lambda: send(PEER_ERROR))
+            return
+        results = self.lines_search(location, mask)
+        self.reply(addr, ('\n'.join(results) or "Nenhuma acomodacao disponivel.").encode('utf-8'))
+
+    def stats(self, addr):
+        # Métricas em texto do Prometheus; com shards, a soma das métricas de todos os processos
+        if self.shards > 1:
+            send = self.reply_later(addr)
+            self.gather('stats', [()] * self.shards, lambda results: send(prometheus_text(merge_snapshots(results)).encode('utf-8')),
+                        lambda: send(PEER_ERROR))
+            return
+        self.reply(addr, prometheus_text(self.metrics.snapshot()).encode('utf-8'))
+
     def notify_user(self, user, message): # Função um usuário específico
-        for addr, username in self.users.items():
-            if username == user:
-                self.rdt.send(addr, message.encode('utf-8'))
-                break
+        addr = self.user_addrs.get(user)
+        if addr is not None:  # Só notifica quem está online
+            self.after_commit(self.notifier.notify, addr, message)
+        elif self.shards > 1:  # Pode estar online em outro processo
+            self.after_commit(self.send_peers, ('notify', user, message))
 
     def notify_all_users(self, message, exclude_addr=None): # Função para notificar todos os usuários (exceto o que ativa a função)
-        for addr in self.users:
-            if addr != exclude_addr: #Não envia nada para o usuário que ativa a função
-                self.send_count += 1
-                self.rdt.send(addr, message.encode('utf-8'))
+        if isinstance(exclude_addr, Proxy):
+            exclude_addr = exclude_addr.client_addr  # O cliente está em outro processo
+        self.after_commit(self.notifier.broadcast, message, exclude_addr)  # Volta na hora: o notificador espalha em segundo plano
+        if self.shards > 1:
+            self.after_commit(self.send_peers, ('broadcast', message, exclude_addr))
+
+    def send_peers(self, message):
+        for peer in self.peers:
+            self.send_peer(peer, message)
+
+def run_worker(shard, shards, links):
+    # Um processo do modo com shards: fica só com as pontas dos pares de sockets que são dele
+    server = Servidor(skt.AF_INET, skt.SOCK_DGRAM, ADDR_BIND, MAX_BUFFER, shard, shards)
+    for (first, second), (first_sock, second_sock) in links.items():
+        if shard in (first, second):
+            peer, sock, other = (second, first_sock, second_sock) if shard == first else (first, second_sock, first_sock)
+            server.peer_socks[peer] = sock
+            other.close()
+        else:
+            first_sock.close()
+            second_sock.close()
+    print(f"Shard {shard} escutando em {ADDR_BIND} (pid {os.getpid()})")
+
+    async def serve():
+        # O SIGTERM do run_workers encerra como o Ctrl+C: o serve fecha o diário antes de sair
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await server.serve()
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def run_workers(count):
+    # Um par de sockets entre cada dois processos, criado antes do fork para todos herdarem
+    links = {(first, second): skt.socketpair() for first in range(count) for second in range(first + 1, count)}
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(shard, count, links)) for shard in range(count)]
+    for worker in workers:
+        worker.start()
+    for sock in itertools.chain.from_iterable(links.values()):
+        sock.close()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Pelo terminal o Ctrl+C também chega aos processos; com kill só neste, o SIGTERM avisa os outros.
+        # Quem não sair a tempo (travado no disco, por exemplo) é morto
+        print("Encerrando o servidor...")
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
 
 # Função principal para iniciar o servidor
 def main_servidor():
+    if WORKERS > 1 and hasattr(skt, 'SO_REUSEPORT'):
+        run_workers(WORKERS)  # Um processo por shard, todos na mesma porta
+        return
     server = Servidor(skt.AF_INET, skt.SOCK_DGRAM, ADDR_BIND, MAX_BUFFER)  # Cria o servidor
     print(f"Servidor escutando em {ADDR_BIND}")
 
     try:
-        while True:
-            threading.Thread(target=server.handle_client).start()  # Inicia uma nova thread para cada cliente
+        asyncio.run(server.serve())  # Um único laço de eventos atende todos os clientes
     except KeyboardInterrupt:
         print("Encerrando o servidor...")  # Mensagem ao encerrar
 
@@ -0,0 +1,233 @@
+import socket as skt
+import time
+import threading
+import random
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import concurrent.futures
+
+from UDPclienteExtra import Cliente, ADDR_BIND, ADDR_TARGET, MAX_BUFFER
+
+
+# Benchmark de carga do servidor da entrega3: CLIENTS clientes simulados (cada um com a sua porta
+# efêmera, como o UDPclienteExtra) mandam comandos sorteados de COMMAND_MIX durante DURATION segundos,
+# cada um esperando a resposta do anterior. Sai uma tabela e um JSON com vazão e latências por comando
+CLIENTS = 20  # Clientes simulados, cada um com o seu socket e a sua thread
+DURATION = 10.0  # Segundos de carga medidos (depois do login e das acomodações iniciais)
+COMMAND_MIX = {  # Comando -> peso no sorteio
+    'login': 5,  # Logout e login de novo (só o login é medido)
+    'create': 10,
+    'list': 25,  # list:acmd paginado (uma página de LIST_PAGE)
+    'list:since': 10,  # Catálogo inteiro pela cópia local do cliente (só o que mudou)
+    'book': 25,
+    'cancel': 15,
+    'search': 15,
+}
+LIST_PAGE = 20  # Acomodações por página no comando list
+INITIAL_ACCOMMODATIONS = 5  # Acomodações criadas por cada cliente antes da carga
+LOCATIONS = 10  # Locais diferentes das acomodações (o search procura em um deles)
+CALENDAR = ['17/07/2024', '18/07/2024', '19/07/2024', '20/07/2024', '21/07/2024', '22/07/2024']  # Dias reserváveis
+THINK_TIME = 0.0  # Pausa de cada cliente entre um comando e outro (segundos)
+REQUEST_TIMEOUT = 5.0  # Espera pela resposta antes de contar o pedido como timeout
+SEED = 1  # Semente dos sorteios (cada cliente usa SEED + número dele)
+
+START_SERVER = True  # Sobe o UDPservidor3 num processo separado (False = usa um servidor já rodando)
+SERVER_WORKERS = 1  # WORKERS do servidor que o benchmark sobe
+SERVER_STATE_DIR = None  # STATE_DIR do servidor que o benchmark sobe (None = só memória, sem diário)
+SERVER_STARTUP = 1.0  # Espera para o servidor abrir a porta
+
+RESULTS_FILE = 'benchmark3.json'  # Resultado da rodada; o anterior, se existir, entra na comparação
+# Respostas que contam como erro do comando (o servidor respondeu, mas recusou). Uma busca sem
+# resultado ("Nenhuma acomodacao disponivel.") é uma resposta certa, não um erro
+ERROR_REPLIES = ('ja existe', 'ja esta em uso', 'nao encontrada', 'indisponivel', 'Voce nao pode',
+                 'invalido', 'Argumentos insuficientes', 'desconhecido', 'Erro gravando')
+
+
+class ClienteSimulado:
+    def __init__(self, number, catalogue):
+        self.number = number
+        self.username = f"carga{number}"
+        self.random = random.Random(SEED + number)
+        self.catalogue = catalogue  # (dono, nome, local) de todas as acomodações criadas, compartilhada
+        self.reservations = []  # (dono, nome, local, dia) das reservas feitas por este cliente
+        self.created = 0
+        self.samples = []  # (comando, segundos, resultado: 'ok', 'erro' ou 'timeout')
+        self.client = Cliente(skt.AF_INET, skt.SOCK_DGRAM, ADDR_BIND, MAX_BUFFER)
+        self.client.echo = False  # Os avisos do servidor não são impressos
+        self.client.rdt.negotiate(self.client.server_addr)
+        self.client.listener_thread = threading.Thread(target=self.client.listen_for_messages, daemon=True)
+        self.client.listener_thread.start()
+
+    def measure(self, command, future):
+        # Espera a resposta e guarda a amostra; devolve o texto (None se não chegou)
+        start = time.perf_counter()
+        try:
+            reply = future.result(REQUEST_TIMEOUT)
+        except (concurrent.futures.TimeoutError, ConnectionError):  # ConnectionError: a sessão foi reiniciada
+            self.samples.append((command, time.perf_counter() - start, 'timeout'))
+            return None
+        outcome = 'erro' if any(error in reply for error in ERROR_REPLIES) else 'ok'
+        self.samples.append((command, time.perf_counter() - start, outcome))
+        return reply if outcome == 'ok' else None
+
+    def create(self):
+        name = f"casa{self.number}_{self.created}"
+        location = f"cidade{self.created % LOCATIONS}"
+        self.created += 1
+        if self.measure('create', self.client.create_accommodation(name, location, "benchmark")) is not None:
+            self.catalogue.append((self.username, name, location))
+
+    def run_command(self, command):
+        if command == 'login':
+            try:
+                self.client.logout().result(REQUEST_TIMEOUT)
+            except (concurrent.futures.TimeoutError, ConnectionError):
+                pass  # O login logo abaixo conta o problema
+            self.measure(command, self.client.login(self.username))
+        elif command == 'create':
+            self.create()
+        elif command == 'list':
+            offset = self.random.randrange(max(len(self.catalogue) - LIST_PAGE, 1))
+            self.measure(command, self.client.list_accommodations(offset, LIST_PAGE))
+        elif command == 'list:since':
+            self.measure(command, self.client.list_cached())
+        elif command == 'book':
+            owner, name, location = self.random.choice(self.catalogue)
+            if owner == self.username:
+                return  # O servidor recusaria: reservar a própria acomodação
+            day = self.random.choice(CALENDAR)
+            if self.measure(command, self.client.book_accommodation(owner, name, location, day)) is not None:
+                self.reservations.append((owner, name, location, day))
+        elif command == 'cancel':
+            if self.reservations:
+                reservation = self.reservations.pop(self.random.randrange(len(self.reservations)))
+                self.measure(command, self.client.cancel_reservation(*reservation))
+        elif command == 'search':
+            first = self.random.randrange(len(CALENDAR))
+            location = f"cidade{self.random.randrange(LOCATIONS)}"
+            self.measure(command, self.client.search_accommodations(location, CALENDAR[first], CALENDAR[-1]))
+
+    def run(self, deadline):
+        commands = list(COMMAND_MIX)
+        weights = list(COMMAND_MIX.values())
+        while time.perf_counter() < deadline:
+            self.run_command(self.random.choices(commands, weights)[0])
+            if THINK_TIME:
+                time.sleep(THINK_TIME)
+
+
+def percentile(values, fraction):
+    # Percentil pelo posto mais próximo, de uma lista já ordenada
+    if not values:
+        return None
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def summarize(samples, elapsed):
+    commands = {}
+    for command in sorted({command for command, _, _ in samples}):
+        times = sorted(seconds for name, seconds, _ in samples if name == command)
+        outcomes = [outcome for name, _, outcome in samples if name == command]
+        commands[command] = {
+            'count': len(times),
+            'ops_per_s': len(times) / elapsed,
+            'error_rate': outcomes.count('erro') / len(outcomes),
+            'timeout_rate': outcomes.count('timeout') / len(outcomes),
+            'mean_ms': sum(times) / len(times) * 1000,
+            'p50_ms': percentile(times, 0.50) * 1000,
+            'p95_ms': percentile(times, 0.95) * 1000,
+            'p99_ms': percentile(times, 0.99) * 1000,
+        }
+    return {
+        'config': {
+            'clients': CLIENTS, 'duration': DURATION, 'mix': COMMAND_MIX, 'list_page': LIST_PAGE,
+            'initial_accommodations': INITIAL_ACCOMMODATIONS, 'think_time': THINK_TIME,
+            'seed': SEED, 'server_workers': SERVER_WORKERS, 'server_state_dir': SERVER_STATE_DIR,
+        },
+        'elapsed': elapsed,
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed,
+        'error_rate': sum(outcome == 'erro' for _, _, outcome in samples) / max(len(samples), 1),
+        'timeout_rate': sum(outcome == 'timeout' for _, _, outcome in samples) / max(len(samples), 1),
+        'commands': commands,
+    }
+
+
+def print_report(results, previous):
+    # Tabela por comando; com um resultado anterior, a variação da vazão e do p95 ao lado
+    def change(now, before):
+        return f" ({(now - before) / before * 100:+.1f}%)" if before else ""
+    old = previous['commands'] if previous else {}
+    print(f"{results['requests']} pedidos em {results['elapsed']:.1f}s: {results['throughput']:.1f} pedidos/s"
+          + change(results['throughput'], previous['throughput'] if previous else 0)
+          + f", erros {results['error_rate']:.2%}, timeouts {results['timeout_rate']:.2%}")
+    print(f"{'comando':<12}{'n':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'erros':>8}{'timeouts':>10}")
+    for command, stats in results['commands'].items():
+        print(f"{command:<12}{stats['count']:>8}{stats['ops_per_s']:>10.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['error_rate']:>8.1%}{stats['timeout_rate']:>10.1%}"
+              + change(stats['p95_ms'], old.get(command, {}).get('p95_ms', 0)))
+
+
+def start_server():
+    # O servidor roda no diretório do benchmark (o diário, se houver, fica num diretório temporário)
+    code = (f"import UDPservidor3 as s; s.WORKERS = {SERVER_WORKERS}; s.STATE_DIR = {SERVER_STATE_DIR!r}; "
+            "s.main_servidor()")
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=tempfile.mkdtemp(), env={**os.environ, 'PYTHONPATH': here},
+                              stdout=subprocess.DEVNULL, start_new_session=True)
+    time.sleep(SERVER_STARTUP)
+    return server
+
+
+def stop_server(server):
+    if os.name == 'posix':
+        os.killpg(server.pid, signal.SIGINT)  # Como um Ctrl+C: encerra todos os processos do servidor
+    else:
+        server.terminate()
+    server.wait()
+
+
+def main_benchmark():
+    server = start_server() if START_SERVER else None
+    try:
+        catalogue = []
+        clients = [ClienteSimulado(number, catalogue) for number in range(CLIENTS)]
+        for simulated in clients:  # Login e acomodações iniciais, fora do tempo da carga
+            simulated.measure('login', simulated.client.login(simulated.username))
+            for _ in range(INITIAL_ACCOMMODATIONS):
+                simulated.create()
+        if not catalogue:
+            print(f"O servidor em {ADDR_TARGET} não respondeu")
+            return
+        for simulated in clients:
+            simulated.samples = []  # Só a carga entra no resultado
+        start = time.perf_counter()
+        threads = [threading.Thread(target=simulated.run, args=(start + DURATION,)) for simulated in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    results = summarize([sample for simulated in clients for sample in simulated.samples], elapsed)
+    previous = None
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE) as file:
+            previous = json.load(file)
+    print_report(results, previous)
+    with open(RESULTS_FILE, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Resultado gravado em {RESULTS_FILE}")
+
+
+# Verifica se o script está sendo executado diretamente
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,208 @@
+import os
+import time
+import atexit
+import bisect
+import collections
+import functools
+import itertools
+import json
+import threading
+
+
+# Métricas, log e perfil compartilhados pelas entregas (como o proxy_rede, fica na raiz do repositório e
+# cada entrega importa daqui). As entregas guardam as suas métricas num Metricas (contadores, histogramas
+# e medidores), que sai no formato de texto do Prometheus ou em JSON, e cronometram os seus métodos com
+# um Perfil; onde e quando gravar, e o que cronometrar, continua na configuração de cada entrega
+# (METRICS_FILE, METRICS_EVERY, PROFILE, PROFILE_FILE e as tabelas de spans)
+METRICS_FORMAT = 'prometheus'  # 'prometheus' (formato de texto do Prometheus) ou 'json'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # Limites dos histogramas (s)
+
+# Log por nível: o que fica abaixo de LOG_LEVEL não é nem formatado, e as mensagens de cada pacote ou
+# pedido (debug) ainda passam por amostragem; imprimir todo pacote custava mais que enviar ele
+LOG_LEVEL = 'info'  # Menor nível impresso: 'debug', 'info', 'aviso' ou 'silencio'
+LOG_SAMPLE = 100  # No nível debug, só uma de cada LOG_SAMPLE mensagens é impressa
+LOG_LEVELS = {'debug': 10, 'info': 20, 'aviso': 30, 'silencio': 100}
+
+
+log_sequence = itertools.count()  # Numera as mensagens de debug para a amostragem
+
+
+def log(level, message, *args):
+    # A mensagem só é montada (message % args) se for mesmo impressa
+    if LOG_LEVELS[level] < LOG_LEVELS[LOG_LEVEL]:
+        return
+    if level == 'debug' and next(log_sequence) % LOG_SAMPLE:
+        return
+    print(message % args if args else message)
+
+
+def merge_snapshots(snapshots):
+    # Soma as métricas de vários processos (o stats da entrega3 com shards)
+    counters, gauges, histograms = collections.Counter(), collections.Counter(), {}
+    for snapshot in snapshots:
+        counters.update(snapshot['counters'])
+        gauges.update(snapshot['gauges'])
+        for name, histogram in snapshot['histograms'].items():
+            total = histograms.setdefault(name, {'counts': [0] * len(histogram['counts']), 'sum': 0.0})
+            total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+    return {'counters': dict(counters), 'histograms': histograms, 'gauges': dict(gauges)}
+
+
+def prometheus_text(snapshot):
+    # Formato de texto do Prometheus; os rótulos já vêm no nome (nome{rotulo="valor"}), e as séries de
+    # uma mesma métrica saem juntas, depois da linha TYPE dela
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        base, _, labels = name.partition('{')
+        if base not in typed:
+            typed.add(base)
+            lines.append(f"# TYPE {base} {kind}")
+        return base, labels.rstrip('}')
+
+    def ordered(values):
+        return sorted(values.items(), key=lambda item: item[0].partition('{')[::2])
+    for kind, values in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+        for name, value in ordered(values):
+            declare(name, kind)
+            lines.append(f"{name} {value}")
+    for name, histogram in ordered(snapshot['histograms']):
+        base, labels = declare(name, 'histogram')
+        prefix = labels + ',' if labels else ''
+        suffix = '{' + labels + '}' if labels else ''
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram['counts']):
+            cumulative += count
+            lines.append(f'{base}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f"{base}_sum{suffix} {histogram['sum']}")
+        lines.append(f"{base}_count{suffix} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, snapshot):
+    # Grava num temporário e troca de nome: quem lê o arquivo nunca pega uma gravação pela metade
+    text = json.dumps(snapshot, indent=2) if METRICS_FORMAT == 'json' else prometheus_text(snapshot)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+# Contadores e histogramas sem lock: cada thread soma no seu próprio acumulador (threading.local), que
+# entra uma vez na lista de acumuladores, e a exportação soma os de todas as threads. Os medidores
+# (janela, filas, sessões) são funções lidas só na hora da exportação, sem custo no caminho dos pacotes
+class Metricas:
+    def __init__(self):
+        self.local = threading.local()
+        self.accumulators = []  # (contadores, histogramas) de cada thread que já registrou algo
+        self.gauges = {}  # Nome -> função que devolve o valor atual
+
+    def accumulator(self):
+        try:
+            return self.local.accumulator
+        except AttributeError:
+            self.local.accumulator = accumulator = (collections.Counter(), {})
+            self.accumulators.append(accumulator)  # list.append é atômico: não precisa de lock
+            return accumulator
+
+    def add(self, name, amount=1):
+        self.accumulator()[0][name] += amount
+
+    def observe(self, name, value):
+        # Histograma: contagem por faixa de LATENCY_BUCKETS (a última fica acima de todas) e a soma no fim
+        histograms = self.accumulator()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        # Só quem escreve num acumulador é a thread dele, e as cópias (dict(), list()) são feitas em C
+        # sem soltar o GIL: uma soma feita ao mesmo tempo entra nesta leitura ou na próxima, nunca se perde
+        counters = collections.Counter()
+        histograms = {}
+        for thread_counters, thread_histograms in list(self.accumulators):
+            counters.update(dict(thread_counters))
+            for name, histogram in list(thread_histograms.items()):
+                histogram = list(histogram)
+                total = histograms.get(name)
+                histograms[name] = histogram if total is None else [a + b for a, b in zip(total, histogram)]
+        return {
+            'counters': dict(counters),
+            'histograms': {name: {'counts': values[:-1], 'sum': values[-1]} for name, values in histograms.items()},
+            'gauges': {name: function() for name, function in self.gauges.items()},
+        }
+
+    def dump_every(self, path, every):
+        # Regrava o arquivo numa thread à parte enquanto o programa roda (quem não tem laço de eventos)
+        def run():
+            while True:
+                time.sleep(every)
+                write_metrics(path, self.snapshot())
+        threading.Thread(target=run, daemon=True).start()
+
+
+# Spans de tempo: cada função cronometrada soma o próprio tempo (menos o dos spans abertos dentro dela)
+# na pilha de spans da thread, sem lock (um Counter por thread, como as métricas). A saída tem uma linha
+# "thread;span;span microssegundos" por pilha, o formato colapsado dos flame graphs
+class Perfil:
+    def __init__(self):
+        self.local = threading.local()
+        self.totals = []  # Counter (pilha -> segundos) de cada thread
+        self.started = False
+
+    def state(self):
+        try:
+            return self.local.state
+        except AttributeError:
+            # Pilha de nomes (começa pela thread), tempo dos spans filhos de cada nível e os totais
+            self.local.state = state = ([threading.current_thread().name], [], collections.Counter())
+            self.totals.append(state[2])
+            return state
+
+    def wrap(self, name, function):
+        @functools.wraps(function)  # Mantém o nome (as threads criadas com target=método levam ele no nome)
+        def span(*args, **kwargs):
+            stack, children, totals = self.state()
+            stack.append(name)
+            children.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                totals[';'.join(stack)] += elapsed - children.pop()
+                stack.pop()
+                if children:
+                    children[-1] += elapsed
+        return span
+
+    def instrument(self, obj, spans):
+        # Troca os métodos listados (método -> span) pelas versões cronometradas, só nesse objeto
+        for method, name in spans.items():
+            setattr(obj, method, self.wrap(name, getattr(obj, method)))
+
+    def start(self, namespace, spans, path=None):
+        # Uma vez por perfil: cronometra as funções do módulo (namespace = globals()) e, com path,
+        # grava o perfil nele na saída do programa (sem path, quem chama o dump é a entrega)
+        if self.started:
+            return
+        self.started = True
+        for function, name in spans.items():
+            namespace[function] = self.wrap(name, namespace[function])
+        if path is not None:
+            atexit.register(self.dump, path)
+
+    def dump(self, path):
+        totals = collections.Counter()
+        for thread_totals in list(self.totals):
+            totals.update(dict(thread_totals))
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, seconds in sorted(totals.items()):
+                if round(seconds * 1e6) > 0:
+                    f.write(f"{stack} {round(seconds * 1e6)}\n")
@@ -0,0 +1,258 @@
+import socket as skt
+import asyncio
+import collections
+import random
+import threading
+
+
+# Proxy UDP que simula uma rede ruim entre cliente e servidor: o cliente manda para LISTEN_ADDR em vez
+# do servidor, e cada datagrama passa por um enlace com perda, atraso, variação, reordenação, duplicação
+# e limite de banda antes de seguir para TARGET_ADDR; as respostas voltam pelo enlace do outro sentido
+# (onde se perdem os ACKs). Cada cliente ganha um socket próprio do proxy para o servidor, então o
+# servidor vê endereços diferentes como veria sem o proxy. Os sorteios usam SEED: a mesma sequência de
+# datagramas sofre os mesmos efeitos em cada rodada
+LISTEN_ADDR = ('localhost', 7071)  # Onde o proxy escuta os clientes (aponte o ADDR_TARGET do cliente para cá)
+TARGET_ADDR = ('127.0.0.1', 7070)  # Servidor de verdade
+PROFILE = 'perda'  # Perfil usado quando o proxy roda sozinho (um dos PROFILES)
+SEED = 1  # Semente dos sorteios
+ROUTE_IDLE = 60.0  # Segundos sem tráfego até o socket de um cliente ser fechado
+RCVBUF_SIZE = 4 * 1024 * 1024  # Buffer de recepção pedido ao SO para cada socket do proxy (rajadas)
+
+# Parâmetros de um sentido do enlace (ida = cliente -> servidor, volta = servidor -> cliente)
+LINK_DEFAULTS = {
+    'loss': 0.0,  # Probabilidade de perder o datagrama
+    'delay': 0.0,  # Atraso fixo (segundos)
+    'jitter': 0.0,  # Variação do atraso, sorteada em [-jitter, +jitter] (sozinha não muda a ordem)
+    'reorder': 0.0,  # Probabilidade do datagrama ficar para trás dos seguintes
+    'reorder_delay': 0.01,  # Quanto um datagrama reordenado fica para trás (segundos)
+    'duplicate': 0.0,  # Probabilidade de entregar duas cópias
+    'rate': 0,  # Banda em bytes por segundo (0 = sem limite)
+    'queue': 256 * 1024,  # Bytes esperando a banda antes de começar a descartar (com rate)
+}
+# Perfis: parâmetros dos dois sentidos, e em 'ida'/'volta' o que muda só em um deles
+PROFILES = {
+    'limpo': {},
+    'lan': {'delay': 0.0005, 'jitter': 0.0002},
+    'perda': {'loss': 0.05},
+    'ack_perdido': {'volta': {'loss': 0.2}},
+    'wifi': {'loss': 0.01, 'delay': 0.003, 'jitter': 0.002, 'reorder': 0.01, 'duplicate': 0.002, 'rate': 5_000_000},
+    'movel': {'loss': 0.02, 'delay': 0.04, 'jitter': 0.015, 'reorder': 0.02, 'rate': 1_000_000},
+    'satelite': {'loss': 0.005, 'delay': 0.3, 'jitter': 0.005, 'rate': 2_000_000, 'queue': 1024 * 1024},
+}
+
+
+def set_rcvbuf(transport):
+    try:
+        transport.get_extra_info('socket').setsockopt(skt.SOL_SOCKET, skt.SO_RCVBUF, RCVBUF_SIZE)
+    except OSError:
+        pass  # O SO pode limitar o valor (net.core.rmem_max no Linux)
+
+
+def link_params(profile, direction):
+    params = {key: value for key, value in profile.items() if key not in ('ida', 'volta')}
+    return {**LINK_DEFAULTS, **params, **profile.get(direction, {})}
+
+
+class Enlace:
+    # Um sentido da rede simulada: decide o destino de cada datagrama e agenda a entrega no laço
+    def __init__(self, params, seed):
+        self.params = params
+        self.random = random.Random(seed)
+        self.busy_until = 0.0  # Quando a banda termina de transmitir o que já está na fila
+        self.last_arrival = 0.0  # Entrega agendada mais tarde, para a variação não reordenar
+        # Entregas em ordem: (instante, função, datagrama), esvaziada por um timer só (timers do laço
+        # com o mesmo instante não saem necessariamente na ordem em que foram agendados)
+        self.queue = collections.deque()
+        self.timer = None
+        self.stats = collections.Counter()
+
+    def send(self, data, deliver):
+        params = self.params
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.stats['recebidos'] += 1
+        if self.random.random() < params['loss']:
+            self.stats['perdidos'] += 1
+            return
+        copies = 2 if self.random.random() < params['duplicate'] else 1
+        self.stats['duplicados'] += copies - 1
+        for _ in range(copies):
+            departure = now
+            if params['rate']:
+                start = max(now, self.busy_until)
+                if (start - now) * params['rate'] > params['queue']:
+                    self.stats['fila cheia'] += 1  # Descarte no fim da fila, como um roteador
+                    continue
+                departure = self.busy_until = start + len(data) / params['rate']
+            arrival = departure + params['delay'] + self.random.uniform(-params['jitter'], params['jitter'])
+            self.stats['entregues'] += 1
+            if self.random.random() < params['reorder']:
+                self.stats['reordenados'] += 1
+                loop.call_at(arrival + params['reorder_delay'], deliver, data)  # Fora da fila: passa os seguintes
+            elif arrival <= now and not self.queue:
+                deliver(data)
+            else:
+                self.last_arrival = max(arrival, self.last_arrival)
+                self.queue.append((self.last_arrival, deliver, data))
+                if self.timer is None:
+                    self.timer = loop.call_at(self.last_arrival, self.drain)
+
+    def drain(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        _, deliver, data = self.queue.popleft()  # O timer é do primeiro da fila
+        deliver(data)
+        while self.queue and self.queue[0][0] <= now:
+            _, deliver, data = self.queue.popleft()
+            deliver(data)
+        self.timer = loop.call_at(self.queue[0][0], self.drain) if self.queue else None
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class Rota(asyncio.DatagramProtocol):
+    # Socket do proxy para o servidor, de um cliente: o que o servidor responde volta para esse cliente
+    def __init__(self, relay, client_addr):
+        self.relay = relay
+        self.client_addr = client_addr
+        self.transport = None
+        self.pending = []  # Datagramas que chegaram antes do socket ficar pronto
+        self.last_seen = asyncio.get_running_loop().time()
+
+    def connection_made(self, transport):
+        if self.pending is None:
+            transport.close()  # O cliente expirou antes do socket ficar pronto
+            return
+        self.transport = transport
+        set_rcvbuf(transport)
+        for data in self.pending:
+            transport.sendto(data)
+        self.pending = None
+
+    def forward(self, data):
+        if self.transport is not None:
+            self.transport.sendto(data)
+        elif self.pending is not None:
+            self.pending.append(data)
+
+    def datagram_received(self, data, addr):
+        self.last_seen = asyncio.get_running_loop().time()
+        self.relay.volta.send(data, self.back)
+
+    def back(self, data):
+        self.relay.transport.sendto(data, self.client_addr)
+
+    def error_received(self, exc):
+        pass  # Servidor fora do ar (ICMP): o datagrama se perde, como na rede
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.pending = None
+
+
+class Relay(asyncio.DatagramProtocol):
+    def __init__(self, target_addr, profile, seed):
+        self.target_addr = target_addr
+        self.ida = Enlace(link_params(profile, 'ida'), f"{seed} ida")
+        self.volta = Enlace(link_params(profile, 'volta'), f"{seed} volta")
+        self.routes = {}  # Endereço do cliente -> Rota
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.expire()
+
+    def datagram_received(self, data, addr):
+        route = self.routes.get(addr)
+        if route is None:
+            route = self.routes[addr] = Rota(self, addr)
+            loop = asyncio.get_running_loop()
+            loop.create_task(loop.create_datagram_endpoint(lambda: route, remote_addr=self.target_addr))
+        route.last_seen = asyncio.get_running_loop().time()
+        self.ida.send(data, route.forward)
+
+    def expire(self):
+        # Fecha os sockets de clientes parados há mais de ROUTE_IDLE
+        loop = asyncio.get_running_loop()
+        for addr, route in list(self.routes.items()):
+            if loop.time() - route.last_seen > ROUTE_IDLE:
+                route.close()
+                del self.routes[addr]
+        self.timer = loop.call_later(ROUTE_IDLE, self.expire)
+
+    def close(self):
+        self.timer.cancel()
+        self.ida.close()
+        self.volta.close()
+        for route in self.routes.values():
+            route.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def report(self):
+        return {'ida': dict(self.ida.stats), 'volta': dict(self.volta.stats)}
+
+
+async def run_proxy(listen_addr, target_addr, profile, seed, ready=None):
+    # Roda até ser cancelado; ready recebe o endereço em que o proxy ficou escutando e o Relay, que
+    # tem as contagens de cada sentido
+    loop = asyncio.get_running_loop()
+    transport, relay = await loop.create_datagram_endpoint(lambda: Relay(target_addr, profile, seed), local_addr=listen_addr)
+    set_rcvbuf(transport)
+    if ready is not None:
+        ready(transport.get_extra_info('sockname'), relay)
+    try:
+        await asyncio.Future()
+    finally:
+        relay.close()
+
+
+def start_proxy(target_addr, profile, seed=SEED, listen_addr=('127.0.0.1', 0)):
+    # Proxy numa thread, para scripts de teste e benchmarks: devolve o endereço dele e a função que o
+    # para (e devolve as contagens de cada sentido)
+    started = threading.Event()
+    state = {}
+
+    def ready(addr, relay):
+        state['addr'] = addr
+        state['relay'] = relay
+        started.set()
+
+    async def main():
+        state['task'] = asyncio.current_task()
+        state['loop'] = asyncio.get_running_loop()
+        await run_proxy(listen_addr, target_addr, profile, seed, ready)
+
+    def run():
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        state['loop'].call_soon_threadsafe(state['task'].cancel)
+        thread.join()
+        return state['relay'].report()
+    return state['addr'], stop
+
+
+def main_proxy():
+    print(f"Proxy em {LISTEN_ADDR} -> {TARGET_ADDR}, perfil {PROFILE}: {PROFILES[PROFILE]}")
+    relays = []
+    try:
+        asyncio.run(run_proxy(LISTEN_ADDR, TARGET_ADDR, PROFILES[PROFILE], SEED, lambda addr, relay: relays.append(relay)))
+    except KeyboardInterrupt:
+        print("Encerrando o proxy...")
+    if relays:
+        print(f"Datagramas: {relays[0].report()}")
+
+
+# Verifica se o script está sendo executado diretamente
+if __name__ == "__main__":
+    main_proxy()
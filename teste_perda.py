@@ -0,0 +1,88 @@
+import socket as skt
+import os
+import sys
+import time
+import asyncio
+import threading
+import importlib.util
+
+import metricas
+from proxy_rede import start_proxy
+
+
+# Teste reproduzível da entrega3 numa rede ruim: o servidor e um cliente rodam neste processo, com o
+# proxy_rede entre os dois perdendo e reordenando datagramas nos dois sentidos (sempre com a mesma
+# semente). O cliente manda CREATES pedidos de criação de uma vez, sem esperar as respostas (pipelining),
+# com descrições maiores que o datagrama (cada pedido vai em vários fragmentos com FLAG_MORE); depois pede
+# a listagem inteira, que volta fragmentada do servidor. Passa se todas as respostas chegarem certas em
+# até TIME_LIMIT segundos; o código de saída é 1 se não passar
+NETWORK = {'loss': 0.2, 'reorder': 0.1}  # Parâmetros do enlace do proxy_rede, iguais nos dois sentidos
+SEED = 1  # Semente dos sorteios do proxy
+CREATES = 200  # Pedidos de criação mandados de uma vez
+DESCRIPTION_SIZE = 3000  # Bytes da descrição de cada acomodação (uns 3 fragmentos de MAX_BUFFER)
+TIME_LIMIT = 30.0  # Segundos para o teste inteiro (no loopback, sem perda, leva menos de 1 s)
+
+
+def load(filename):
+    # Carrega o módulo da entrega3 pelo caminho, sem as mensagens dele na saída do teste
+    root = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(filename[:-3], os.path.join(root, 'entrega3', filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.print = lambda *args, **kwargs: None
+    return module
+
+
+def main_teste():
+    S = load('UDPservidor3.py')
+    C = load('UDPcliente3.py')
+    S.STATE_DIR = None  # Estado só em memória: o teste não deixa arquivos
+    metricas.LOG_LEVEL = 'silencio'  # O log das entregas sai pelo metricas.py
+
+    server = S.Servidor(skt.AF_INET, skt.SOCK_DGRAM, ('127.0.0.1', 0), S.MAX_BUFFER)
+    threading.Thread(target=lambda: asyncio.run(server.serve()), daemon=True).start()
+    proxy_addr, stop = start_proxy(server.sckt.getsockname(), NETWORK, seed=SEED)
+    # Sem negociação: os datagramas ficam em MAX_BUFFER e as mensagens grandes vão fragmentadas
+    client = C.Cliente(skt.AF_INET, skt.SOCK_DGRAM, ('127.0.0.1', 0), C.MAX_BUFFER)
+    client.server_addr = proxy_addr
+    client.echo = False
+    threading.Thread(target=client.listen_for_messages, daemon=True).start()
+
+    start = time.monotonic()
+    deadline = start + TIME_LIMIT
+    failures = []
+    try:
+        client.login('perda').result(TIME_LIMIT)
+        description = 'x' * DESCRIPTION_SIZE
+        futures = [client.create_accommodation(f'perda{i}', 'recife', description) for i in range(CREATES)]
+        for i, future in enumerate(futures):
+            reply = future.result(max(deadline - time.monotonic(), 0))
+            if 'criada com sucesso' not in reply:
+                failures.append(f"create perda{i}: {reply}")
+        created = time.monotonic()
+        listing = client.list_accommodations().result(max(deadline - time.monotonic(), 0))
+        missing = [i for i in range(CREATES) if f'perda{i} em recife' not in listing]
+        if missing:
+            failures.append(f"list: {len(missing)} acomodações faltando (a primeira é perda{missing[0]})")
+    except Exception as exc:  # Timeout do Future ou sessão reiniciada
+        failures.append(f"sem resposta: {exc!r}")
+        created = time.monotonic()
+    elapsed = time.monotonic() - start
+    report = stop()
+
+    print(f"{CREATES} creates em {created - start:.2f}s, listagem em {elapsed - (created - start):.2f}s, "
+          f"total {elapsed:.2f}s (limite {TIME_LIMIT:.0f}s)")
+    for direction, counts in report.items():
+        print(f"{direction}: " + ', '.join(f"{key} {value}" for key, value in counts.items()))
+    if elapsed > TIME_LIMIT:
+        failures.append(f"passou do limite de {TIME_LIMIT:.0f}s")
+    for failure in failures:
+        print(f"FALHOU: {failure}")
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+# Verifica se o script está sendo executado diretamente
+if __name__ == "__main__":
+    sys.exit(main_teste())